@@ -21,6 +21,7 @@ def main():
     auth = AuthClient(sock, emit_status=lambda s: logging.info("[AUTH] %s", s))
     handler.register("AUTH_OK", auth.on_auth_ok)
     handler.register("AUTH_FAIL", auth.on_auth_fail)
+    sock.set_on_reconnect(auth.resume)
 
     # ---- notification ----
     notif = NotificationManager(emit=lambda ev, data: logging.info("[NOTIF] %s %s", ev, data))
@@ -48,6 +49,23 @@ def main():
                          m.get("to_user_id"), tag,
                          f"(react={rx})" if rx else "")
 
+    def on_sync(data: dict):
+        for m in data.get("messages") or []:
+            where = f"group {m['group_id']}" if m.get("group_id") is not None else f"-> {m.get('to_user_id')}"
+            rx = m.get("reactions_summary") or {}
+            logging.info("[SYNC] [%s] %s %s: %s %s", m.get("message_id"), m.get("from_user_id"), where,
+                         "[RECALLED]" if m.get("recalled") else m.get("content"),
+                         f"(react={rx})" if rx else "")
+
+    def on_conv_list(data: dict):
+        for c in data.get("conversations") or []:
+            who = f"group {c['group_id']} {c.get('name')}" if "group_id" in c else f"peer {c.get('peer_id')} {c.get('username')}"
+            last = c.get("last_message") or {}
+            logging.info("[INBOX] %s (%s unread): %s", who, c.get("unread"),
+                         "[RECALLED]" if last.get("recalled") else last.get("content"))
+        if data.get("has_more"):
+            logging.info("[INBOX] còn nữa: inbox %s", data["conversations"][-1]["last_message"]["message_id"])
+
     msg_cli = MessageClient(
         sock,
         on_recv=on_recv_1v1,
@@ -55,12 +73,26 @@ def main():
         on_seen_update=lambda d: logging.info("[SEEN_UPDATE] %s", d),
         on_recall_update=lambda d: logging.info("[RECALL_UPDATE] %s", d),
         on_react_update=lambda d: logging.info("[REACT_UPDATE] %s", d),
+        on_batch_result=lambda d: logging.info("[BATCH_RESULT] %s", d),
+        on_sync=on_sync,
+        on_conv_list=on_conv_list,
     )
     handler.register("MSG_RECV", msg_cli.handle_msg_recv)
     handler.register("MSG_HISTORY_RESULT", msg_cli.handle_history_result)
     handler.register("MSG_SEEN_UPDATE", msg_cli.handle_seen_update)
     handler.register("MSG_RECALL_UPDATE", msg_cli.handle_recall_update)
     handler.register("MSG_REACT_UPDATE", msg_cli.handle_react_update)
+    handler.register("BATCH_RESULT", msg_cli.handle_batch_result)
+    handler.register("SYNC_RESULT", msg_cli.handle_sync_result)
+    handler.register("CONV_LIST_RESULT", msg_cli.handle_conv_list_result)
+    def on_auth_ok(m: dict):
+        auth.on_auth_ok(m)
+        # after every login/resume: first time only fetches the cursor, after a reconnect catches up.
+        # The AUTH_OK of AUTH_REGISTER carries no token and logs nobody in (SYNC would get ERROR UNAUTH)
+        if (m.get("data") or {}).get("token"):
+            msg_cli.sync()
+
+    handler.register("AUTH_OK", on_auth_ok)
 
     # ---- groups wiring ----
     def on_group_event(ev: str, data: dict):
@@ -76,7 +108,8 @@ def main():
     handler.register("GROUP_INVITE_ACCEPTED", grp.on_invite_accepted)
     handler.register("GROUP_INVITE_DECLINED", grp.on_invite_declined)
     # Messages
-    handler.register("GROUP_MSG_RECV", lambda m: (notif.on_incoming_msg(m.get("data", {})),
+    handler.register("GROUP_MSG_RECV", lambda m: (msg_cli.advance_cursor(m.get("data") or {}),
+                                                  notif.on_incoming_msg(m.get("data", {})),
                                                   logging.info("[GROUP_MSG] %s", m.get("data"))))
     handler.register("GROUP_HISTORY_RESULT", lambda m: logging.info("[GROUP_HISTORY] %s", m.get("data")))
 
@@ -91,7 +124,7 @@ def main():
         time.sleep(0.3)
         logging.info("Lệnh:")
         logging.info("  reg <u> <p> | login <u> <p>")
-        logging.info("  peer <user_id> | send <text> | history")
+        logging.info("  inbox [before_message_id] | peer <user_id> | send <text> | history")
         logging.info("  reply <message_id> <text> | seen <id1> [id2] ... | recall <id> | react <id> <like|heart|smile>")
         logging.info("  group create <name> | group add <gid> <uid> | group list")
         logging.info("  group send <gid> <text> | group reply <gid> <msg_id> <text> | group history <gid>")
@@ -115,6 +148,14 @@ def main():
                     continue
                 (auth.register if action == "reg" else auth.login)(u, p)
 
+            elif action == "inbox":
+                try:
+                    before = int(parts[1]) if len(parts) > 1 else None
+                except ValueError:
+                    logging.info("Cú pháp: inbox [before_message_id]")
+                    continue
+                msg_cli.list_conversations(before_id=before)
+
             elif action == "peer":
                 try:
                     pid = int(parts[1].strip())
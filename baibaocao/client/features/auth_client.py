@@ -5,14 +5,16 @@ from client.utils.helpers import new_request_id
 
 class AuthClient:
     """
-    API phía client để gửi AUTH_REGISTER / AUTH_LOGIN
-    và lưu phiên đăng nhập tạm (in-memory).
+    API phía client để gửi AUTH_REGISTER / AUTH_LOGIN / AUTH_RESUME
+    và lưu phiên đăng nhập tạm (in-memory). Token trong AUTH_OK được giữ lại
+    để resume() đăng nhập lại sau khi mất kết nối mà không gửi mật khẩu.
     """
 
     def __init__(self, sock: SocketClient, emit_status: Optional[Callable[[str], None]] = None):
         self.sock = sock
         self.user_id: Optional[int] = None
         self.username: Optional[str] = None
+        self.token: Optional[str] = None
         self.emit_status = emit_status or (lambda msg: None)
 
     # --- gửi ---
@@ -30,13 +32,26 @@ class AuthClient:
             "request_id": new_request_id()
         })
 
+    def resume(self):
+        """Gọi sau khi SocketClient nối lại; không làm gì nếu chưa từng đăng nhập."""
+        if not self.token:
+            return
+        self.sock.send_json({
+            "type": "AUTH_RESUME",
+            "data": {"token": self.token},
+            "request_id": new_request_id()
+        })
+
     # --- nhận ---
     def on_auth_ok(self, msg: dict):
         data = msg.get("data", {})
         self.user_id = data.get("user_id")
         self.username = data.get("username")
+        self.token = data.get("token") or self.token
         self.emit_status(f"Đăng nhập OK: {self.username} (id={self.user_id})")
 
     def on_auth_fail(self, msg: dict):
         reason = (msg.get("data") or {}).get("reason", "unknown")
+        if reason == "invalid_token":
+            self.token = None  # hết hạn / server đổi khoá: phải login lại
         self.emit_status(f"Đăng nhập/đăng ký FAIL: {reason}")
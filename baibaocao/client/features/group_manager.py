@@ -1,7 +1,7 @@
 # client/features/group_manager.py
-from typing import Callable, Optional, Dict, Any
+from typing import Callable, Optional, Dict, Any, Iterable, List, Tuple
 from client.network.socket_client import SocketClient
-from client.utils.helpers import new_request_id
+from client.utils.helpers import command, new_request_id
 
 
 class GroupManager:
@@ -16,6 +16,7 @@ class GroupManager:
       - GROUP_INVITE_DECLINE{invite_id}
       - GROUP_MSG_SEND{group_id, content, reply_to_id?}
       - GROUP_HISTORY{group_id, before_id?, limit}
+      - BATCH{items:[lệnh ở trên...]}  (send_text_batch, add_members_batch)
 
     Server phản hồi / fanout:
       - GROUP_CREATED{group_id, name}
@@ -25,8 +26,9 @@ class GroupManager:
       - GROUP_INVITE_LIST_RESULT{incoming:[], outgoing:[]}
       - GROUP_INVITE_ACCEPTED{invite_id, group_id, user_id}
       - GROUP_INVITE_DECLINED{invite_id, group_id, user_id}
-      - GROUP_MSG_RECV{message_id, group_id, from_user_id, content, created_at, reply_to_id?}
+      - GROUP_MSG_RECV{message_id, group_id, from_user_id, content, created_at, reply_to_id?, seq}
       - GROUP_HISTORY_RESULT{group_id, messages:[...], has_more:bool}
+      - BATCH_RESULT{results:[{request_id, ok, replies:[...]}, ...]}  (theo thứ tự các lệnh trong BATCH)
     """
 
     def __init__(
@@ -94,6 +96,19 @@ class GroupManager:
             "request_id": new_request_id()
         })
 
+    # ---- batch senders ----
+    def send_text_batch(self, messages: Iterable[Tuple]) -> List[str]:
+        """messages: (group_id, content) hoặc (group_id, content, reply_to_id)."""
+        return self.sock.send_batch([
+            command("GROUP_MSG_SEND", {"group_id": m[0], "content": m[1], "reply_to_id": m[2] if len(m) > 2 else None})
+            for m in messages
+        ])
+
+    def add_members_batch(self, group_id: int, user_ids: Iterable[int]) -> List[str]:
+        return self.sock.send_batch([
+            command("GROUP_ADD", {"group_id": group_id, "user_id": uid}) for uid in user_ids
+        ])
+
     # ---- handlers ----
     def on_created(self, msg: dict):
         self.on_event("GROUP_CREATED", msg.get("data") or {})
@@ -122,3 +137,6 @@ class GroupManager:
 
     def on_history_result(self, msg: dict):
         self.on_event("GROUP_HISTORY_RESULT", msg.get("data") or {})
+
+    def on_batch_result(self, msg: dict):
+        self.on_event("BATCH_RESULT", msg.get("data") or {})
@@ -1,7 +1,7 @@
 # client/features/message_client.py
-from typing import Optional, Callable, Dict, Any, List
+from typing import Optional, Callable, Dict, Any, Iterable, List, Tuple
 from client.network.socket_client import SocketClient
-from client.utils.helpers import new_request_id
+from client.utils.helpers import command, new_request_id
 
 class MessageClient:
     """
@@ -12,6 +12,13 @@ class MessageClient:
       - handle_seen_update
       - handle_recall_update
       - handle_react_update
+      - handle_batch_result
+      - handle_sync_result
+      - handle_conv_list_result
+    sync() lấy bù mọi thay đổi kể từ cursor lần trước (gọi sau mỗi lần login/resume, không sau đăng ký).
+    Các bản tin đẩy MSG_RECV / GROUP_MSG_RECV / MSG_RECALL_UPDATE / MSG_REACT_UPDATE mang "seq" của thay đổi,
+    cursor chỉ tiến khi seq liền ngay sau cursor (advance_cursor): bản tin đẩy có thể đến lệch thứ tự, nên gặp
+    khoảng trống thì dừng lại và lần sync sau tải lại từ đó, không bỏ sót thay đổi nào.
     Đồng thời có alias on_msg_recv / on_history_result để tương thích bản cũ.
     """
 
@@ -23,6 +30,9 @@ class MessageClient:
         on_seen_update: Optional[Callable[[Dict[str, Any]], None]] = None,
         on_recall_update: Optional[Callable[[Dict[str, Any]], None]] = None,
         on_react_update: Optional[Callable[[Dict[str, Any]], None]] = None,
+        on_batch_result: Optional[Callable[[Dict[str, Any]], None]] = None,
+        on_sync: Optional[Callable[[Dict[str, Any]], None]] = None,
+        on_conv_list: Optional[Callable[[Dict[str, Any]], None]] = None,
     ):
         self.sock = sock
         # callback nội bộ (không đụng tên method)
@@ -31,6 +41,11 @@ class MessageClient:
         self._cb_seen = on_seen_update or (lambda m: None)
         self._cb_recall = on_recall_update or (lambda m: None)
         self._cb_react = on_react_update or (lambda m: None)
+        self._cb_batch = on_batch_result or (lambda m: None)
+        self._cb_sync = on_sync or (lambda m: None)
+        self._cb_conv_list = on_conv_list or (lambda m: None)
+        # SYNC cursor; None until the first sync (which only fetches the current cursor)
+        self.cursor: Optional[int] = None
 
     # ----------------- senders -----------------
     def send_text(self, to_user_id: int, content: str, reply_to_id: Optional[int] = None):
@@ -68,9 +83,50 @@ class MessageClient:
             "request_id": new_request_id()
         })
 
+    def sync(self):
+        self.sock.send_json({
+            "type": "SYNC",
+            "data": {"since": self.cursor},
+            "request_id": new_request_id()
+        })
+
+    def list_conversations(self, before_id: Optional[int] = None, limit: int = 50):
+        """Hộp thư: hội thoại mới nhất trước, kèm tin cuối và số tin chưa đọc (CONV_LIST_RESULT)."""
+        self.sock.send_json({
+            "type": "CONV_LIST",
+            "data": {"before_id": before_id, "limit": limit},
+            "request_id": new_request_id()
+        })
+
+    # ----------------- batch senders: một frame BATCH, một BATCH_RESULT theo request_id -----------------
+    def send_text_batch(self, messages: Iterable[Tuple]) -> List[str]:
+        """messages: (to_user_id, content) hoặc (to_user_id, content, reply_to_id)."""
+        return self.sock.send_batch([
+            command("MSG_SEND", {"to_user_id": m[0], "content": m[1], "reply_to_id": m[2] if len(m) > 2 else None})
+            for m in messages
+        ])
+
+    def recall_batch(self, message_ids: Iterable[int]) -> List[str]:
+        return self.sock.send_batch([command("MSG_RECALL", {"message_id": mid}) for mid in message_ids])
+
+    def react_batch(self, reactions: Iterable[Tuple[int, str]]) -> List[str]:
+        """reactions: (message_id, reaction)."""
+        return self.sock.send_batch([
+            command("MSG_REACT", {"message_id": mid, "reaction": reaction}) for mid, reaction in reactions
+        ])
+
     # ----------------- handlers cho ProtocolHandler -----------------
+    def advance_cursor(self, data: dict):
+        # pushes can arrive out of order (executor replies, other workers over the bus): a seq past a gap
+        # may not be passed, or the next sync would skip the change in the gap. Not before the first sync
+        seq = data.get("seq")
+        if self.cursor is not None and type(seq) is int and seq == self.cursor + 1:
+            self.cursor = seq
+
     def handle_msg_recv(self, msg: dict):
-        self._cb_recv(msg.get("data") or {})
+        data = msg.get("data") or {}
+        self.advance_cursor(data)
+        self._cb_recv(data)
 
     def handle_history_result(self, msg: dict):
         self._cb_history(msg.get("data") or {})
@@ -79,10 +135,27 @@ class MessageClient:
         self._cb_seen(msg.get("data") or {})
 
     def handle_recall_update(self, msg: dict):
-        self._cb_recall(msg.get("data") or {})
+        data = msg.get("data") or {}
+        self.advance_cursor(data)
+        self._cb_recall(data)
 
     def handle_react_update(self, msg: dict):
-        self._cb_react(msg.get("data") or {})
+        data = msg.get("data") or {}
+        self.advance_cursor(data)
+        self._cb_react(data)
+
+    def handle_batch_result(self, msg: dict):
+        self._cb_batch(msg.get("data") or {})
+
+    def handle_sync_result(self, msg: dict):
+        # each chunk carries the cursor to resume from, so a drop mid-sync loses nothing
+        data = msg.get("data") or {}
+        if data.get("cursor") is not None:
+            self.cursor = data["cursor"]
+        self._cb_sync(data)
+
+    def handle_conv_list_result(self, msg: dict):
+        self._cb_conv_list(msg.get("data") or {})
 
     # ----------------- alias tương thích bản cũ -----------------
     def on_msg_recv(self, msg: dict):
@@ -3,17 +3,24 @@ import socket
 import threading
 import time
 import logging
-from typing import Optional, Callable
+from typing import Optional, Callable, List
 from ..utils import config
-from ..utils.helpers import encode_line, decode_line
+from ..utils.helpers import encode_line, decode_line, new_request_id
+from tools import binproto
+from tools.framing import LengthFramer, LineFramer
 
 logger = logging.getLogger(__name__)
 
 
 class SocketClient:
-    def __init__(self, host: str = None, port: int = None):
+    def __init__(self, host: str = None, port: int = None, wire_format: str = None):
         self.host = host or config.SERVER_HOST
         self.port = port or config.SERVER_PORT
+        self.wire_format = wire_format or config.WIRE_FORMAT
+        self._encode = encode_line
+        self._decode = decode_line
+        self._framer = LineFramer()
+        self._rx_rest = b""  # bytes received right after HELLO_OK
         self._sock: Optional[socket.socket] = None
         self._recv_thread: Optional[threading.Thread] = None
         self._hb_thread: Optional[threading.Thread] = None
@@ -21,10 +28,16 @@ class SocketClient:
         self._connected = threading.Event()
         self._last_pong_ts = 0.0
         self._on_message: Optional[Callable[[dict], None]] = None
+        self._on_reconnect: Optional[Callable[[], None]] = None
+        self._reconnect_lock = threading.Lock()
 
     def set_on_message(self, cb: Callable[[dict], None]):
         self._on_message = cb
 
+    def set_on_reconnect(self, cb: Callable[[], None]):
+        """cb() chạy sau mỗi lần nối lại thành công, vd AuthClient.resume để gửi AUTH_RESUME."""
+        self._on_reconnect = cb
+
     # ---- lifecycle ----
     def start(self):
         self._stop.clear()
@@ -53,6 +66,7 @@ class SocketClient:
             try:
                 s = socket.create_connection((self.host, self.port), timeout=config.CONNECT_TIMEOUT)
                 s.settimeout(None)  # blocking
+                self._use_format(s)
                 self._sock = s
                 self._connected.set()
                 self._last_pong_ts = time.time()
@@ -64,34 +78,53 @@ class SocketClient:
                 time.sleep(backoff)
                 backoff = min(backoff * 2, config.RECONNECT_MAX_BACKOFF)
 
+    def _use_format(self, s: socket.socket):
+        # every connection starts in JSON-lines; HELLO asks the server to switch both directions
+        fmt, rest = "json", b""
+        if self.wire_format != "json":
+            fmt, rest = binproto.negotiate(s, self.wire_format, config.CONNECT_TIMEOUT)
+        if fmt == binproto.FORMAT:
+            self._encode, self._decode, self._framer = binproto.encode_frame, binproto.decode, LengthFramer()
+        else:
+            self._encode, self._decode, self._framer = encode_line, decode_line, LineFramer()
+        self._rx_rest = rest
+        logger.info("Wire format: %s", fmt)
+
     def send_json(self, obj: dict):
-        data = encode_line(obj)
+        data = self._encode(obj)
+        sock = self._sock
         try:
-            if not self._sock:
+            if not sock:
                 raise RuntimeError("Socket not connected")
-            self._sock.sendall(data)
+            sock.sendall(data)
         except Exception as e:
             logger.warning("send_json error: %s; will try reconnect", e)
             self._connected.clear()
-            self._reconnect()
+            self._reconnect(sock)
+
+    def send_batch(self, items: List[dict]) -> List[str]:
+        """
+        Gửi nhiều lệnh trong các frame BATCH (mỗi frame tối đa config.BATCH_MAX lệnh);
+        server trả một BATCH_RESULT cho mỗi frame. Trả về request_id của từng lệnh.
+        """
+        for i in range(0, len(items), config.BATCH_MAX):
+            self.send_json({"type": "BATCH", "data": {"items": items[i:i + config.BATCH_MAX]},
+                            "request_id": new_request_id()})
+        return [it.get("request_id") for it in items]
 
     # ---- loops ----
     def _recv_loop(self):
-        buf = b""
         while not self._stop.is_set():
-            if not self._sock:
+            sock = self._sock
+            if not sock:
                 self._reconnect()
                 continue
             try:
-                chunk = self._sock.recv(4096)
+                chunk, self._rx_rest = self._rx_rest or sock.recv(4096), b""
                 if not chunk:
                     raise ConnectionError("peer closed")
-                buf += chunk
-                while b"\n" in buf:
-                    line, buf = buf.split(b"\n", 1)
-                    if not line:
-                        continue
-                    msg = decode_line(line + b"\n")
+                for frame in self._framer.feed(chunk):
+                    msg = self._decode(frame)
                     if msg.get("type") == "PONG":
                         self._last_pong_ts = time.time()
                     if self._on_message:
@@ -99,7 +132,7 @@ class SocketClient:
             except Exception as e:
                 logger.warning("recv_loop error: %s", e)
                 self._connected.clear()
-                self._reconnect()
+                self._reconnect(sock)
 
     def _heartbeat_loop(self):
         while not self._stop.is_set():
@@ -110,16 +143,23 @@ class SocketClient:
             if time.time() - self._last_pong_ts > config.HEARTBEAT_TIMEOUT:
                 logger.warning("Heartbeat timeout; reconnecting...")
                 self._connected.clear()
-                self._reconnect()
+                self._reconnect(self._sock)
             time.sleep(config.HEARTBEAT_INTERVAL)
 
-    def _reconnect(self):
-        try:
-            if self._sock:
+    def _reconnect(self, failed: Optional[socket.socket] = None):
+        # recv, heartbeat and send may all notice the same broken socket: only the first one reconnects
+        with self._reconnect_lock:
+            if failed is not None and self._sock is not failed:
+                return
+            old, self._sock = self._sock, None
+            if old:
                 try:
-                    self._sock.shutdown(socket.SHUT_RDWR)
+                    old.shutdown(socket.SHUT_RDWR)
                 except Exception:
                     pass
-                self._sock.close()
-        finally:
-            self._sock = None
\ No newline at end of file
+                old.close()
+            if self._stop.is_set():
+                return
+            self._connect()
+        if self._sock is not None and self._on_reconnect:
+            self._on_reconnect()
\ No newline at end of file
@@ -6,3 +6,6 @@ CONNECT_TIMEOUT = 5  # giây
 HEARTBEAT_INTERVAL = 20  # giây
 HEARTBEAT_TIMEOUT = 45  # giây (nếu >45s không nhận PONG => reconnect)
 RECONNECT_MAX_BACKOFF = 15  # giây
+
+BATCH_MAX = 500  # số lệnh tối đa trong một frame BATCH (server: MAX_BATCH)
+WIRE_FORMAT = "json"  # "bin1": bắt tay HELLO để dùng frame nhị phân (tools/binproto.py)
@@ -1,7 +1,8 @@
 
-import json
 import uuid
 
+from tools import codec
+
 ENCODING = "utf-8"
 
 
@@ -9,15 +10,17 @@ def new_request_id() -> str:
     return str(uuid.uuid4())
 
 
+def command(msg_type: str, data: dict) -> dict:
+    """Một lệnh client -> server kèm request_id mới (dùng cho cả lệnh lẻ và phần tử của BATCH)."""
+    return {"type": msg_type, "data": data, "request_id": new_request_id()}
+
+
 def encode_line(obj: dict) -> bytes:
     """
-    Serialize dict -> JSON string + newline, encode to bytes.
+    Serialize dict -> compact UTF-8 JSON + newline (tools/codec.py picks orjson/msgspec/json).
     """
-    s = json.dumps(obj, ensure_ascii=False)
-    if not s.endswith("\n"):
-        s += "\n"
-    return s.encode(ENCODING)
+    return codec.encode_line(obj)
 
 
 def decode_line(line: bytes) -> dict:
-    return json.loads(line.decode(ENCODING).rstrip("\n"))
+    return codec.loads(line)
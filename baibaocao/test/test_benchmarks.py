@@ -0,0 +1,23 @@
+import sys
+
+import pytest
+
+from tools import bench_fanout, bench_msg_lookup
+from tools import server_async as srv
+
+
+@pytest.fixture(autouse=True)
+def fresh_server(monkeypatch):
+    # the benchmarks replace the module state; put it back afterwards
+    monkeypatch.setattr(srv, "STATE", srv.STATE)
+    monkeypatch.setattr(srv, "STORE", srv.STORE)
+    monkeypatch.setattr(srv, "USER_CONNS", {})
+
+
+@pytest.mark.parametrize("bench, size", [(bench_msg_lookup, "200"), (bench_fanout, "3")])
+def test_benchmark_runs_against_route(bench, size, monkeypatch, capsys):
+    # their fake connections must keep up with every attribute route()/fanout() read from a Connection
+    monkeypatch.setattr(sys, "argv", [bench.__file__, size])
+    bench.main()
+    out = capsys.readouterr().out.splitlines()
+    assert len(out) == 2 and out[1].split()[0] == size
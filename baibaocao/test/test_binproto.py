@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+from tools import binproto, codec
+from tools.framing import LengthFramer
+
+SAMPLE = {"type": "GROUP_MSG_RECV", "request_id": "1",
+          "data": {"message_id": 70000, "group_id": 2, "from_user_id": -5, "content": "Xin chào 👋 " * 10,
+                   "created_at": 1729230000.123456, "reply_to_id": None, "recalled": False,
+                   "reactions_summary": {"❤️": 2, "+1": 1}, "ids": list(range(20)), "big": 1 << 40}}
+
+
+def test_roundtrip_and_interning():
+    frame = binproto.encode_frame(SAMPLE)
+    assert int.from_bytes(frame[:4], "big") == len(frame) - 4
+    assert binproto.decode(frame[4:]) == SAMPLE
+    assert len(frame) < len(codec.encode_line(SAMPLE))
+    # unknown types and keys travel as strings
+    odd = {"type": "NEW_THING", "data": {"new_key": [1, {"x": "y"}]}}
+    assert binproto.decode(binproto.encode_frame(odd)[4:]) == odd
+
+
+def test_length_framer_and_bad_frames():
+    frames = b"".join(binproto.encode_frame({"type": "PING", "data": {"i": i}}) for i in range(3))
+    f = LengthFramer()
+    assert f.feed(frames[:7]) == []
+    bodies = f.feed(frames[7:])
+    assert [binproto.decode(b)["data"]["i"] for b in bodies] == [0, 1, 2]
+    assert f.pending() == 0
+    with pytest.raises(ValueError):
+        binproto.decode(b"\x92\x00")
+
+
+def test_out_of_range_ints_and_codes_are_value_errors():
+    for n in (1 << 64, -(1 << 63) - 1):
+        with pytest.raises(ValueError):
+            binproto.encode_frame({"type": "PONG", "data": {"peer_id": n}})
+    edge = {"type": "PONG", "data": {"a": (1 << 64) - 1, "b": -(1 << 63)}}
+    assert binproto.decode(binproto.encode_frame(edge)[4:]) == edge
+    # type / key codes below 0 or past the end of the tables
+    for body in (b"\x92\xff\x80", b"\x92\x7f\x80", b"\x92\x00\x81\xff\x01", b"\x92\x00\x81\x7f\x01"):
+        with pytest.raises(ValueError):
+            binproto.decode(body)
+
+
+def test_unencodable_reply_becomes_an_error():
+    from tools import server_async as srv
+
+    frame = srv.encode_or_error(binproto.encode_frame, {"type": "MSG_HISTORY_RESULT", "data": {"peer_id": 1 << 70}})
+    assert binproto.decode(frame[4:]) == {"type": "ERROR", "data": {"code": "UNENCODABLE", "got": "MSG_HISTORY_RESULT"}}
+
+
+def test_server_hello_switches_to_binary():
+    from tools import server_async as srv
+
+    async def scenario():
+        server = await asyncio.start_server(srv.handle_client, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(codec.encode_line(binproto.hello(["bin1", "json"])))
+        assert codec.loads(await reader.readline()) == {"type": "HELLO_OK", "data": {"format": "bin1"}}
+        writer.write(binproto.encode_frame({"type": "PING", "data": {}, "request_id": "7"}))
+        size = int.from_bytes(await reader.readexactly(4), "big")
+        reply = binproto.decode(await reader.readexactly(size))
+        writer.close()
+        server.close()
+        return reply
+
+    reply = asyncio.run(scenario())
+    assert reply == {"type": "PONG", "data": {}}
@@ -0,0 +1,99 @@
+import asyncio
+import sys
+
+import pytest
+
+from tools import server_async as srv
+from tools.bus import Broker, BusClient
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="the bus runs on a Unix domain socket")
+
+
+class FakeConn:
+    fmt = "json"
+    limiter = None
+
+    def __init__(self):
+        self.sent = []
+
+    def encode(self, obj):
+        return obj
+
+    def push_frame(self, obj, ephemeral=False):
+        self.sent.append(obj)
+        return True
+
+
+async def _until(cond, timeout=2.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not cond():
+        assert loop.time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+async def _workers(path, broker, uids):
+    # one BusClient per worker, each with user uids[i] connected to it
+    got = [[] for _ in uids]
+    buses = [BusClient(path, lambda msg, to, box=box: box.append((msg, to))) for box in got]
+    for bus, uid in zip(buses, uids):
+        await bus.connect()
+        bus.online(uid)
+    await _until(lambda: all(uid in broker.where for uid in uids))
+    return buses, got
+
+
+def test_broker_forwards_only_to_the_worker_holding_the_user(tmp_path):
+    path = str(tmp_path / "bus.sock")
+
+    async def scenario():
+        broker = Broker()
+        server = await broker.serve(path)
+        (a, b), (got_a, got_b) = await _workers(path, broker, [1, 2])
+        msg = {"type": "MSG_RECV", "data": {"content": "hi"}}
+        a.publish(msg, [2, 1, 3])
+        await _until(lambda: got_b)
+        assert got_b == [(msg, [2, 1, 3])] and broker.forwarded == 1
+
+        b.offline(2)
+        await _until(lambda: 2 not in broker.where)
+        a.publish(msg, [2])
+        b.publish({"type": "PING"}, [1])
+        await _until(lambda: got_a)
+        await asyncio.sleep(0.05)  # time for the broker to route a's pub, if it would
+        assert got_a == [({"type": "PING"}, [1])] and len(got_b) == 1 and broker.forwarded == 2
+        for bus in (a, b):
+            await bus.close()
+        server.close()
+
+    asyncio.run(scenario())
+
+
+def test_fanout_reaches_users_on_another_worker(tmp_path, monkeypatch):
+    path = str(tmp_path / "bus.sock")
+
+    async def scenario():
+        broker = Broker()
+        server = await broker.serve(path)
+        (a, b), (_, got_b) = await _workers(path, broker, [1, 2])
+        alice, bob = FakeConn(), FakeConn()
+        payload = {"type": "GROUP_MSG_RECV", "data": {"group_id": 7, "content": "hi"}}
+
+        # worker A: alice is local, bob is only reachable over the bus
+        monkeypatch.setattr(srv, "USER_CONNS", {1: alice})
+        monkeypatch.setattr(srv, "BUS", a)
+        srv.fanout(payload, [1, 2])
+        assert alice.sent == [payload] and a.published == 1
+        await _until(lambda: got_b)
+
+        # worker B: deliver to its own connections without publishing back
+        monkeypatch.setattr(srv, "USER_CONNS", {2: bob})
+        monkeypatch.setattr(srv, "BUS", b)
+        (msg, uids), = got_b
+        srv.deliver_remote(msg, uids)
+        assert bob.sent == [payload] and b.published == 0
+        for bus in (a, b):
+            await bus.close()
+        server.close()
+
+    asyncio.run(scenario())
@@ -1,4 +1,7 @@
 
+import json
+
+from client.features.message_client import MessageClient
 from client.network.socket_client import SocketClient
 
 
@@ -22,3 +25,32 @@ def test_send_json_appends_newline(monkeypatch):
     c._sock = DummySock()
     c.send_json({"type": "PING", "data": {}, "request_id": "t"})
     assert c._sock.sent.endswith(b"\n"), c._sock.sent
+
+
+def test_pushes_advance_sync_cursor():
+    c = SocketClient(host="127.0.0.1", port=65535)
+    c._sock = DummySock()
+    m = MessageClient(c)
+    m.handle_msg_recv({"type": "MSG_RECV", "data": {"message_id": 1, "seq": 5}})
+    assert m.cursor is None  # nothing to resume from before the first sync
+    m.handle_sync_result({"type": "SYNC_RESULT", "data": {"messages": [], "cursor": 7, "has_more": False}})
+    m.handle_react_update({"type": "MSG_REACT_UPDATE", "data": {"message_id": 1, "seq": 8}})
+    m.handle_recall_update({"type": "MSG_RECALL_UPDATE", "data": {"message_id": 1, "seq": 9}})
+    assert m.cursor == 9
+
+
+def test_out_of_order_pushes_do_not_let_sync_skip_a_change():
+    c = SocketClient(host="127.0.0.1", port=65535)
+    c._sock = DummySock()
+    m = MessageClient(c)
+    m.handle_sync_result({"type": "SYNC_RESULT", "data": {"messages": [], "cursor": 7, "has_more": False}})
+    # 8 is still on its way when 9 and 10 arrive
+    m.handle_msg_recv({"type": "MSG_RECV", "data": {"message_id": 3, "seq": 10}})
+    m.handle_react_update({"type": "MSG_REACT_UPDATE", "data": {"message_id": 1, "seq": 9}})
+    assert m.cursor == 7
+    m.handle_recall_update({"type": "MSG_RECALL_UPDATE", "data": {"message_id": 2, "seq": 8}})
+    assert m.cursor == 8
+    m.sync()
+    assert json.loads(c._sock.sent.splitlines()[-1])["data"]["since"] == 8
+    m.handle_sync_result({"type": "SYNC_RESULT", "data": {"messages": [], "cursor": 10, "has_more": False}})
+    assert m.cursor == 10
@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+from tools import codec
+
+SAMPLE = {"type": "GROUP_MSG_RECV", "request_id": "1",
+          "data": {"message_id": 7, "group_id": 2, "from_user_id": 1, "content": "Xin chào 👋 \"quoted\"\n",
+                   "created_at": 1729230000.123456, "reply_to_id": None, "recalled": False,
+                   "reactions_summary": {"❤️": 2, "+1": 1}, "ids": [1, 2, 3]}}
+
+
+def _available():
+    names = []
+    for name in ("orjson", "msgspec", "json"):
+        try:
+            __import__(name)
+            names.append(name)
+        except ImportError:
+            pass
+    return names
+
+
+@pytest.fixture(params=_available())
+def backend(request):
+    before = codec.BACKEND
+    codec.use(request.param)
+    yield request.param
+    codec.use(before)
+
+
+def test_identical_wire_output(backend):
+    expected = json.dumps(SAMPLE, ensure_ascii=False, separators=(",", ":")).encode() + b"\n"
+    assert codec.encode_line(SAMPLE) == expected
+    assert codec.loads(expected) == SAMPLE
+
+
+def test_bad_input_raises_value_error(backend):
+    with pytest.raises(ValueError):
+        codec.loads(b'{"type": ')
+
+
+def test_unknown_backend_is_named(monkeypatch):
+    with pytest.raises(ValueError, match="orjson, msgspec, json"):
+        codec.use("ujson")
+    before = codec.BACKEND
+    monkeypatch.setenv("CHAT_JSON", "ujson")
+    try:
+        with pytest.warns(RuntimeWarning, match="CHAT_JSON"):
+            codec._auto()
+        assert codec.BACKEND in ("orjson", "msgspec", "json")
+    finally:
+        codec.use(before)
@@ -0,0 +1,131 @@
+import asyncio
+
+from tools import binproto
+from tools import server_async as srv
+
+
+class FakeTransport:
+    def __init__(self):
+        self.buffered = 0
+        self.aborted = False
+
+    def get_write_buffer_size(self):
+        return self.buffered
+
+    def abort(self):
+        self.aborted = True
+
+
+class FakeWriter:
+    """StreamWriter giả: ghi lại từng lần writelines; stall=True là client không bao giờ đọc (drain() treo)."""
+
+    def __init__(self, stall=False):
+        self.transport = FakeTransport()
+        self.stall = stall
+        self.writes = []
+        self.drains = 0
+
+    def get_extra_info(self, name):
+        return ("127.0.0.1", 9)
+
+    def writelines(self, frames):
+        frames = list(frames)
+        self.writes.append(frames)
+        self.transport.buffered += sum(map(len, frames))
+
+    async def drain(self):
+        self.drains += 1
+        if self.stall:
+            await asyncio.Event().wait()
+        self.transport.buffered = 0
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+async def _settle():
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+def test_slow_consumer_loses_ephemeral_frames_then_is_disconnected(monkeypatch):
+    monkeypatch.setattr(srv, "OUTBOX_SOFT_LIMIT", 100)
+    monkeypatch.setattr(srv, "OUTBOX_HARD_LIMIT", 280)
+    monkeypatch.setattr(srv, "DRAIN_THRESHOLD", 0)
+    frame = b"x" * 60
+
+    async def scenario():
+        w = FakeWriter(stall=True)
+        conn = srv.Connection(w)
+        assert conn.push_frame(frame)
+        await _settle()  # handed to the transport, the writer now hangs in drain()
+        assert w.writes == [[frame]] and conn.pending == 0
+        assert conn.push_frame(frame) and conn.push_frame(frame)
+        # over the soft limit: ephemeral pushes are dropped, the others still queue
+        assert not conn.push({"type": "MSG_SEEN_UPDATE", "data": {}}) and conn.dropped == 1
+        assert conn.push_frame(frame, ephemeral=True) is False and conn.dropped == 2
+        assert conn.push_frame(frame) and conn.push_frame(frame) and conn.pending == 240
+        assert not w.transport.aborted
+        # over the hard limit: the client is cut off and nothing more is queued
+        assert not conn.push_frame(frame)
+        assert w.transport.aborted and conn.closed and conn.pending == 0 and not conn.outbox
+        assert not conn.push_frame(b"y")
+        await conn.drained()  # does not wait for a closed connection
+        return w
+
+    w = asyncio.run(scenario())
+    assert w.writes == [[frame]]
+
+
+def test_fanout_encodes_once_per_wire_format(monkeypatch):
+    calls = []
+
+    def counting(enc):
+        def wrapped(obj):
+            calls.append(enc)
+            return enc(obj)
+        return wrapped
+
+    async def scenario():
+        conns = {uid: srv.Connection(FakeWriter()) for uid in (1, 2, 3, 4)}
+        conns[3].set_format(binproto.FORMAT)
+        conns[4].set_format(binproto.FORMAT)
+        for c in conns.values():
+            c.encode = counting(c.encode)
+        monkeypatch.setattr(srv, "USER_CONNS", conns)
+        payload = {"type": "GROUP_MSG_RECV", "data": {"group_id": 1, "content": "hi " * 50}}
+        srv.fanout(payload, [1, 2, 3, 4, 99])
+        assert len(calls) == 2  # one json frame, one binary frame
+        assert conns[1].outbox[0] is conns[2].outbox[0]
+        assert conns[3].outbox[0] is conns[4].outbox[0] != conns[1].outbox[0]
+        await _settle()
+        return conns
+
+    conns = asyncio.run(scenario())
+    assert all(len(c.writer.writes) == 1 for c in conns.values())
+
+
+def test_write_loop_coalesces_frames_and_drains_only_over_threshold(monkeypatch):
+    monkeypatch.setattr(srv, "DRAIN_THRESHOLD", 1000)
+
+    async def scenario():
+        w = FakeWriter()
+        conn = srv.Connection(w)
+        frames = [b"%d\n" % i for i in range(5)]
+        for f in frames:
+            conn.push_frame(f)
+        await _settle()
+        assert w.writes == [frames] and w.drains == 0 and conn.pending == 0
+        conn.push_frame(b"a\n")
+        await _settle()
+        assert w.writes[1:] == [[b"a\n"]] and w.drains == 0
+        conn.push_frame(b"x" * 2000)
+        conn.push_frame(b"b\n")
+        await conn.drained()
+        await _settle()
+        assert w.writes[2:] == [[b"x" * 2000, b"b\n"]] and w.drains == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,344 @@
+import asyncio
+import os
+
+import pytest
+
+from tools import codec
+from tools import server_async as srv
+from tools.dispatch import TypeStats
+from tools.tokens import TokenSigner
+
+
+class FakeConn:
+    fmt = "json"
+    limiter = None
+
+    def __init__(self):
+        self.sent = []
+
+    def push(self, obj):
+        self.sent.append(obj)
+        return True
+
+    def encode(self, obj):
+        return obj
+
+    def push_frame(self, obj, ephemeral=False):
+        return self.push(obj)
+
+
+@pytest.fixture(autouse=True)
+def fresh_server(monkeypatch):
+    # every test gets its own users, connections and session secret
+    st = srv.State()
+    monkeypatch.setattr(srv, "STATE", st)
+    monkeypatch.setattr(srv, "STORE", st)
+    monkeypatch.setattr(srv, "USER_CONNS", {})
+    monkeypatch.setattr(srv, "SESSIONS", TokenSigner(os.urandom(32), ttl=srv.SESSIONS.ttl))
+    return st
+
+
+def test_auth_guard_unknown_type_and_timing_hook():
+    conn, session = FakeConn(), {}
+    stats = TypeStats()
+    srv.HANDLERS.timing = stats
+    try:
+        for msg in ({"type": "PING"}, {"type": "GROUP_LIST"}, {"type": ["x"]}):
+            asyncio.run(srv.route(session, conn, msg))
+        session["user_id"] = 1
+        asyncio.run(srv.route(session, conn, {"type": "NOPE"}))
+    finally:
+        srv.HANDLERS.timing = None
+    assert [m["type"] for m in conn.sent] == ["PONG", "ERROR", "ERROR", "ERROR"]
+    assert [m["data"].get("code") for m in conn.sent[1:]] == ["UNAUTH", "UNAUTH", "UNKNOWN_TYPE"]
+    assert list(stats.stats) == ["PING"] and stats.stats["PING"][0] == 1
+    assert "PING" in stats.report()
+
+
+def test_mock_server_routes_with_the_same_arguments():
+    from tools import mock_server
+
+    class FakeSock:
+        def __init__(self):
+            self.sent = []
+
+        def sendall(self, data):
+            self.sent.append(codec.loads(data))
+
+    sock, session = FakeSock(), {}
+    for msg in ({"type": "PING"}, {"type": "GROUP_LIST"}):
+        mock_server._route(session, sock, msg)
+    assert [m["type"] for m in sock.sent] == ["PONG", "ERROR"]
+    # a handler of either server is called as fn(session, conn, data)
+    conn = FakeConn()
+    asyncio.run(srv.HANDLERS.get("PING").fn(session, conn, {}))
+    mock_server._HANDLERS.get("PING").fn(session, sock, {})
+    assert conn.sent[-1] == sock.sent[-1] == {"type": "PONG", "data": {}}
+
+
+class Patched:
+    """A module with some attributes replaced."""
+
+    def __init__(self, module, **attrs):
+        self._module = module
+        self.__dict__.update(attrs)
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+
+def test_rate_limits_reject_or_delay(monkeypatch):
+    from tools.ratelimit import RateLimits
+
+    # virtual clock: it only moves when the server sleeps, so what gets limited or delayed
+    # does not depend on how fast the machine runs the test
+    now = [0.0]
+
+    async def sleep(seconds):
+        now[0] += seconds
+        await asyncio.sleep(0)
+
+    monkeypatch.setattr(srv, "time", Patched(srv.time, monotonic=lambda: now[0]))
+    monkeypatch.setattr(srv, "asyncio", Patched(srv.asyncio, sleep=sleep))
+
+    async def pings(limits, n):
+        monkeypatch.setattr(srv, "LIMITS", limits)
+        conn = FakeConn()
+        conn.limiter = limits.connection(srv.time.monotonic())
+        for _ in range(n):
+            await srv.route({"user_id": 1}, conn, {"type": "PING"})
+        await srv.route({"user_id": 1}, conn, {"type": "BATCH", "data": {"items": [{"type": "PING"}] * 3}})
+        return conn.sent
+
+    limits = RateLimits(None, {"PING": (1.0, 3.0)}, "error", max_inflight=2)
+    sent = asyncio.run(pings(limits, 4))
+    assert [m["type"] for m in sent] == ["PONG"] * 3 + ["ERROR", "BATCH_RESULT"]
+    assert sent[3]["data"]["code"] == "RATE_LIMITED" and sent[3]["data"]["got"] == "PING"
+    # the first two items reach the (empty) PING bucket, the third is over max_inflight
+    results = sent[4]["data"]["results"]
+    assert [r["replies"][0]["data"].get("reason") for r in results] == [None, None, "inflight"]
+    assert results[2]["replies"][0]["data"] == {"code": "RATE_LIMITED", "reason": "inflight", "max": 2,
+                                                "got": "PING", "request_id": None}
+    assert limits.counts["PING"][:2] == [3, 3] and limits.inflight_limited == 1
+
+    limits = RateLimits((50.0, 1.0), action="delay")
+    stats = TypeStats()
+    monkeypatch.setattr(srv.HANDLERS, "timing", stats)
+    sent = asyncio.run(pings(limits, 5))
+    # every delayed command still ran, in order: the PINGs, then the BATCH once its items had run
+    assert [m["type"] for m in sent] == ["PONG"] * 5 + ["BATCH_RESULT"]
+    assert [r["replies"][0]["type"] for r in sent[5]["data"]["results"]] == ["PONG"] * 3
+    assert list(stats.stats) == ["PING", "BATCH"] and stats.stats["PING"][0] == 8 and stats.stats["BATCH"][0] == 1
+    assert limits.counts["PING"][2] == 7  # burst 1, then 50/s: 4 PINGs + 3 items; BATCH counts apart
+    assert now[0] == pytest.approx(0.16)  # 7 PINGs and the BATCH each waited 1/50 s
+    assert "PING" in limits.report()
+
+    monkeypatch.setattr(srv, "HISTORY_MAX", 2)
+    assert srv._history_limit("MSG_HISTORY", {"limit": 10 ** 9}) == 2 and limits.counts["MSG_HISTORY"][4] == 1
+
+
+def test_history_limit_that_is_not_a_number_gets_an_error(monkeypatch):
+    monkeypatch.setattr(srv, "HISTORY_MAX", 3)
+
+    async def scenario():
+        conn, session = FakeConn(), {}
+        await srv.route(session, conn, {"type": "AUTH_REGISTER", "data": {"username": "hist", "password": "p"}})
+        await srv.route(session, conn, {"type": "AUTH_LOGIN", "data": {"username": "hist", "password": "p"}})
+        gid = srv.STATE.create_group(session["user_id"], "g", None)
+        for i in range(5):
+            await srv.route(session, conn, {"type": "GROUP_MSG_SEND", "data": {"group_id": gid, "content": f"m{i}"}})
+        conn.sent.clear()
+        for limit in ("abc", [1], {"n": 1}, "2", -5, 10 ** 9):
+            await srv.route(session, conn, {"type": "GROUP_HISTORY", "data": {"group_id": gid, "limit": limit}})
+        await srv.route(session, conn, {"type": "MSG_HISTORY", "data": {"peer_id": 2, "limit": "x"}})
+        return conn.sent
+
+    sent = asyncio.run(scenario())
+    assert [m["data"]["code"] for m in sent[:3]] == ["BAD_LIMIT"] * 3 and sent[0]["data"]["max"] == 3
+    assert [len(m["data"]["messages"]) for m in sent[3:6]] == [2, 1, 3]
+    assert sent[6] == {"type": "ERROR", "data": {"code": "BAD_LIMIT", "max": 3}}
+
+
+def test_pipelined_commands_over_max_inflight_are_rejected_one_by_one(monkeypatch):
+    from tools.ratelimit import RateLimits
+
+    monkeypatch.setattr(srv, "LIMITS", RateLimits(max_inflight=2))
+
+    async def scenario():
+        server = await asyncio.start_server(srv.handle_client, "127.0.0.1", 0)
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.sockets[0].getsockname()[1])
+        writer.write(b"".join(codec.encode_line({"type": "PING", "request_id": f"p{i}"}) for i in range(4)))
+        replies = [codec.loads(await reader.readline()) for _ in range(4)]
+        writer.close()
+        server.close()
+        return replies
+
+    replies = asyncio.run(scenario())
+    # the rejections do not wait for the PONGs of the commands ahead of them
+    assert sorted(m["type"] for m in replies) == ["ERROR", "ERROR", "PONG", "PONG"]
+    assert [m["data"]["request_id"] for m in replies if m["type"] == "ERROR"] == ["p2", "p3"]
+    assert srv.LIMITS.inflight_limited == 2
+
+
+def test_inflight_counter_does_not_depend_on_how_reads_split(monkeypatch):
+    from tools.dispatch import Handler
+    from tools.ratelimit import RateLimits
+
+    monkeypatch.setattr(srv, "LIMITS", RateLimits(max_inflight=2))
+    seen, release = [], asyncio.Event()
+
+    async def slow_ping(session, conn, data):
+        # a command whose handler is still busy (like one waiting on the executor)
+        seen.append(conn)
+        await release.wait()
+        await srv.send(conn, {"type": "PONG", "data": {"inflight": conn.inflight}})
+
+    monkeypatch.setitem(srv.HANDLERS.handlers, "PING", Handler(slow_ping, False))
+
+    async def until(cond):
+        while not cond():
+            await asyncio.sleep(0.01)
+
+    async def scenario():
+        server = await asyncio.start_server(srv.handle_client, "127.0.0.1", 0)
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.sockets[0].getsockname()[1])
+        ping = lambda rid: codec.encode_line({"type": "PING", "request_id": rid})
+        # one command per write: every read on the server holds a single frame
+        writer.write(ping("p0"))
+        await until(lambda: seen)
+        conn = seen[0]
+        writer.write(ping("p1"))
+        await until(lambda: conn.inflight == 2)
+        writer.write(ping("p2"))
+        rejected = codec.loads(await reader.readline())
+        release.set()
+        pongs = [codec.loads(await reader.readline()) for _ in range(2)]
+        await until(lambda: conn.inflight == 0)
+        writer.write(ping("p3"))  # answered commands no longer count
+        last = codec.loads(await reader.readline())
+        writer.close()
+        server.close()
+        return rejected, pongs, last
+
+    rejected, pongs, last = asyncio.run(scenario())
+    assert rejected["data"]["reason"] == "inflight" and rejected["data"]["request_id"] == "p2"
+    assert [m["data"]["inflight"] for m in pongs] == [2, 1] and last["type"] == "PONG"
+    assert srv.LIMITS.inflight_limited == 1
+
+
+def test_batch_collects_replies_by_request_id():
+    async def scenario():
+        a, b, sa, sb = FakeConn(), FakeConn(), {}, {}
+        for conn, session, name in ((a, sa, "batch_a"), (b, sb, "batch_b")):
+            await srv.route(session, conn, {"type": "AUTH_REGISTER", "data": {"username": name, "password": "p"}})
+            await srv.route(session, conn, {"type": "AUTH_LOGIN", "data": {"username": name, "password": "p"}})
+        await srv.route(sa, a, {"type": "FRIEND_REQUEST", "data": {"to_user_id": sb["user_id"]}})
+        req_id = a.sent[-1]["data"]["request_id"]
+        await srv.route(sb, b, {"type": "FRIEND_ACCEPT", "data": {"request_id": req_id}})
+        a.sent.clear(); b.sent.clear()
+        items = [{"type": "MSG_SEND", "data": {"to_user_id": sb["user_id"], "content": f"m{i}"}, "request_id": f"r{i}"}
+                 for i in range(3)]
+        items += [{"type": "MSG_SEND", "data": {"to_user_id": sb["user_id"]}, "request_id": "bad"},
+                  {"type": "AUTH_LOGIN", "data": {}}]
+        await srv.route(sa, a, {"type": "BATCH", "data": {"items": items}})
+        return a.sent, b.sent
+
+    a_sent, b_sent = asyncio.run(scenario())
+    assert [m["type"] for m in a_sent] == ["BATCH_RESULT"]
+    results = a_sent[0]["data"]["results"]
+    assert [r["request_id"] for r in results] == ["r0", "r1", "r2", "bad", None]
+    assert results[1]["ok"] and results[1]["replies"][0]["data"]["content"] == "m1"
+    assert results[3]["replies"][0]["data"]["code"] == "BAD_MSG" and not results[3]["ok"]
+    assert results[4]["replies"][0]["data"]["code"] == "BAD_BATCH_ITEM"
+    # the recipient still gets ordinary pushes
+    assert [m["data"]["content"] for m in b_sent if m["type"] == "MSG_RECV"] == ["m0", "m1", "m2"]
+
+
+def test_batch_results_keep_every_item_and_reject_duplicate_ids():
+    async def scenario():
+        conn, session = FakeConn(), {}
+        await srv.route(session, conn, {"type": "AUTH_REGISTER", "data": {"username": "batch_ids", "password": "p"}})
+        await srv.route(session, conn, {"type": "AUTH_LOGIN", "data": {"username": "batch_ids", "password": "p"}})
+        conn.sent.clear()
+        # a client id equal to another item's position, and a "0" after an item without an id
+        await srv.route(session, conn, {"type": "BATCH", "data": {"items": [
+            {"type": "GROUP_CREATE", "data": {"name": "g"}, "request_id": "1"}, {"type": "PING"},
+            {"type": "PING", "request_id": "0"}]}})
+        await srv.route(session, conn, {"type": "BATCH", "data": {"items": [
+            {"type": "PING", "request_id": "x"}, {"type": "GROUP_CREATE", "data": {"name": "h"}, "request_id": "x"}]}})
+        return conn.sent
+
+    first, dup = asyncio.run(scenario())
+    results = first["data"]["results"]
+    assert [(r["request_id"], [m["type"] for m in r["replies"]]) for r in results] == \
+        [("1", ["GROUP_CREATED"]), (None, ["PONG"]), ("0", ["PONG"])]
+    assert dup == {"type": "ERROR", "data": {"code": "BAD_BATCH", "reason": "duplicate_request_id",
+                                              "request_id": "x"}}
+
+
+def test_auth_resume_with_session_token():
+    async def scenario():
+        conn, session = FakeConn(), {}
+        await srv.route(session, conn, {"type": "AUTH_REGISTER", "data": {"username": "resume_a", "password": "p"}})
+        await srv.route(session, conn, {"type": "AUTH_LOGIN", "data": {"username": "resume_a", "password": "p"}})
+        token = conn.sent[-1]["data"]["token"]
+        fresh, again = FakeConn(), {}
+        await srv.route(again, fresh, {"type": "AUTH_RESUME", "data": {"token": token}})
+        await srv.route({}, fresh, {"type": "AUTH_RESUME", "data": {"token": token[:-2] + "AA"}})
+        return session, again, fresh.sent
+
+    session, again, sent = asyncio.run(scenario())
+    assert [m["type"] for m in sent] == ["AUTH_OK", "AUTH_FAIL"]
+    assert again["user_id"] == session["user_id"] and sent[0]["data"]["username"] == "resume_a"
+    assert sent[1]["data"]["reason"] == "invalid_token"
+    assert srv.SESSIONS.verify(sent[0]["data"]["token"], now=1e12) is None  # expired
+
+
+def test_auth_resume_rejects_token_of_a_reused_user_id(monkeypatch):
+    # in-memory store restarted with the same CHAT_SESSION_SECRET: the id now belongs to someone else
+    async def scenario():
+        conn = FakeConn()
+        await srv.route({}, conn, {"type": "AUTH_REGISTER", "data": {"username": "old_owner", "password": "p"}})
+        await srv.route({}, conn, {"type": "AUTH_LOGIN", "data": {"username": "old_owner", "password": "p"}})
+        token = conn.sent[-1]["data"]["token"]
+        restarted = srv.State()
+        monkeypatch.setattr(srv, "STATE", restarted)
+        monkeypatch.setattr(srv, "STORE", restarted)
+        while restarted.next_uid <= conn.sent[-1]["data"]["user_id"]:
+            restarted.add_user(f"new_{restarted.next_uid}", srv._hash("q"))
+        session, fresh = {}, FakeConn()
+        await srv.route(session, fresh, {"type": "AUTH_RESUME", "data": {"token": token}})
+        return session, fresh.sent
+
+    session, sent = asyncio.run(scenario())
+    assert sent == [{"type": "AUTH_FAIL", "data": {"reason": "invalid_token"}}] and "user_id" not in session
+
+
+def test_sync_streams_chunks_with_cursor(monkeypatch):
+    async def drained():
+        pass
+
+    async def scenario():
+        a, b, sa, sb = FakeConn(), FakeConn(), {}, {}
+        b.drained = drained
+        for conn, session, name in ((a, sa, "sync_a"), (b, sb, "sync_b")):
+            await srv.route(session, conn, {"type": "AUTH_REGISTER", "data": {"username": name, "password": "p"}})
+            await srv.route(session, conn, {"type": "AUTH_LOGIN", "data": {"username": name, "password": "p"}})
+        await srv.route(sa, a, {"type": "FRIEND_REQUEST", "data": {"to_user_id": sb["user_id"]}})
+        await srv.route(sb, b, {"type": "FRIEND_ACCEPT", "data": {"request_id": a.sent[-1]["data"]["request_id"]}})
+        await srv.route(sb, b, {"type": "SYNC", "data": {}})
+        start = b.sent[-1]["data"]["cursor"]
+        for i in range(5):
+            await srv.route(sa, a, {"type": "MSG_SEND", "data": {"to_user_id": sb["user_id"], "content": f"m{i}"}})
+        b.sent.clear()
+        await srv.route(sb, b, {"type": "SYNC", "data": {"since": start}})
+        await srv.route(sb, b, {"type": "SYNC", "data": {"since": "x"}})
+        return b.sent
+
+    monkeypatch.setattr(srv, "SYNC_CHUNK", 2)
+    sent = asyncio.run(scenario())
+    chunks = [m["data"] for m in sent if m["type"] == "SYNC_RESULT"]
+    assert [[x["content"] for x in c["messages"]] for c in chunks] == [["m0", "m1"], ["m2", "m3"], ["m4"]]
+    assert [c["has_more"] for c in chunks] == [True, True, False]
+    assert chunks[0]["cursor"] < chunks[1]["cursor"] < chunks[2]["cursor"]
+    assert sent[-1]["data"]["code"] == "BAD_SYNC"
@@ -0,0 +1,26 @@
+import pytest
+
+from tools.framing import FrameTooLarge, LineFramer
+
+
+def test_frames_split_across_reads():
+    f = LineFramer()
+    assert f.feed(b'{"a":1}\n\n{"b"') == [b'{"a":1}']
+    assert f.pending() == 4
+    assert f.feed(b':2}\n{"c":3}\n{') == [b'{"b":2}', b'{"c":3}']
+    assert f.feed(b"}\n") == [b"{}"]
+    assert f.pending() == 0
+
+
+def test_many_small_frames_in_one_read():
+    data = b"".join(b'{"i":%d}\n' % i for i in range(10_000))
+    assert len(LineFramer().feed(data)) == 10_000
+
+
+def test_oversized_frame_is_rejected():
+    f = LineFramer(max_frame=16)
+    assert f.feed(b"x" * 16 + b"\n") == [b"x" * 16]
+    with pytest.raises(FrameTooLarge):
+        f.feed(b"y" * 17 + b"\n")
+    with pytest.raises(FrameTooLarge):
+        LineFramer(max_frame=16).feed(b"z" * 10 + b"z" * 10)
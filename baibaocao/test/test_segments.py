@@ -0,0 +1,71 @@
+from tools.records import Message
+from tools.segments import SegmentDir
+from tools.server_async import State
+
+
+def _fill(st: State, n: int) -> None:
+    for i in range(n):
+        st.add_message(Message(1 + (i & 1), f"m{i}", float(i), to_user_id=2 - (i & 1)))
+        st.add_message(Message(1, f"g{i}", float(i), group_id=1))
+
+
+def test_history_pages_span_hot_and_cold(tmp_path):
+    plain, tiered = State(), State(SegmentDir(str(tmp_path)), hot_messages=4)
+    _fill(plain, 30)
+    _fill(tiered, 30)
+    key = State.dm_key(1, 2)
+    assert len(tiered.conversations[key]) < 8 and tiered.cold[key]
+    for before_id in (None, 59, 41, 17, 3, 1):
+        for limit in (1, 5, 30):
+            got = tiered.history_page(key, before_id, limit)
+            want = plain.history_page(key, before_id, limit)
+            assert [m.id for m in got[0]] == [m.id for m in want[0]] and got[1] == want[1]
+    assert [m.content for m in tiered.history_page(key, None, 30)[0]] == [f"m{i}" for i in range(30)]
+
+
+def test_lookups_do_not_pin_cold_messages(tmp_path, monkeypatch):
+    st = State(SegmentDir(str(tmp_path)), hot_messages=4)
+    for uid in (1, 2, 3):
+        st.add_user(f"u{uid}", "x")
+    _fill(st, 30)
+    cold = [i + 1 for i, slot in enumerate(st.messages) if type(slot) is int]
+    assert len(st.get_messages(cold)) == len(cold)
+    assert all(type(st.messages[mid - 1]) is int for mid in cold)
+    # a stranger's MSG_SEEN never reaches the segment files
+    monkeypatch.setattr(st.segments, "get", lambda *a: (_ for _ in ()).throw(AssertionError("segment read")))
+    assert st.visible_messages(cold, 3) == []
+    monkeypatch.undo()
+    assert {m.id for m in st.visible_messages(cold, 2)} == {m for m in cold if st.get_message(m).group_id is None}
+
+
+def test_cold_mutations_survive_snapshot(tmp_path):
+    st = State(SegmentDir(str(tmp_path)), hot_messages=4)
+    _fill(st, 20)
+    rec = st.get_message(1)
+    assert rec.content == "m0" and type(st.messages[0]) is int  # a plain read leaves it cold
+    st.toggle_reaction(rec, "+1", 2)
+    assert st.messages[0] is rec and st.get_message(1) is rec  # a mutation keeps it in RAM
+    st.toggle_reaction(st.get_message(1), "ok", 1)
+    st.recall_message(st.get_message(3))
+
+    back = State(SegmentDir(str(tmp_path)), hot_messages=4)
+    back.restore(st.snapshot())
+    page = back.history_page(State.dm_key(1, 2), None, 20)[0]
+    assert page[0].reactions_summary() == {"+1": 1, "ok": 1}
+    assert page[1].recalled and page[1].content == ""
+    assert back.snapshot() == st.snapshot()
+
+
+def test_unread_counts_match_across_tiers(tmp_path):
+    plain, tiered = State(), State(SegmentDir(str(tmp_path)), hot_messages=4)
+    _fill(plain, 30)
+    _fill(tiered, 30)
+    # watermarks stopping below, on and above each user's own last message, through cold segments
+    for st in (plain, tiered):
+        for uid, mid in ((2, 7), (1, 9), (2, 40), (1, 41), (2, 59), (1, 60)):
+            st.mark_seen([st.get_message(mid)], uid)
+    for uid in (1, 2):
+        want = sum(1 for i, m in enumerate(plain.messages) if m.from_user_id != uid and m.group_id is None
+                   and i + 1 > plain.reads[uid][State.dm_key(1, 2)][2])
+        assert [e["unread"] for e in tiered.inbox_page(uid, None, 10)[0] if "peer_id" in e] == [want]
+    assert tiered.reads == plain.reads
@@ -0,0 +1,82 @@
+from tools.records import Message
+from tools.server_async import State
+
+
+def _msg(frm, to):
+    return Message(frm, "hi", 0.0, to_user_id=to)
+
+
+def test_message_index_lookup():
+    st = State()
+    recs = [st.add_message(_msg(1, 2)) for _ in range(5)]
+    assert [r.id for r in recs] == [1, 2, 3, 4, 5]
+    assert st.get_message(3) is recs[2]
+    assert st.get_message(0) is None
+    assert st.get_message(6) is None
+    assert st.get_message("3") is None
+    assert st.get_message(True) is None
+
+
+def test_history_page_uses_conversation_index():
+    st = State()
+    for i in range(10):
+        st.add_message(_msg(1, 2) if i % 2 else _msg(2, 1))
+        st.add_message(_msg(1, 3))
+    key = State.dm_key(2, 1)
+    page, more = st.history_page(key, None, 3)
+    assert [m.id for m in page] == [15, 17, 19] and more
+    page, more = st.history_page(key, 15, 3)
+    assert [m.id for m in page] == [9, 11, 13] and more
+    page, more = st.history_page(key, 5, 3)
+    assert [m.id for m in page] == [1, 3] and not more
+    assert st.history_page(State.group_key(1), None, 3) == ([], False)
+
+
+def test_user_directory():
+    st = State()
+    a = st.add_user("alice", "h1")
+    b = st.add_user("bob", "h2")
+    assert (a["user_id"], b["user_id"]) == (1, 2)
+    assert st.username_of(2) == "bob"
+    assert st.username_of(9) == "user_9"
+    assert st.user_exists(1) and not st.user_exists(9)
+    assert st.users["alice"] is st.users_by_id[1]
+
+
+def test_friend_request_indexes():
+    st = State()
+    r1 = st.add_friend_request(1, 2)
+    r2 = st.add_friend_request(3, 2)
+    assert [r["id"] for r in st.pending_in(2)] == [r1["id"], r2["id"]]
+    assert st.pending_out(1) == [r1]
+    st.resolve_friend_request(r1, "accepted")
+    assert st.pending_in(2) == [r2] and st.pending_out(1) == []
+    assert r1["id"] not in st.friend_requests
+    assert st.friend_requests_done[r1["id"]]["status"] == "accepted"
+
+
+def test_user_groups_index():
+    st = State()
+    g1 = st.create_group(1, "a", None)
+    g2 = st.create_group(2, "b", None)
+    st.add_group_member(g1, 2)
+    assert st.groups_of(2) == [{"group_id": g1, "name": "a", "member_count": 2},
+                               {"group_id": g2, "name": "b", "member_count": 1}]
+    assert st.groups_of(1) == [{"group_id": g1, "name": "a", "member_count": 2}]
+    assert st.groups_of(3) == []
+
+
+def test_message_containers_are_lazy():
+    m = _msg(1, 2)
+    assert m.reactions is None and m.reactions_summary() == {}
+    assert not hasattr(m, "seen_by")  # read state is a per-conversation watermark in the store
+    assert m.toggle_reaction("+1", 2) == "add"
+    assert m.toggle_reaction("+1", 3) == "add"
+    assert m.toggle_reaction("+1", 2) == "remove"
+    before = m.reactions_summary()
+    assert before == {"+1": 1} and m.reactions["+1"].tolist() == [3]
+    assert m.toggle_reaction("+1", 3) == "remove" and m.toggle_reaction("ok", 1) == "add"
+    assert m.reactions_summary() == {"ok": 1} and before == {"+1": 1}  # counts replaced, not mutated
+    m.load_reactions(m.reactions_rows())
+    assert m.reactions_summary() == {"ok": 1}
+    assert m.other_party(1) == 2 and m.other_party(2) == 1
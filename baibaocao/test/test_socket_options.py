@@ -0,0 +1,66 @@
+import asyncio
+import socket
+import sys
+
+import pytest
+
+from tools import codec
+from tools import server_async as srv
+from tools.tokens import TokenSigner
+
+
+@pytest.fixture(autouse=True)
+def restore_globals(monkeypatch):
+    # main() configures the module from its arguments
+    for name in ("STATE", "STORE", "SOCKET_OPTS", "LISTEN_OPTS", "LIMITS", "HISTORY_MAX", "MAX_FRAME",
+                 "OUTBOX_SOFT_LIMIT", "OUTBOX_HARD_LIMIT"):
+        monkeypatch.setattr(srv, name, getattr(srv, name))
+    monkeypatch.setattr(srv, "SESSIONS", TokenSigner(b"k" * 32, ttl=60))
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Linux/macOS socket semantics")
+def test_backlog_and_socket_options_reach_the_sockets(monkeypatch):
+    started, accepted = [], []
+    real_start, real_handle = asyncio.start_server, srv.handle_client
+
+    async def start_server(*args, **kw):
+        server = await real_start(*args, **kw)
+        started.append((server, kw))
+        return server
+
+    async def handle_client(reader, writer):
+        accepted.append(writer.get_extra_info("socket"))
+        await real_handle(reader, writer)
+
+    monkeypatch.setattr(asyncio, "start_server", start_server)
+    monkeypatch.setattr(srv, "handle_client", handle_client)
+    sndbuf, rcvbuf = 96 * 1024, 48 * 1024
+
+    def buffer_size(sock, opt, asked):
+        # Linux reports twice the requested size (bookkeeping overhead), others the size itself
+        return sock.getsockopt(socket.SOL_SOCKET, opt) in (asked, 2 * asked)
+
+    async def scenario():
+        task = asyncio.create_task(srv.main(
+            ["--host", "127.0.0.1", "--port", "0", "--hot-messages", "0", "--backlog", "7", "--read-limit", "4096",
+             "--no-nodelay", "--sndbuf", str(sndbuf), "--rcvbuf", str(rcvbuf)]))
+        while not started:
+            await asyncio.sleep(0.01)
+        server, kw = started[0]
+        listening = server.sockets[0]
+        reader, writer = await asyncio.open_connection(*listening.getsockname()[:2])
+        writer.write(codec.encode_line({"type": "PING"}))
+        assert codec.loads(await reader.readline())["type"] == "PONG"
+        try:
+            assert kw["backlog"] == 7 and kw["limit"] == 4096  # listen() backlog has no getsockopt
+            assert listening.getsockopt(socket.SOL_SOCKET, socket.SO_ACCEPTCONN)
+            for sock in (listening, accepted[0]):
+                assert buffer_size(sock, socket.SO_SNDBUF, sndbuf) and buffer_size(sock, socket.SO_RCVBUF, rcvbuf)
+            assert accepted[0].getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY) == 0
+        finally:
+            writer.close()
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+    asyncio.run(scenario())
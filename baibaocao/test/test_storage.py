@@ -0,0 +1,156 @@
+import pytest
+
+from tools.records import Message
+from tools.server_async import CHANGES_COMPACT_MIN, State
+from tools.storage import SQLiteStore
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    return State() if request.param == "memory" else SQLiteStore(str(tmp_path / "chat.db"))
+
+
+def test_users_and_friends(store):
+    a = store.add_user("alice", "h1")["user_id"]
+    b = store.add_user("bob", "h2")["user_id"]
+    assert store.add_user("alice", "x") is None
+    assert store.get_user("alice")["password_hash"] == "h1"
+    assert store.user_exists(b) and not store.user_exists(99)
+    store.accept_friend_request(store.add_friend_request(a, b))
+    req = store.add_friend_request(b, a)
+    assert store.are_friends(a, b)
+    assert store.get_friend_request(req["id"])["from_user_id"] == b
+    assert store.friend_list(a) == {
+        "friends": [{"user_id": b, "username": "bob", "status": "accepted"}],
+        "pending_in": [{"request_id": req["id"], "from_user_id": b, "from_username": "bob"}],
+        "pending_out": []}
+    store.remove_friendship(a, b)
+    assert not store.are_friends(a, b)
+    store.block(a, b)
+    assert store.is_blocked(a, b) and not store.is_blocked(b, a)
+    store.unblock(a, b)
+    assert not store.is_blocked(a, b)
+
+
+def test_groups_and_messages(store):
+    a = store.add_user("alice", "h1")["user_id"]
+    b = store.add_user("bob", "h2")["user_id"]
+    gid = store.create_group(a, "g", None)
+    store.add_group_member(gid, b)
+    assert store.get_group(gid)["owner_id"] == a and store.get_group("x") is None
+    assert store.members_of(gid) == {a, b} and store.is_member(gid, b)
+    assert store.groups_of(b) == [{"group_id": gid, "name": "g", "member_count": 2}]
+
+    ids = [store.add_message(Message(a, f"m{i}", float(i), to_user_id=b)).id for i in range(5)]
+    g = store.add_message(Message(b, "hi", 9.0, group_id=gid))
+    assert store.toggle_reaction(g, "+1", a) == ("add", {"+1": 1})
+    assert store.toggle_reaction(g, "+1", a) == ("remove", {})
+    assert store.toggle_reaction(g, "+1", a) == ("add", {"+1": 1})
+    assert store.toggle_reaction(store.get_message(ids[2]), "+1", b)[0] == "add"
+    store.recall_message(store.get_message(ids[0]))
+    store.mark_seen(store.get_messages([ids[1], "x", 999]), b)
+
+    page, more = store.history_page(State.dm_key(b, a), ids[3], 2)
+    assert [m.id for m in page] == ids[1:3] and more
+    assert page[1].reactions_summary() == {"+1": 1}
+    page, more = store.history_page(State.dm_key(a, b), None, 10)
+    assert [m.id for m in page] == ids and not more
+    assert page[0].recalled and page[0].content == ""
+    assert [m.id for m in store.history_page(State.group_key(gid), None, 10)[0]] == [g.id]
+    c = store.add_user("carol", "h3")["user_id"]
+    assert [m.id for m in store.visible_messages([g.id, ids[1], "x", 999], b)] == [g.id, ids[1]]
+    assert store.visible_messages([g.id, ids[1]], c) == []
+
+
+def test_sync_page_returns_changes_after_cursor(store):
+    a = store.add_user("alice", "h1")["user_id"]
+    b = store.add_user("bob", "h2")["user_id"]
+    c = store.add_user("carol", "h3")["user_id"]
+    gid = store.create_group(a, "g", None)
+    store.add_group_member(gid, b)
+    _, start, _ = store.sync_page(b, None, 10)
+    ids = [store.add_message(Message(a, f"m{i}", float(i), to_user_id=b)).id for i in range(3)]
+    g = store.add_message(Message(a, "hi", 9.0, group_id=gid))
+    store.add_message(Message(a, "not for bob", 9.0, to_user_id=c))
+    page, cursor, more = store.sync_page(b, start, 2)
+    assert [m.id for m in page] == ids[:2] and more
+    page, cursor, more = store.sync_page(b, cursor, 10)
+    assert [m.id for m in page] == [ids[2], g.id] and not more
+    assert sorted(store.conversations_of(b)) == sorted([("group", gid), ("dm", a, b)])
+
+    store.recall_message(store.get_message(ids[0]))
+    store.toggle_reaction(store.get_message(g.id), "+1", b)
+    store.toggle_reaction(store.get_message(g.id), "+1", a)
+    page, after, more = store.sync_page(b, cursor, 10)
+    assert [m.id for m in page] == [ids[0], g.id] and not more
+    assert page[0].recalled and page[1].reactions_summary() == {"+1": 2}
+    assert store.sync_page(b, after, 10) == ([], after, False)
+    assert store.sync_page(c, start, 10)[0][0].content == "not for bob"
+
+
+def test_change_log_keeps_latest_seq_per_message(store):
+    a = store.add_user("alice", "h1")["user_id"]
+    b = store.add_user("bob", "h2")["user_id"]
+    gid = store.create_group(a, "g", None)
+    store.add_group_member(gid, b)
+    g = store.add_message(Message(a, "hi", 1.0, group_id=gid))
+    seqs = [g.seq]
+    for _ in range(300):
+        store.toggle_reaction(g, "+1", b)
+        seqs.append(g.seq)
+    assert seqs == sorted(set(seqs))
+    page, cursor, more = store.sync_page(b, seqs[-2], 10)
+    assert [m.id for m in page] == [g.id] and cursor == seqs[-1] and not more
+    assert store.sync_page(b, seqs[0] - 1, 10)[0][0].reactions_summary() == {}
+    if isinstance(store, State):
+        rows = len(store.changes[State.group_key(gid)][0])
+    else:
+        rows = store._conn().execute("SELECT COUNT(*) FROM changes").fetchone()[0]
+    assert rows <= CHANGES_COMPACT_MIN
+
+
+def test_inbox_page_tracks_last_message_and_unread(store):
+    a = store.add_user("alice", "h1")["user_id"]
+    b = store.add_user("bob", "h2")["user_id"]
+    c = store.add_user("carol", "h3")["user_id"]
+    gid = store.create_group(a, "g", None)
+    store.add_group_member(gid, b)
+    dm = [store.add_message(Message(a, f"m{i}", float(i), to_user_id=b)) for i in range(3)]
+    store.add_message(Message(b, "hi " * 100, 5.0, group_id=gid))
+    store.add_group_member(gid, c)  # joins with the existing history already read
+    g2 = store.add_message(Message(a, "ok", 6.0, group_id=gid))
+    store.mark_seen(dm[:2], b)
+    store.mark_seen(dm[:2], b)  # seeing twice counts once
+
+    page, more = store.inbox_page(b, None, 10)
+    assert [(e.get("group_id"), e.get("peer_id"), e["unread"]) for e in page] == [(gid, None, 1), (None, a, 1)]
+    assert page[0]["name"] == "g" and page[1]["username"] == "alice"
+    assert page[0]["last_message"]["message_id"] == g2.id and page[1]["last_message"]["content"] == "m2"
+    assert [e["unread"] for e in store.inbox_page(a, None, 10)[0]] == [1, 0]
+    assert [e["unread"] for e in store.inbox_page(c, None, 10)[0]] == [1]
+
+    page, more = store.inbox_page(b, None, 1)
+    assert len(page) == 1 and more
+    page, more = store.inbox_page(b, page[0]["last_message"]["message_id"], 1)
+    assert page[0]["peer_id"] == a and not more
+    store.recall_message(store.get_message(dm[2].id))
+    assert store.inbox_page(b, None, 10)[0][1]["last_message"]["recalled"]
+
+
+def test_read_watermarks(store):
+    a = store.add_user("alice", "h1")["user_id"]
+    b = store.add_user("bob", "h2")["user_id"]
+    c = store.add_user("carol", "h3")["user_id"]
+    gid = store.create_group(a, "g", None)
+    store.add_group_member(gid, b)
+    ms = [store.add_message(Message(a if i % 2 else b, f"m{i}", float(i), group_id=gid)) for i in range(6)]
+    assert store.read_marks(("group", gid)) == {}
+    store.mark_seen([ms[3], ms[1]], b)
+    store.mark_seen([ms[2]], b)  # never moves back
+    store.add_group_member(gid, c)
+    assert store.read_marks(("group", gid)) == {b: ms[3].id, c: ms[5].id}
+    # bob sent m0, m2, m4: of alice's m1, m3, m5 two are read
+    assert [e["unread"] for e in store.inbox_page(b, None, 10)[0]] == [1]
+    assert [e["unread"] for e in store.inbox_page(c, None, 10)[0]] == [0]
+    store.mark_seen([ms[5]], a)
+    assert [e["unread"] for e in store.inbox_page(a, None, 10)[0]] == [0]
@@ -0,0 +1,105 @@
+from tools.records import Message
+from tools.server_async import State
+from tools.wal import WriteAheadLog
+
+
+def _populate(st: State) -> None:
+    st.add_user("alice", "h1")
+    st.add_user("bob", "h2")
+    st.accept_friend_request(st.add_friend_request(1, 2))
+    st.add_friend_request(2, 1)
+    st.block(1, 2)
+    gid = st.create_group(1, "g", None)
+    st.add_group_member(gid, 2)
+    m1 = st.add_message(Message(1, "hi", 1.0, to_user_id=2))
+    m2 = st.add_message(Message(2, "yo", 2.0, group_id=gid, reply_to_id=1))
+    st.mark_seen([m1, m2], 2)
+    st.toggle_reaction(m2, "+1", 1)
+    st.recall_message(m1)
+
+
+def _recover(path) -> State:
+    wal = WriteAheadLog(str(path))
+    st = State()
+    snap, records = wal.recover()
+    if snap is not None:
+        st.restore(snap)
+    for r in records:
+        st.apply(r)
+    return st
+
+
+def _same(a: State, b: State) -> None:
+    assert a.snapshot() == b.snapshot()
+    assert a.pending_in(1) == b.pending_in(1)
+    assert a.groups_of(2) == b.groups_of(2)
+    assert sorted(a.conversations_of(1)) == sorted(b.conversations_of(1))
+    assert a.sync_page(2, 0, 10)[1:] == b.sync_page(2, 0, 10)[1:]
+    assert a.inbox_page(2, None, 10) == b.inbox_page(2, None, 10)
+    assert [m.id for m in a.history_page(State.dm_key(1, 2), None, 10)[0]] == \
+           [m.id for m in b.history_page(State.dm_key(1, 2), None, 10)[0]]
+
+
+def test_replay_from_log(tmp_path):
+    wal = WriteAheadLog(str(tmp_path))
+    wal.recover()
+    wal.start()
+    st = State()
+    st.journal = wal.append
+    _populate(st)
+    wal.close()
+    assert wal.durable_lsn == wal.lsn
+    _same(st, _recover(tmp_path))
+
+
+def test_snapshot_compacts_log(tmp_path):
+    wal = WriteAheadLog(str(tmp_path), commit_interval=0, snapshot_every=4)
+    wal.recover()
+    st = State()
+    wal.start(st.capture)
+    st.journal = wal.append
+    _populate(st)
+    wal.close()
+    assert wal.snapshots >= 1
+    assert len(list(tmp_path.glob("wal-*.log"))) <= 2
+    _same(st, _recover(tmp_path))
+
+
+def test_capture_is_not_affected_by_later_changes():
+    st = State()
+    _populate(st)
+    before = st.snapshot()
+    build = st.capture()
+    st.toggle_reaction(st.get_message(2), "+1", 2)
+    st.recall_message(st.get_message(2))
+    st.add_message(Message(1, "later", 3.0, to_user_id=2))
+    st.mark_seen([st.get_message(3)], 2)
+    st.accept_friend_request(st.get_friend_request(2))
+    st.add_group_member(1, 3)
+    assert build() == before
+    assert st.get_message(2).recalled and st.history_page(State.group_key(1), None, 10)[0][0].recalled
+
+
+def test_recall_after_capture_keeps_the_snapshot_content():
+    st = State()
+    _populate(st)
+    build = st.capture()
+    rec = st.get_message(2)
+    st.recall_message(rec)
+    assert rec.content == "yo" and not rec.recalled  # the record the capture holds
+    snap = build()
+    assert [m[4] for m in snap["messages"]] == ["", "yo"] and [m[7] for m in snap["messages"]] == [True, False]
+    assert st.get_message(2).recalled and st.get_message(2).content == ""
+
+
+def test_torn_tail_is_ignored(tmp_path):
+    wal = WriteAheadLog(str(tmp_path))
+    wal.recover()
+    wal.start()
+    st = State()
+    st.journal = wal.append
+    st.add_user("alice", "h1")
+    wal.close()
+    with open(next(tmp_path.glob("wal-*.log")), "ab") as f:
+        f.write(b'{"op":"user","username":"bo')
+    assert list(_recover(tmp_path).users) == ["alice"]
@@ -0,0 +1,122 @@
+# tools/bench_admission.py
+# Một client xấu dồn GROUP_HISTORY với limit rất lớn (không chờ trả lời) trong khi một client bình thường
+# PING đều đặn; đo độ trễ PING của client bình thường với các cấu hình giới hạn của server_async:
+#  1) không giới hạn gì (như trước đây);
+#  2) chỉ chặn limit (--max-history);
+#  3) + token bucket theo kết nối / theo type, trả ERROR RATE_LIMITED;
+#  4) như 3 nhưng --limit-action delay (giữ lệnh lại, ngừng đọc socket của client xấu).
+# Chạy: python tools/bench_admission.py [số_tin_trong_nhóm] [giây_mỗi_cấu_hình] [port]
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.bench_burst import ROOT, Client, connect
+from tools.bench_sync import login
+
+CONFIGS = [
+    ("no limits", ["--max-history", str(10 ** 9)]),
+    ("max-history 200", []),
+    ("+ buckets, error", ["--rate-limit", "200:400", "--type-limit", "GROUP_HISTORY=20:20", "--max-inflight", "64"]),
+    ("+ buckets, delay", ["--rate-limit", "200:400", "--type-limit", "GROUP_HISTORY=20:20", "--max-inflight", "64",
+                          "--limit-action", "delay"]),
+]
+
+
+async def fill(port: int, n: int) -> int:
+    # one message at a time, waiting out RATE_LIMITED, so every config starts from the same group
+    c = await connect(port, "abuser")
+    c.send("GROUP_CREATE", name="big")
+    gid = (await c.until("GROUP_CREATED"))["data"]["group_id"]
+    i = 0
+    while i < n:
+        c.send("GROUP_MSG_SEND", group_id=gid, content=f"message {i} " + "x" * 80)
+        msg = json.loads(await c.reader.readline())
+        while msg["type"] not in ("GROUP_MSG_RECV", "ERROR"):
+            msg = json.loads(await c.reader.readline())
+        if msg["type"] == "ERROR":
+            await asyncio.sleep(msg["data"].get("retry_after", 0.01))
+        else:
+            i += 1
+    c.writer.close()
+    return gid
+
+
+async def abuse(port: int, gid: int, stop: asyncio.Event) -> tuple[int, int]:
+    # pipelines GROUP_HISTORY without waiting; logs in again whenever the server drops it
+    replies = reconnects = 0
+
+    async def read_all(c: Client) -> None:
+        nonlocal replies
+        while await c.reader.readline():
+            replies += 1
+
+    while not stop.is_set():
+        bad = await login(port, "abuser")
+        reader = asyncio.create_task(read_all(bad))
+        try:
+            while not stop.is_set() and not bad.writer.transport.is_closing():
+                for _ in range(50):
+                    bad.send("GROUP_HISTORY", group_id=gid, limit=10 ** 9)
+                try:
+                    # with --limit-action delay the server stops reading: the socket stays full
+                    await asyncio.wait_for(bad.writer.drain(), 0.5)
+                except asyncio.TimeoutError:
+                    pass
+        except ConnectionError:
+            pass
+        reader.cancel()
+        bad.writer.close()
+        reconnects += not stop.is_set()
+    return replies, reconnects
+
+
+async def run(port: int, n: int, seconds: float) -> None:
+    good = await connect(port, "pinger")
+    stop = asyncio.Event()
+    gid = await fill(port, n)
+    abuser = asyncio.create_task(abuse(port, gid, stop))
+    await asyncio.sleep(0.5)
+    lat = []
+    t_end = time.perf_counter() + seconds
+    while time.perf_counter() < t_end:
+        t0 = time.perf_counter()
+        good.send("PING")
+        await good.until("PONG")
+        lat.append(time.perf_counter() - t0)
+        await asyncio.sleep(0.01)
+    stop.set()
+    replies, reconnects = await abuser
+    lat.sort()
+    p = lambda q: lat[min(len(lat) - 1, int(q * len(lat)))] * 1000
+    print(f"  PING p50 {p(0.5):.1f} ms, p99 {p(0.99):.1f} ms, max {lat[-1] * 1000:.1f} ms ({len(lat)} pings); "
+          f"abuser: {replies} replies, dropped {reconnects} times")
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 3.0
+    port = int(sys.argv[3]) if len(sys.argv) > 3 else 5597
+    print(f"group of {n} messages, GROUP_HISTORY flood with limit=10**9, {seconds:.0f}s per config")
+    for name, extra in CONFIGS:
+        server = subprocess.Popen([sys.executable, os.path.join(ROOT, "tools", "server_async.py"),
+                                   "--port", str(port), "--hot-messages", "0", *extra],
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        try:
+            time.sleep(1.0)
+            print(name)
+            asyncio.run(run(port, n, seconds))
+        finally:
+            server.terminate()
+            out = server.communicate()[0]
+        stats = [line for line in out.splitlines() if line.startswith(("GROUP_HISTORY ", "over max_inflight"))]
+        for line in stats:
+            print("  server:", line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# tools/bench_burst.py
+# Thông lượng server_async khi chat nhóm dồn dập: một người gửi liên tục GROUP_MSG_SEND,
+# đo thời gian tới khi mọi thành viên nhận đủ và CPU server tiêu tốn (Linux: /proc).
+# Chạy: python tools/bench_burst.py [số_thành_viên] [số_tin] [port]
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def server_cpu(pid: int) -> float | None:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class Client:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader, self.writer = reader, writer
+
+    def send(self, typ: str, **data) -> None:
+        self.writer.write((json.dumps({"type": typ, "data": data}) + "\n").encode())
+
+    async def until(self, typ: str) -> dict:
+        while True:
+            msg = json.loads(await self.reader.readline())
+            if msg["type"] == typ:
+                return msg
+
+
+async def connect(port: int, name: str) -> Client:
+    c = Client(*await asyncio.open_connection("127.0.0.1", port, limit=1 << 20))
+    c.send("AUTH_REGISTER", username=name, password="x")
+    await c.until("AUTH_OK")
+    c.send("AUTH_LOGIN", username=name, password="x")
+    await c.until("AUTH_OK")
+    return c
+
+
+async def count_group_msgs(c: Client, n: int) -> None:
+    got = 0
+    while got < n:
+        line = await c.reader.readline()
+        if b'"GROUP_MSG_RECV"' in line:
+            got += 1
+
+
+async def run(port: int, members: int, n: int, pid: int) -> None:
+    clients = [await connect(port, f"burst{i}") for i in range(members)]
+    sender = clients[0]
+    sender.send("GROUP_CREATE", name="burst")
+    gid = (await sender.until("GROUP_CREATED"))["data"]["group_id"]
+    for c in clients[1:]:
+        c.send("GROUP_ACCEPT_INVITATION", group_id=gid)
+        await c.until("GROUP_ACCEPTED")
+    await asyncio.sleep(0.2)
+    cpu0, t0 = server_cpu(pid), time.perf_counter()
+    receivers = [asyncio.create_task(count_group_msgs(c, n)) for c in clients]
+    for i in range(n):
+        sender.send("GROUP_MSG_SEND", group_id=gid, content=f"burst message {i}")
+        if i % 100 == 99:
+            await sender.writer.drain()
+    await asyncio.gather(*receivers)
+    wall, cpu1 = time.perf_counter() - t0, server_cpu(pid)
+    delivered = n * members
+    print(f"{members} members x {n} messages: {wall:.2f}s, {delivered / wall:,.0f} deliveries/s")
+    if cpu0 is not None and cpu1 is not None and cpu1 > cpu0:
+        print(f"server CPU {cpu1 - cpu0:.2f}s -> {delivered / (cpu1 - cpu0):,.0f} deliveries per CPU-second")
+
+
+def main():
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    port = int(sys.argv[3]) if len(sys.argv) > 3 else 5599
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, "tools", "server_async.py"),
+                               "--port", str(port), "--hot-messages", "0"],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        time.sleep(1.0)
+        asyncio.run(run(port, members, n, server.pid))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# tools/bench_codec.py
+# So sánh các backend của tools/codec.py (orjson / msgspec / json) trên các gói tin thật:
+# MSG_RECV, MSG_REACT_UPDATE, FRIEND_LIST_RESULT và GROUP_HISTORY_RESULT (50 tin).
+# Chạy: python tools/bench_codec.py [số_vòng]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools import codec
+
+
+def _msg(i: int) -> dict:
+    return {"message_id": 1000 + i, "group_id": 3, "from_user_id": 1 + i % 7,
+            "content": f"tin nhắn số {i}: hẹn gặp lúc 8h nhé 😀", "created_at": 1729230000.5 + i,
+            "reply_to_id": None if i % 5 else 999 + i, "recalled": False,
+            "reactions_summary": {"+1": i % 3} if i % 4 == 0 else {}}
+
+
+SHAPES = {
+    "MSG_RECV": {"type": "MSG_RECV", "data": _msg(0) | {"to_user_id": 2}},
+    "MSG_REACT_UPDATE": {"type": "MSG_REACT_UPDATE",
+                         "data": {"message_id": 1000, "reaction": "❤️", "action": "add", "by_user_id": 2,
+                                  "counts": {"❤️": 3, "+1": 1}}},
+    "FRIEND_LIST_RESULT": {"type": "FRIEND_LIST_RESULT",
+                           "data": {"friends": [{"user_id": i, "username": f"user{i}", "status": "accepted"}
+                                                for i in range(30)],
+                                    "pending_in": [], "pending_out": []}},
+    "GROUP_HISTORY_RESULT": {"type": "GROUP_HISTORY_RESULT",
+                             "data": {"group_id": 3, "messages": [_msg(i) for i in range(50)], "has_more": True}},
+}
+
+
+def bench(rounds: int) -> dict:
+    out = {}
+    for name, obj in SHAPES.items():
+        line = codec.encode_line(obj)
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            codec.encode_line(obj)
+        enc = (time.perf_counter() - t0) / rounds * 1e6
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            codec.loads(line)
+        dec = (time.perf_counter() - t0) / rounds * 1e6
+        out[name] = (len(line), enc, dec, line)
+    return out
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    default = codec.BACKEND
+    results = {}
+    for backend in ("json", "orjson", "msgspec"):
+        try:
+            codec.use(backend)
+        except ImportError:
+            print(f"{backend}: not installed, skipped")
+            continue
+        results[backend] = bench(rounds)
+    codec.use(default)
+    print(f"{'payload':<22} {'bytes':>6} " + " ".join(f"{b + ' enc/dec (us)':>24}" for b in results))
+    for name in SHAPES:
+        size = results["json"][name][0]
+        cells = " ".join(f"{r[name][1]:>11.2f} /{r[name][2]:>11.2f}" for r in results.values())
+        same = all(r[name][3] == results["json"][name][3] for r in results.values())
+        print(f"{name:<22} {size:>6} {cells}{'' if same else '  OUTPUT DIFFERS'}")
+    print(f"default backend: {default}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# tools/bench_fanout.py
+# CPU mã hoá cho một lần fanout GROUP_MSG_SEND / MSG_REACT tới nhóm N thành viên:
+# mã hoá lại cho từng người nhận (cách cũ) vs mã hoá một lần rồi dùng chung bytes (fanout()).
+# Chạy: python tools/bench_fanout.py [số_thành_viên ...]
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools import server_async as srv
+
+
+class CountingConn:
+    fmt = "json"
+    limiter = None
+
+    def __init__(self) -> None:
+        self.frames = 0
+
+    def push(self, obj: dict) -> bool:
+        return self.push_frame(self.encode(obj))
+
+    def encode(self, obj: dict) -> bytes:
+        return srv.encode(obj)
+
+    def push_frame(self, data: bytes, ephemeral: bool = False) -> bool:
+        self.frames += 1
+        return True
+
+
+def setup(members: int) -> None:
+    srv.STATE = srv.STORE = srv.State()
+    st = srv.STATE
+    for i in range(members):
+        uid = st.add_user(f"u{i}", "x")["user_id"]
+        srv.USER_CONNS[uid] = CountingConn()
+    gid = st.create_group(1, "bench", None)
+    for uid in range(2, members + 1):
+        st.add_group_member(gid, uid)
+
+
+def per_recipient(members: int, payload: dict, rounds: int) -> float:
+    # what send() did before: a full encode for every member
+    t0 = time.process_time()
+    for _ in range(rounds):
+        for uid in range(1, members + 1):
+            srv.USER_CONNS[uid].push_frame(srv.encode(payload))
+    return (time.process_time() - t0) / rounds * 1e6
+
+
+async def via_route(msg: dict, rounds: int) -> float:
+    session = {"user_id": 1, "username": "u0"}
+    t0 = time.process_time()
+    for _ in range(rounds):
+        await srv.route(session, srv.USER_CONNS[1], msg)
+    return (time.process_time() - t0) / rounds * 1e6
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [10, 100, 500]
+    content = "hello everyone, this is a typical group chat message " * 2
+    print(f"{'members':>8} {'GROUP_MSG old (us)':>19} {'new (us)':>9} {'MSG_REACT old (us)':>19} {'new (us)':>9}")
+    for n in sizes:
+        setup(n)
+        rounds = max(20_000 // n, 20)
+        msg_payload = {"type": "GROUP_MSG_RECV",
+                       "data": {"message_id": 1, "group_id": 1, "from_user_id": 1, "content": content,
+                                "created_at": time.time(), "reply_to_id": None, "recalled": False,
+                                "reactions_summary": {}}}
+        react_payload = {"type": "MSG_REACT_UPDATE",
+                         "data": {"message_id": 1, "reaction": "+1", "action": "add", "by_user_id": 1,
+                                  "counts": {"+1": 3, "heart": 1}}}
+        old_msg = per_recipient(n, msg_payload, rounds)
+        new_msg = asyncio.run(via_route({"type": "GROUP_MSG_SEND", "data": {"group_id": 1, "content": content}},
+                                        rounds))
+        old_react = per_recipient(n, react_payload, rounds)
+        new_react = asyncio.run(via_route({"type": "MSG_REACT", "data": {"message_id": 1, "reaction": "+1"}},
+                                          rounds))
+        print(f"{n:>8} {old_msg:>19.1f} {new_msg:>9.1f} {old_react:>19.1f} {new_react:>9.1f}")
+        srv.USER_CONNS.clear()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# tools/bench_loop.py
+# So sánh event loop mặc định của asyncio với uvloop (nếu đã cài) cho server_async:
+#  1) connection churn: nhiều client song song lặp lại connect -> PING -> PONG -> đóng;
+#  2) thông lượng tin nhắn: chat nhóm dồn dập như tools/bench_burst.py.
+# Các tham số còn lại được chuyển nguyên cho server để thử cấu hình theo từng môi trường,
+# vd --backlog 1024 --sndbuf 262144 --no-nodelay.
+# Chạy: python tools/bench_loop.py [tuỳ chọn server_async ...]
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.bench_burst import ROOT, run as burst, server_cpu
+
+PORT = 5596
+PING = b'{"type":"PING","data":{}}\n'
+
+
+async def churn(port: int, clients: int, rounds: int) -> None:
+    async def one_client() -> None:
+        for _ in range(rounds):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(PING)
+            await reader.readline()
+            writer.close()
+            await writer.wait_closed()
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one_client() for _ in range(clients)))
+    wall = time.perf_counter() - t0
+    print(f"  churn: {clients * rounds} connections in {wall:.2f}s -> {clients * rounds / wall:,.0f} conn/s")
+
+
+def bench(loop: str, extra: list[str]) -> None:
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, "tools", "server_async.py"),
+                               "--port", str(PORT), "--hot-messages", "0", "--loop", loop, *extra],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        time.sleep(1.0)
+        print(f"{loop} loop {' '.join(extra)}")
+        cpu0 = server_cpu(server.pid)
+        asyncio.run(churn(PORT, 50, 100))
+        cpu1 = server_cpu(server.pid)
+        if cpu0 is not None and cpu1 is not None:
+            print(f"  churn: server CPU {(cpu1 - cpu0) / 5000 * 1e6:.0f} us/connection")
+        print("  throughput:", end=" ")
+        asyncio.run(burst(PORT, 50, 2000, server.pid))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    extra = sys.argv[1:]
+    bench("asyncio", extra)
+    try:
+        import uvloop  # noqa: F401
+    except ImportError:
+        print("uvloop: not installed, skipped (pip install uvloop)")
+        return
+    bench("uvloop", extra)
+
+
+if __name__ == "__main__":
+    main()
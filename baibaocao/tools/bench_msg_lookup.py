@@ -0,0 +1,65 @@
+# tools/bench_msg_lookup.py
+# Đo độ trễ MSG_SEEN / MSG_REACT khi số tin nhắn lưu trên server tăng dần.
+# Chạy: python tools/bench_msg_lookup.py [n1 n2 ...]
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools import server_async as srv
+from tools.records import Message
+
+
+class NullConn:
+    fmt = "json"
+    limiter = None
+
+    def push(self, obj: dict) -> bool:
+        return True
+
+    def encode(self, obj: dict) -> bytes:
+        return srv.encode(obj)
+
+    def push_frame(self, data: bytes, ephemeral: bool = False) -> bool:
+        return True
+
+
+def fill(n: int) -> None:
+    srv.STATE = srv.STORE = srv.State()
+    st = srv.STATE
+    st.friendships = {1: {2}, 2: {1}}
+    for i in range(n):
+        st.add_message(Message(1 + (i & 1), "x", 0.0, to_user_id=2 - (i & 1)))
+
+
+async def run(n: int, rounds: int = 200, batch: int = 50) -> tuple[float, float]:
+    fill(n)
+    w = NullConn()
+    session = {"user_id": 1, "username": "u1"}
+    rnd = random.Random(n)
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        ids = [rnd.randint(1, n) for _ in range(batch)]
+        await srv.route(session, w, {"type": "MSG_SEEN", "data": {"message_ids": ids}})
+    seen_us = (time.perf_counter() - t0) / rounds * 1e6
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        await srv.route(session, w, {"type": "MSG_REACT",
+                                     "data": {"message_id": rnd.randint(1, n), "reaction": "+1"}})
+    react_us = (time.perf_counter() - t0) / rounds * 1e6
+    return seen_us, react_us
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+    print(f"{'messages':>12} {'MSG_SEEN x50 (us)':>18} {'MSG_REACT (us)':>15}")
+    for n in sizes:
+        seen_us, react_us = asyncio.run(run(n))
+        print(f"{n:>12} {seen_us:>18.1f} {react_us:>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
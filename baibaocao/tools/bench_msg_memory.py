@@ -0,0 +1,49 @@
+# tools/bench_msg_memory.py
+# So sánh bộ nhớ / tin nhắn: bản ghi dict cũ vs tools.records.Message (__slots__).
+# Chạy: python tools/bench_msg_memory.py [n1 n2 ...]   (mặc định 1M và 10M; 10M dict cần ~10 GB RAM)
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.records import Message
+
+
+def legacy_record(i: int, now: float) -> dict:
+    # shape used by server_async / mock_server before tools.records
+    return {"id": i, "from_user_id": 1, "to_user_id": 2, "content": f"message {i}",
+            "created_at": now, "reply_to_id": None, "recalled": False,
+            "seen_by": set(), "reactions": {}}
+
+
+def slotted_record(i: int, now: float) -> Message:
+    return Message(1, f"message {i}", now, to_user_id=2, id=i)
+
+
+def measure(factory, n: int) -> float:
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    now = time.time()
+    store = [factory(i, now + i) for i in range(n)]
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    del store
+    gc.collect()
+    return used / n
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [1_000_000, 10_000_000]
+    print(f"{'messages':>12} {'dict (B/msg)':>14} {'slots (B/msg)':>14} {'saved':>7}")
+    for n in sizes:
+        before = measure(legacy_record, n)
+        after = measure(slotted_record, n)
+        print(f"{n:>12} {before:>14.0f} {after:>14.0f} {1 - after / before:>7.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# tools/bench_reactions.py
+# Nhóm nhiều cảm xúc: mỗi tin trong trang lịch sử có vài emoji, mỗi emoji hàng trăm người thả.
+#  1) cũ: set user id theo emoji, reactions_summary() đếm lại {emoji: len(set)} mỗi lần trả lịch sử / MSG_REACT;
+#  2) mới: array id đã sắp xếp + reaction_counts được cập nhật khi thêm/bỏ.
+# Đo bộ nhớ các tập người thả, thời gian dựng một trang GROUP_HISTORY và một MSG_REACT_UPDATE.
+# Chạy: python tools/bench_reactions.py [số_tin] [số_emoji] [người_mỗi_emoji]
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools import codec
+from tools.records import Message
+
+EMOJI = ["+1", "❤️", "😂", "😮", "😢", "🙏", "🔥", "🎉"]
+
+
+def traced(fn):
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    keep = fn()
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return keep, used
+
+
+def old_sets(n: int, emoji: int, users: int) -> list[dict]:
+    return [{e: set(range(1, users + 1)) for e in EMOJI[:emoji]} for _ in range(n)]
+
+
+def new_records(n: int, emoji: int, users: int) -> list[Message]:
+    out = []
+    for i in range(n):
+        m = Message(1, f"message {i}", float(i), group_id=1, id=i + 1)
+        m.load_reactions({e: range(1, users + 1) for e in EMOJI[:emoji]})
+        out.append(m)
+    return out
+
+
+def page(items: list, summary) -> bytes:
+    return codec.encode_line({"type": "GROUP_HISTORY_RESULT", "data": {"messages": [
+        {"message_id": i, "reactions_summary": summary(r)} for i, r in enumerate(items)]}})
+
+
+def per_call(fn, rounds: int = 200) -> float:
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - t0) / rounds * 1e6
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    emoji = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+    users = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+    print(f"history page of {n} messages, {emoji} emoji x {users} users each")
+
+    sets, set_mem = traced(lambda: old_sets(n, emoji, users))
+    recs, rec_mem = traced(lambda: new_records(n, emoji, users))
+    rec_mem -= sum(sys.getsizeof(m) + sys.getsizeof(m.content) for m in recs)  # the messages themselves
+
+    old_page = per_call(lambda: page(sets, lambda r: {k: len(v) for k, v in r.items()}))
+    new_page = per_call(lambda: page(recs, Message.reactions_summary))
+    print(f"sets:   {set_mem / 1024:,.0f} KiB, page {old_page:,.0f} us")
+    print(f"arrays: {rec_mem / 1024:,.0f} KiB, page {new_page:,.0f} us")
+
+    def old_toggle():
+        s = sets[0][EMOJI[0]]
+        s.discard(users + 1) if users + 1 in s else s.add(users + 1)
+        return {k: len(v) for k, v in sets[0].items()}
+
+    def new_toggle():
+        recs[0].toggle_reaction(EMOJI[0], users + 1)
+        return recs[0].reactions_summary()
+
+    print(f"MSG_REACT counts: sets {per_call(old_toggle, 20000):.2f} us, "
+          f"maintained {per_call(new_toggle, 20000):.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# tools/bench_read_state.py
+# Bộ nhớ cho trạng thái "đã xem" của một nhóm lớn: mỗi thành viên đã đọc hết lịch sử.
+#  1) cũ: một set seen_by cho mỗi tin (tin x người đọc). Dựng đủ 100k set x 1000 người cần vài GB,
+#     nên đo trên một mẫu tin rồi nhân tuyến tính (in rõ là ngoại suy);
+#  2) mới: watermark "đã đọc tới tin nào" theo (user, hội thoại) trong State, đo trên dữ liệu đầy đủ.
+# Chạy: python tools/bench_read_state.py [số_thành_viên] [số_tin] [số_tin_mẫu]
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.records import Message
+from tools.server_async import State
+
+
+def traced(fn) -> int:
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    keep = fn()
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    del keep
+    return used
+
+
+def seen_sets(readers: list[int], n: int) -> list[set]:
+    # what MSG_SEEN used to build: every reader added to every message's set
+    out = []
+    for _ in range(n):
+        s = set()
+        for uid in readers:
+            s.add(uid)
+        out.append(s)
+    return out
+
+
+def main():
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 100_000
+    sample = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    print(f"group of {members:,} members, {n:,} messages, everyone has read everything")
+
+    readers = list(range(1, members + 1))
+    per_msg = traced(lambda: seen_sets(readers, sample)) / sample
+    print(f"seen_by sets: {per_msg:,.0f} B/message (measured on {sample:,}) -> "
+          f"{per_msg * n / 2**20:,.0f} MiB for {n:,} messages (extrapolated)")
+
+    st = State()
+    for uid in readers:
+        st.add_user(f"u{uid}", "x")
+    gid = st.create_group(1, "big", None)
+
+    def join():
+        for uid in readers[1:]:
+            st.add_group_member(gid, uid)
+        return None
+
+    joined = traced(join)
+    now = time.time()
+    for i in range(n):
+        st.add_message(Message(readers[i % members], f"message {i}", now + i, group_id=gid))
+    last = st.get_message(st.next_msg_id - 1)
+
+    def read_everything():
+        for uid in readers:
+            st.mark_seen([last], uid)
+        return None
+
+    t0 = time.perf_counter()
+    marked = traced(read_everything)
+    wall = time.perf_counter() - t0
+    # the per-(user, group) entries are created on join and only hold counts, sending does not grow them
+    used = joined + marked
+    print(f"watermarks:   {used / 2**20:,.2f} MiB ({joined / 2**20:,.2f} entries "
+          f"+ {marked / 2**20:,.2f} marking); {wall * 1000:.0f} ms for every member to read all {n:,} messages")
+    print(f"-> {per_msg * n / used:,.0f}x less memory")
+
+
+if __name__ == "__main__":
+    main()
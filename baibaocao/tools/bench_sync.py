@@ -0,0 +1,116 @@
+# tools/bench_sync.py
+# Bắt kịp sau khi nối lại: một user có N hội thoại 1-1, mỗi hội thoại đã có sẵn lịch sử;
+# trong lúc user mất kết nối, mỗi người bạn gửi thêm vài tin. So sánh hai cách lấy bù:
+#  1) cũ: FRIEND_LIST rồi MSG_HISTORY (limit 50) cho từng hội thoại;
+#  2) mới: một SYNC{since} với cursor lấy trước khi mất kết nối.
+# Thêm: dựng danh sách hội thoại khi mở app bằng một CONV_LIST (tin cuối + số chưa đọc được server giữ sẵn).
+# Đo thời gian, số frame và số byte client nhận được.
+# Chạy: python tools/bench_sync.py [số_hội_thoại] [tin_cũ_mỗi_hội_thoại] [tin_mới_mỗi_hội_thoại] [port]
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.bench_burst import ROOT, Client, connect
+
+
+async def send_all(peers: list[Client], n: int, tag: str) -> None:
+    for p in peers:
+        for j in range(n):
+            p.send("MSG_SEND", to_user_id=1, content=f"{tag} message {j}")
+        for _ in range(n):
+            await p.until("MSG_RECV")
+
+
+async def read_until(c: Client, done) -> tuple[int, int]:
+    # frames and bytes received until done(msg) is true
+    frames = size = 0
+    while True:
+        line = await c.reader.readline()
+        frames += 1
+        size += len(line)
+        if done(json.loads(line)):
+            return frames, size
+
+
+async def login(port: int, name: str) -> Client:
+    c = Client(*await asyncio.open_connection("127.0.0.1", port, limit=1 << 20))
+    c.send("AUTH_LOGIN", username=name, password="x")
+    await c.until("AUTH_OK")
+    return c
+
+
+async def run(port: int, convs: int, old: int, new: int) -> None:
+    me = await connect(port, "sync_me")
+    peers = []
+    for i in range(convs):
+        p = await connect(port, f"sync_peer{i}")
+        p.send("FRIEND_REQUEST", to_user_id=1)
+        req = (await me.until("FRIEND_REQUEST_INCOMING"))["data"]["request_id"]
+        me.send("FRIEND_ACCEPT", request_id=req)
+        await me.until("FRIEND_ACCEPTED")
+        peers.append(p)
+    me.writer.close()
+    await send_all(peers, old, "old")
+    me = await login(port, "sync_me")
+    me.send("SYNC")
+    cursor = (await me.until("SYNC_RESULT"))["data"]["cursor"]
+    me.writer.close()
+    await send_all(peers, new, "new")  # while "me" is offline
+
+    me = await login(port, "sync_me")
+    t0 = time.perf_counter()
+    me.send("FRIEND_LIST")
+    friends = (await me.until("FRIEND_LIST_RESULT"))["data"]["friends"]
+    frames = size = 0
+    # one request at a time, like the clients do (all at once would overflow the server outbox)
+    for f in friends:
+        me.send("MSG_HISTORY", peer_id=f["user_id"], limit=50)
+        n, b = await read_until(me, lambda msg: msg["type"] == "MSG_HISTORY_RESULT")
+        frames, size = frames + n, size + b
+    wall = time.perf_counter() - t0
+    print(f"history: {len(friends) + 1} requests, {frames + 1} frames, {size / 1024:,.0f} KiB, {wall * 1000:.0f} ms")
+
+    t0 = time.perf_counter()
+    me.send("SYNC", since=cursor)
+    got = 0
+
+    def sync_done(msg: dict) -> bool:
+        nonlocal got
+        got += len(msg["data"]["messages"])
+        return not msg["data"]["has_more"]
+
+    frames, size = await read_until(me, sync_done)
+    wall = time.perf_counter() - t0
+    print(f"sync:    1 request, {frames} frames, {size / 1024:,.0f} KiB, {wall * 1000:.0f} ms ({got} messages)")
+
+    t0 = time.perf_counter()
+    me.send("CONV_LIST", limit=convs)
+    frames, size = await read_until(me, lambda msg: msg["type"] == "CONV_LIST_RESULT")
+    wall = time.perf_counter() - t0
+    print(f"inbox:   1 request, {frames} frames, {size / 1024:,.0f} KiB, {wall * 1000:.0f} ms")
+
+
+def main():
+    convs = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    old = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    new = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    port = int(sys.argv[4]) if len(sys.argv) > 4 else 5595
+    print(f"{convs} conversations, {old} old + {new} new messages each")
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, "tools", "server_async.py"),
+                               "--port", str(port), "--hot-messages", "0"],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        time.sleep(1.0)
+        asyncio.run(run(port, convs, old, new))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# tools/bench_tiering.py
+# So sánh State giữ toàn bộ lịch sử trong RAM với State phân tầng hot/cold (tools/segments.py):
+# bộ nhớ Python sau khi nạp, độ trễ trang mới nhất và trang sâu trong lịch sử.
+# Chạy: python tools/bench_tiering.py [số_tin_nhắn] [số_hội_thoại] [hot_messages]
+import gc
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.records import Message
+from tools.segments import SegmentDir
+from tools.server_async import State
+
+
+def fill(st: State, n: int, convs: int) -> None:
+    for i in range(n):
+        st.add_message(Message(1, f"message number {i}", float(i), group_id=1 + i % convs))
+
+
+def page_latency(st: State, n: int, convs: int, deep: bool, rounds: int = 2000) -> float:
+    rnd = random.Random(1)
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        gid = rnd.randint(1, convs)
+        before = rnd.randint(1, n // 2) if deep else None
+        st.history_page(State.group_key(gid), before, 50)
+    return (time.perf_counter() - t0) / rounds * 1e6
+
+
+def run(label: str, make, n: int, convs: int) -> None:
+    gc.collect()
+    tracemalloc.start()
+    st = make()
+    fill(st, n, convs)
+    mem = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    recent = page_latency(st, n, convs, deep=False)
+    deep = page_latency(st, n, convs, deep=True)
+    print(f"{label:>8} {mem / 2**20:>10.1f} {recent:>14.1f} {deep:>12.1f}")
+    if st.segments is not None:
+        st.segments.close()
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    convs = int(sys.argv[2]) if len(sys.argv) > 2 else 1_000
+    hot = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    d = tempfile.mkdtemp(prefix="tier-bench-")
+    print(f"{n} messages in {convs} conversations, hot tail {hot}-{2 * hot} per conversation")
+    print(f"{'':>8} {'RAM (MiB)':>10} {'recent (us)':>14} {'deep (us)':>12}")
+    try:
+        run("all RAM", State, n, convs)
+        run("tiered", lambda: State(SegmentDir(d), hot_messages=hot), n, convs)
+    finally:
+        shutil.rmtree(d, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
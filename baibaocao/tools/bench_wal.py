@@ -0,0 +1,64 @@
+# tools/bench_wal.py
+# Đo độ trễ commit (group commit + fsync) của WriteAheadLog và thời gian khôi phục
+# (chỉ replay log vs snapshot + đuôi log).
+# Chạy: python tools/bench_wal.py [số_tin_nhắn]
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.records import Message
+from tools.server_async import State
+from tools.wal import WriteAheadLog
+
+
+def write_phase(directory: str, n: int, snapshot_every: int) -> tuple[float, dict]:
+    wal = WriteAheadLog(directory, snapshot_every=snapshot_every)
+    wal.recover()
+    st = State()
+    wal.start(st.snapshot)
+    st.journal = wal.append
+    a = st.add_user("a", "x")["user_id"]
+    b = st.add_user("b", "x")["user_id"]
+    st.accept_friend_request(st.add_friend_request(a, b))
+    t0 = time.perf_counter()
+    for i in range(n):
+        st.add_message(Message(a if i & 1 else b, f"message {i}", time.time(), to_user_id=b if i & 1 else a))
+    append_s = time.perf_counter() - t0
+    wal.close()
+    return append_s, wal.stats()
+
+
+def recover_phase(directory: str) -> tuple[float, int]:
+    t0 = time.perf_counter()
+    wal = WriteAheadLog(directory)
+    st = State()
+    snap, records = wal.recover()
+    if snap is not None:
+        st.restore(snap)
+    for r in records:
+        st.apply(r)
+    return time.perf_counter() - t0, len(st.messages)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    for label, every in (("log only", n * 10), ("snapshots", max(n // 4, 1))):
+        d = tempfile.mkdtemp(prefix="wal-bench-")
+        try:
+            append_s, stats = write_phase(d, n, every)
+            rec_s, count = recover_phase(d)
+        finally:
+            shutil.rmtree(d, ignore_errors=True)
+        print(f"[{label}] {n} messages: append {n / append_s:,.0f} msg/s on the caller thread, "
+              f"{stats['commits']} fsyncs ({stats['records'] / max(stats['commits'], 1):.0f} records/fsync), "
+              f"commit latency avg {stats['avg_commit_ms']:.1f} ms max {stats['max_commit_ms']:.1f} ms, "
+              f"snapshots {stats['snapshots']}")
+        print(f"[{label}] recovery: {count} messages in {rec_s:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
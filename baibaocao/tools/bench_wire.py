@@ -0,0 +1,141 @@
+# tools/bench_wire.py
+# So sánh JSON-lines với frame nhị phân bin1 (tools/binproto.py, bật bằng HELLO):
+#  1) số byte trên dây và thời gian encode/decode của các gói tin thật (SHAPES của bench_codec);
+#  2) chat nhóm dồn dập qua server_async thật: byte nhận được và CPU server cho mỗi tin giao tới client.
+# Chạy: python tools/bench_wire.py [số_thành_viên] [số_tin] [port]
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools import binproto, codec
+from tools.bench_burst import ROOT, server_cpu
+from tools.bench_codec import SHAPES
+from tools.framing import LengthFramer, LineFramer
+
+WIRES = {"json": (codec.encode_line, codec.loads), "bin1": (binproto.encode_frame, binproto.decode)}
+
+
+def bench_shapes(rounds: int = 5000) -> None:
+    print(f"{'payload':<22} " + " ".join(f"{w + ' bytes / enc / dec (us)':>32}" for w in WIRES))
+    for name, obj in SHAPES.items():
+        cells = []
+        for encode, decode in WIRES.values():
+            frame = encode(obj)
+            body = frame[4:] if encode is binproto.encode_frame else frame
+            t0 = time.perf_counter()
+            for _ in range(rounds):
+                encode(obj)
+            enc = (time.perf_counter() - t0) / rounds * 1e6
+            t0 = time.perf_counter()
+            for _ in range(rounds):
+                decode(body)
+            dec = (time.perf_counter() - t0) / rounds * 1e6
+            cells.append(f"{len(frame):>10} / {enc:>8.2f} / {dec:>8.2f}")
+        print(f"{name:<22} " + " ".join(f"{c:>32}" for c in cells))
+
+
+class WireClient:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader, self.writer = reader, writer
+        self.encode, self.decode = WIRES["json"]
+        self.framer: LineFramer | LengthFramer = LineFramer()
+        self.frames: list[bytes] = []
+        self.received = 0
+
+    async def hello(self, wire: str) -> None:
+        if wire == "json":
+            return
+        self.writer.write(codec.encode_line(binproto.hello([wire])))
+        ok = codec.loads(await self.reader.readline())
+        assert ok["data"]["format"] == wire, ok
+        self.encode, self.decode = WIRES[wire]
+        self.framer = LengthFramer()
+
+    def send(self, typ: str, **data) -> None:
+        self.writer.write(self.encode({"type": typ, "data": data}))
+
+    async def next(self) -> dict:
+        while not self.frames:
+            chunk = await self.reader.read(65536)
+            if not chunk:
+                raise ConnectionError("server closed")
+            self.received += len(chunk)
+            self.frames.extend(self.framer.feed(chunk))
+        return self.decode(self.frames.pop(0))
+
+    async def until(self, typ: str) -> dict:
+        while True:
+            msg = await self.next()
+            if msg["type"] == typ:
+                return msg
+
+
+async def connect(port: int, name: str, wire: str) -> WireClient:
+    c = WireClient(*await asyncio.open_connection("127.0.0.1", port))
+    await c.hello(wire)
+    c.send("AUTH_REGISTER", username=name, password="x")
+    await c.until("AUTH_OK")
+    c.send("AUTH_LOGIN", username=name, password="x")
+    await c.until("AUTH_OK")
+    return c
+
+
+async def count_group_msgs(c: WireClient, n: int) -> None:
+    got = 0
+    while got < n:
+        if (await c.next())["type"] == "GROUP_MSG_RECV":
+            got += 1
+
+
+async def burst(port: int, wire: str, members: int, n: int, pid: int) -> None:
+    clients = [await connect(port, f"{wire}{i}", wire) for i in range(members)]
+    sender = clients[0]
+    sender.send("GROUP_CREATE", name=wire)
+    gid = (await sender.until("GROUP_CREATED"))["data"]["group_id"]
+    for c in clients[1:]:
+        c.send("GROUP_ACCEPT_INVITATION", group_id=gid)
+        await c.until("GROUP_ACCEPTED")
+    await asyncio.sleep(0.2)
+    for c in clients:
+        c.received = 0
+    cpu0, t0 = server_cpu(pid), time.perf_counter()
+    receivers = [asyncio.create_task(count_group_msgs(c, n)) for c in clients]
+    for i in range(n):
+        sender.send("GROUP_MSG_SEND", group_id=gid, content=f"burst message {i} 😀")
+        if i % 100 == 99:
+            await sender.writer.drain()
+    await asyncio.gather(*receivers)
+    wall, cpu1 = time.perf_counter() - t0, server_cpu(pid)
+    delivered = n * members
+    line = f"{wire:<5} {sum(c.received for c in clients) / delivered:>6.1f} bytes/delivery, {wall:.2f}s wall"
+    if cpu0 is not None and cpu1 is not None:
+        line += f", server CPU {(cpu1 - cpu0) / n * 1e6:,.0f} us/message ({(cpu1 - cpu0) / delivered * 1e6:.1f} us/delivery)"
+    print(line)
+    for c in clients:
+        c.writer.close()
+
+
+def main():
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    port = int(sys.argv[3]) if len(sys.argv) > 3 else 5598
+    bench_shapes()
+    print(f"\ngroup burst: {members} members x {n} messages (codec backend {codec.BACKEND})")
+    for wire in WIRES:
+        server = subprocess.Popen([sys.executable, os.path.join(ROOT, "tools", "server_async.py"),
+                                   "--port", str(port), "--hot-messages", "0"],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            time.sleep(1.0)
+            asyncio.run(burst(port, wire, members, n, server.pid))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# tools/bench_workers.py
+# Khả năng mở rộng của server_async --workers N (SO_REUSEPORT + broker tools/bus.py, lưu trữ SQLite):
+# nhiều nhóm chat cùng lúc, mỗi nhóm một người gửi liên tục; các client chạy trong nhiều tiến trình
+# để bản thân máy tạo tải không thành nút thắt. Đo tổng số tin giao tới client mỗi giây với 1, 2, 4, 8 worker.
+# Chạy: python tools/bench_workers.py [số_nhóm] [thành_viên_mỗi_nhóm] [số_tin_mỗi_nhóm] [port]
+import asyncio
+import multiprocessing as mp
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.bench_burst import ROOT, connect, count_group_msgs
+
+
+async def run_group(port: int, g: int, members: int, n: int, barrier) -> tuple[float, float]:
+    clients = [await connect(port, f"w{g}_{i}") for i in range(members)]
+    sender = clients[0]
+    sender.send("GROUP_CREATE", name=f"g{g}")
+    gid = (await sender.until("GROUP_CREATED"))["data"]["group_id"]
+    for c in clients[1:]:
+        c.send("GROUP_ACCEPT_INVITATION", group_id=gid)
+        await c.until("GROUP_ACCEPTED")
+    await asyncio.sleep(0.5)  # let the other workers' online events reach the broker
+    await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+    t0 = time.time()
+    receivers = [asyncio.create_task(count_group_msgs(c, n)) for c in clients]
+    for i in range(n):
+        sender.send("GROUP_MSG_SEND", group_id=gid, content=f"group {g} message {i}")
+        if i % 50 == 49:
+            await sender.writer.drain()
+    await asyncio.gather(*receivers)
+    for c in clients:
+        c.writer.close()
+    return t0, time.time()
+
+
+def load_process(port: int, g: int, members: int, n: int, barrier, out) -> None:
+    out.put(asyncio.run(run_group(port, g, members, n, barrier)))
+
+
+def run(workers: int, groups: int, members: int, n: int, port: int) -> float:
+    tmp = tempfile.mkdtemp(prefix="bench-workers-")
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, "tools", "server_async.py"),
+                               "--port", str(port), "--workers", str(workers),
+                               "--storage", f"sqlite:{os.path.join(tmp, 'chat.db')}"],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        time.sleep(1.5)
+        barrier, out = mp.Barrier(groups), mp.Queue()
+        procs = [mp.Process(target=load_process, args=(port, g, members, n, barrier, out)) for g in range(groups)]
+        for p in procs:
+            p.start()
+        spans = [out.get(timeout=600) for _ in procs]
+        for p in procs:
+            p.join()
+        return max(end for _, end in spans) - min(start for start, _ in spans)
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def main():
+    groups = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    members = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+    n = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+    port = int(sys.argv[4]) if len(sys.argv) > 4 else 5597
+    delivered = groups * members * n
+    print(f"{groups} groups x {members} members x {n} messages = {delivered:,} deliveries, {os.cpu_count()} CPUs")
+    base = None
+    for workers in (1, 2, 4, 8):
+        wall = run(workers, groups, members, n, port)
+        rate = delivered / wall
+        base = base or rate
+        print(f"{workers} worker(s): {wall:6.2f}s  {rate:>10,.0f} deliveries/s  x{rate / base:.2f}")
+
+
+if __name__ == "__main__":
+    main()
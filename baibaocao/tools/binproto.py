@@ -0,0 +1,262 @@
+# tools/binproto.py
+import socket
+import struct
+from typing import Any
+
+from tools import codec
+from tools.framing import LineFramer
+
+
+# Giao thức nhị phân "bin1", bật bằng bắt tay HELLO (JSON-lines vẫn là mặc định):
+#   client -> {"type": "HELLO", "data": {"formats": ["bin1", "json"]}}       (JSON-lines)
+#   server -> {"type": "HELLO_OK", "data": {"format": "bin1"}}               (JSON-lines)
+# Sau HELLO_OK cả hai chiều dùng frame: độ dài u32 big-endian + thân kiểu MessagePack.
+# Client không gửi gì thêm giữa HELLO và HELLO_OK.
+# Thân frame là mảng [type, data] hoặc [type, data, {các khoá top-level khác, vd request_id}];
+# type và các khoá dict quen thuộc được thay bằng số nguyên nhỏ (bảng dưới, chỉ được thêm vào cuối).
+
+FORMAT = "bin1"
+
+TYPES = [
+    "PING", "PONG", "HELLO", "HELLO_OK", "ERROR",
+    "AUTH_REGISTER", "AUTH_LOGIN", "AUTH_OK", "AUTH_FAIL",
+    "FRIEND_REQUEST", "FRIEND_REQUEST_SENT", "FRIEND_REQUEST_INCOMING", "FRIEND_ACCEPT", "FRIEND_ACCEPTED",
+    "FRIEND_REMOVE", "FRIEND_REMOVED", "FRIEND_LIST", "FRIEND_LIST_RESULT", "FRIEND_LIST_UPDATE",
+    "FRIEND_BLOCK", "FRIEND_BLOCKED", "FRIEND_UNBLOCK", "FRIEND_UNBLOCKED",
+    "MSG_SEND", "MSG_RECV", "MSG_HISTORY", "MSG_HISTORY_RESULT",
+    "GROUP_CREATE", "GROUP_CREATED", "GROUP_ADD", "GROUP_INVITATION", "GROUP_ACCEPT_INVITATION",
+    "GROUP_ACCEPTED", "GROUP_REJECT_INVITATION", "GROUP_REJECTED", "GROUP_INVITATION_REJECTED",
+    "GROUP_LIST", "GROUP_LIST_RESULT", "GROUP_LIST_UPDATE",
+    "GROUP_MSG_SEND", "GROUP_MSG_RECV", "GROUP_HISTORY", "GROUP_HISTORY_RESULT",
+    "MSG_SEEN", "MSG_SEEN_UPDATE", "MSG_RECALL", "MSG_RECALL_UPDATE", "MSG_REACT", "MSG_REACT_UPDATE",
+    "BATCH", "BATCH_RESULT", "AUTH_RESUME", "SYNC", "SYNC_RESULT",
+    "CONV_LIST", "CONV_LIST_RESULT",
+]
+
+KEYS = [
+    "request_id", "message_id", "from_user_id", "to_user_id", "group_id", "content", "created_at",
+    "reply_to_id", "recalled", "reactions_summary", "user_id", "username", "password", "reason", "code",
+    "peer_id", "before_id", "limit", "messages", "has_more", "name", "avatar", "status", "friends",
+    "pending_in", "pending_out", "from_username", "to_username", "member_count", "groups", "group",
+    "message_ids", "by_user_id", "reaction", "action", "counts", "user_id1", "user_id2", "group_name",
+    "got", "max", "formats", "format", "items", "results", "ok", "replies", "token",
+    "since", "cursor", "conversations", "last_message", "unread", "retry_after", "seq",
+]
+
+_TYPE_CODES = {t: i for i, t in enumerate(TYPES)}
+_KEY_CODES = {k: i for i, k in enumerate(KEYS)}
+assert len(KEYS) < 128  # interned keys must stay positive fixints
+_LEN = struct.Struct(">I")
+_F64 = struct.Struct(">d")
+
+
+def _pack(obj: Any, out: bytearray) -> None:
+    t = type(obj)
+    if t is str:
+        b = obj.encode()
+        n = len(b)
+        if n < 32:
+            out.append(0xA0 | n)
+        elif n < 0x100:
+            out += b"\xd9" + n.to_bytes(1, "big")
+        elif n < 0x10000:
+            out += b"\xda" + n.to_bytes(2, "big")
+        else:
+            out += b"\xdb" + n.to_bytes(4, "big")
+        out += b
+    elif t is int:
+        if 0 <= obj < 0x80:
+            out.append(obj)
+        elif -32 <= obj < 0:
+            out.append(obj & 0xFF)
+        elif obj >= 0:
+            if obj < 0x100:
+                out += b"\xcc" + obj.to_bytes(1, "big")
+            elif obj < 0x10000:
+                out += b"\xcd" + obj.to_bytes(2, "big")
+            elif obj < 0x100000000:
+                out += b"\xce" + obj.to_bytes(4, "big")
+            elif obj < 0x10000000000000000:
+                out += b"\xcf" + obj.to_bytes(8, "big")
+            else:
+                raise ValueError(f"int out of 64-bit range: {obj}")
+        elif obj >= -0x80:
+            out += b"\xd0" + obj.to_bytes(1, "big", signed=True)
+        elif obj >= -0x8000:
+            out += b"\xd1" + obj.to_bytes(2, "big", signed=True)
+        elif obj >= -0x80000000:
+            out += b"\xd2" + obj.to_bytes(4, "big", signed=True)
+        elif obj >= -0x8000000000000000:
+            out += b"\xd3" + obj.to_bytes(8, "big", signed=True)
+        else:
+            raise ValueError(f"int out of 64-bit range: {obj}")
+    elif t is dict:
+        n = len(obj)
+        if n < 16:
+            out.append(0x80 | n)
+        elif n < 0x10000:
+            out += b"\xde" + n.to_bytes(2, "big")
+        else:
+            out += b"\xdf" + n.to_bytes(4, "big")
+        for k, v in obj.items():
+            code = _KEY_CODES.get(k)
+            if code is not None:
+                out.append(code)
+            else:
+                _pack(k if type(k) is str else str(k), out)  # like JSON, keys are strings
+            _pack(v, out)
+    elif t is list or t is tuple:
+        n = len(obj)
+        if n < 16:
+            out.append(0x90 | n)
+        elif n < 0x10000:
+            out += b"\xdc" + n.to_bytes(2, "big")
+        else:
+            out += b"\xdd" + n.to_bytes(4, "big")
+        for v in obj:
+            _pack(v, out)
+    elif obj is None:
+        out.append(0xC0)
+    elif obj is True:
+        out.append(0xC3)
+    elif obj is False:
+        out.append(0xC2)
+    elif t is float:
+        out += b"\xcb" + _F64.pack(obj)
+    else:
+        raise TypeError(f"cannot encode {t.__name__}")
+
+
+def _str(buf: bytes, pos: int, n: int) -> tuple[str, int]:
+    end = pos + n
+    return buf[pos:end].decode(), end
+
+
+def _unpack(buf: bytes, pos: int) -> tuple[Any, int]:
+    b = buf[pos]
+    pos += 1
+    if b < 0x80:
+        return b, pos
+    if b >= 0xE0:
+        return b - 0x100, pos
+    if 0xA0 <= b < 0xC0:
+        return _str(buf, pos, b & 0x1F)
+    if 0x80 <= b < 0x90:
+        return _map(buf, pos, b & 0x0F)
+    if 0x90 <= b < 0xA0:
+        return _array(buf, pos, b & 0x0F)
+    if b == 0xC0:
+        return None, pos
+    if b == 0xC2:
+        return False, pos
+    if b == 0xC3:
+        return True, pos
+    if b == 0xCB:
+        return _F64.unpack_from(buf, pos)[0], pos + 8
+    if 0xCC <= b <= 0xCF:
+        size = 1 << (b - 0xCC)
+        return int.from_bytes(buf[pos:pos + size], "big"), pos + size
+    if 0xD0 <= b <= 0xD3:
+        size = 1 << (b - 0xD0)
+        return int.from_bytes(buf[pos:pos + size], "big", signed=True), pos + size
+    if 0xD9 <= b <= 0xDB:
+        size = 1 << (b - 0xD9)
+        n = int.from_bytes(buf[pos:pos + size], "big")
+        return _str(buf, pos + size, n)
+    if b in (0xDC, 0xDD):
+        size = 2 if b == 0xDC else 4
+        return _array(buf, pos + size, int.from_bytes(buf[pos:pos + size], "big"))
+    if b in (0xDE, 0xDF):
+        size = 2 if b == 0xDE else 4
+        return _map(buf, pos + size, int.from_bytes(buf[pos:pos + size], "big"))
+    raise ValueError(f"unsupported type byte 0x{b:02x}")
+
+
+def _array(buf: bytes, pos: int, n: int) -> tuple[list, int]:
+    out = []
+    for _ in range(n):
+        v, pos = _unpack(buf, pos)
+        out.append(v)
+    return out, pos
+
+
+def _map(buf: bytes, pos: int, n: int) -> tuple[dict, int]:
+    out = {}
+    for _ in range(n):
+        k, pos = _unpack(buf, pos)
+        if type(k) is int:
+            if not 0 <= k < len(KEYS):
+                raise ValueError(f"unknown key code {k}")
+            k = KEYS[k]
+        out[k], pos = _unpack(buf, pos)
+    return out, pos
+
+
+def encode_frame(obj: dict) -> bytes:
+    """dict -> một frame bin1 (độ dài + thân)."""
+    typ = obj.get("type")
+    env = [_TYPE_CODES.get(typ, typ), obj.get("data", {})]
+    if len(obj) > 2 or "data" not in obj:
+        extra = {k: v for k, v in obj.items() if k != "type" and k != "data"}
+        if extra:
+            env.append(extra)
+    out = bytearray(4)
+    _pack(env, out)
+    _LEN.pack_into(out, 0, len(out) - 4)
+    return bytes(out)
+
+
+def decode(body: bytes) -> dict:
+    """Thân frame (không gồm 4 byte độ dài) -> dict; ValueError nếu hỏng."""
+    try:
+        env, pos = _unpack(body, 0)
+        if pos != len(body) or type(env) is not list or not 2 <= len(env) <= 3:
+            raise ValueError("bad bin1 envelope")
+        typ = env[0]
+        if type(typ) is int:
+            if not 0 <= typ < len(TYPES):
+                raise ValueError(f"unknown type code {typ}")
+            typ = TYPES[typ]
+        msg = {"type": typ, "data": env[1]}
+        if len(env) == 3:
+            msg.update(env[2])
+    except (IndexError, KeyError, TypeError, UnicodeDecodeError, struct.error) as e:
+        raise ValueError(f"bad bin1 frame: {e}") from None
+    return msg
+
+
+def hello(formats: list[str]) -> dict:
+    return {"type": "HELLO", "data": {"formats": formats}}
+
+
+def choose_format(msg: dict) -> str:
+    """Server: chọn định dạng đầu tiên trong HELLO mà server hỗ trợ."""
+    data = msg.get("data") or {}
+    for fmt in data.get("formats") or ():
+        if fmt in (FORMAT, "json"):
+            return fmt
+    return "json"
+
+
+def negotiate(sock: socket.socket, want: str = FORMAT, timeout: float = 5.0) -> tuple[str, bytes]:
+    """
+    Client (socket blocking): gửi HELLO, chờ HELLO_OK.
+    Trả về (định dạng server chọn, các byte đã nhận sau HELLO_OK).
+    """
+    sock.sendall(codec.encode_line(hello([want, "json"])))
+    framer = LineFramer()
+    old = sock.gettimeout()
+    sock.settimeout(timeout)
+    try:
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                raise ConnectionError("closed during HELLO")
+            for line in framer.feed(data):
+                msg = codec.loads(line)
+                if msg.get("type") == "HELLO_OK":
+                    return (msg.get("data") or {}).get("format", "json"), framer.take_rest()
+                if msg.get("type") == "ERROR":
+                    return "json", framer.take_rest()  # server without HELLO support
+    finally:
+        sock.settimeout(old)
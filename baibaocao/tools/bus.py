@@ -0,0 +1,111 @@
+# tools/bus.py
+import asyncio
+from typing import Callable, Dict, Iterable
+
+from tools import codec
+from tools.framing import FrameTooLarge, LineFramer
+
+
+# Bus pub/sub cục bộ cho chế độ nhiều worker của server_async (--workers N).
+# Tiến trình cha chạy Broker trên một Unix domain socket; mỗi worker nối tới bằng BusClient.
+# Các dòng JSON trên bus:
+#   {"op": "online",  "uid": u}                  user u đang kết nối ở worker này
+#   {"op": "offline", "uid": u}
+#   {"op": "pub", "uids": [...], "msg": {...}}    giao msg cho các user đang ở worker khác
+# Broker chỉ chuyển tiếp nguyên dòng "pub" tới (các) worker đang giữ kết nối của những uid đó.
+
+MAX_FRAME = 64 << 20
+HIGH_WATER = 1 << 20  # bytes buffered towards one worker before the broker waits for it
+
+
+class Broker:
+    """Chạy trong tiến trình cha; giữ bảng uid -> worker đang giữ kết nối của user đó."""
+
+    def __init__(self) -> None:
+        self.where: Dict[int, asyncio.StreamWriter] = {}
+        self.forwarded = 0
+
+    async def serve(self, path: str) -> asyncio.AbstractServer:
+        return await asyncio.start_unix_server(self._handle, path)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        framer = LineFramer(MAX_FRAME)
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for line in framer.feed(data):
+                    msg = codec.loads(line)
+                    op = msg.get("op")
+                    if op == "pub":
+                        await self._forward(line, msg.get("uids") or (), writer)
+                    elif op == "online":
+                        self.where[msg["uid"]] = writer
+                    elif op == "offline" and self.where.get(msg["uid"]) is writer:
+                        del self.where[msg["uid"]]
+        except (ConnectionError, FrameTooLarge, ValueError) as e:
+            print(f"Bus: dropping worker connection: {e!r}")
+        finally:
+            for uid in [u for u, w in self.where.items() if w is writer]:
+                del self.where[uid]
+            writer.close()
+
+    async def _forward(self, line: bytes, uids: Iterable[int], sender: asyncio.StreamWriter) -> None:
+        targets = {self.where.get(uid) for uid in uids}
+        targets.discard(None)
+        targets.discard(sender)
+        for w in targets:
+            w.write(line + b"\n")
+            self.forwarded += 1
+            if w.transport.get_write_buffer_size() > HIGH_WATER:
+                await w.drain()
+
+
+class BusClient:
+    """
+    Phía worker. deliver(msg, uids) được gọi cho mỗi "pub" tới từ worker khác;
+    worker tự lọc ra các uid đang kết nối tại chỗ.
+    """
+
+    def __init__(self, path: str, deliver: Callable[[dict, list], None]) -> None:
+        self.path = path
+        self.deliver = deliver
+        self.published = 0
+        self._writer: asyncio.StreamWriter | None = None
+        self._task: asyncio.Task | None = None
+
+    async def connect(self) -> None:
+        reader, self._writer = await asyncio.open_unix_connection(self.path)
+        self._task = asyncio.create_task(self._read_loop(reader))
+
+    async def _read_loop(self, reader: asyncio.StreamReader) -> None:
+        framer = LineFramer(MAX_FRAME)
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                print("Bus: broker went away")
+                return
+            for line in framer.feed(data):
+                msg = codec.loads(line)
+                self.deliver(msg["msg"], msg["uids"])
+
+    def _send(self, obj: dict) -> None:
+        if self._writer is not None and not self._writer.is_closing():
+            self._writer.write(codec.encode_line(obj))
+
+    def online(self, uid: int) -> None:
+        self._send({"op": "online", "uid": uid})
+
+    def offline(self, uid: int) -> None:
+        self._send({"op": "offline", "uid": uid})
+
+    def publish(self, msg: dict, uids: list) -> None:
+        self.published += 1
+        self._send({"op": "pub", "uids": uids, "msg": msg})
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        if self._writer is not None:
+            self._writer.close()
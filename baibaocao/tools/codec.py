@@ -0,0 +1,84 @@
+# tools/codec.py
+import json
+import os
+import warnings
+from typing import Any, Callable
+
+
+# Codec JSON dùng chung cho server_async, mock_server, http_gateway và client (utils/helpers.py).
+# Dùng orjson hoặc msgspec nếu đã cài, nếu không thì json của stdlib. Mọi backend cho ra
+# cùng một chuỗi byte: JSON gọn (không khoảng trắng), UTF-8 nguyên bản (không \uXXXX).
+# Ép chọn backend bằng biến môi trường CHAT_JSON=orjson|msgspec|json.
+
+
+def _stdlib() -> tuple[Callable[[Any], bytes], Callable[[Any], Any]]:
+    enc = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+    def dumps(obj: Any) -> bytes:
+        return enc(obj).encode()
+
+    return dumps, json.loads
+
+
+def _orjson() -> tuple[Callable[[Any], bytes], Callable[[Any], Any]]:
+    import orjson
+
+    def dumps(obj: Any) -> bytes:
+        # int dict keys become strings, like the stdlib
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    return dumps, orjson.loads  # orjson.JSONDecodeError is a ValueError
+
+
+def _msgspec() -> tuple[Callable[[Any], bytes], Callable[[Any], Any]]:
+    import msgspec
+
+    decode = msgspec.json.Decoder().decode
+
+    def loads(data: Any) -> Any:
+        try:
+            return decode(data)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from None
+
+    return msgspec.json.Encoder().encode, loads
+
+
+_BACKENDS = {"orjson": _orjson, "msgspec": _msgspec, "json": _stdlib}
+
+BACKEND = "json"
+dumps: Callable[[Any], bytes]
+loads: Callable[[Any], Any]  # raises ValueError on bad input, whatever the backend
+
+
+def use(name: str) -> None:
+    """Chọn backend ("orjson", "msgspec" hoặc "json"); ValueError nếu tên lạ, ImportError nếu chưa cài."""
+    global BACKEND, dumps, loads
+    if name not in _BACKENDS:
+        raise ValueError(f"unknown JSON backend {name!r}, expected one of: {', '.join(_BACKENDS)}")
+    dumps, loads = _BACKENDS[name]()
+    BACKEND = name
+
+
+def encode_line(obj: Any) -> bytes:
+    """dict -> một frame JSON-lines."""
+    return dumps(obj) + b"\n"
+
+
+def _auto() -> None:
+    forced = os.environ.get("CHAT_JSON")
+    if forced and forced not in _BACKENDS:
+        # a typo must not stop every program that imports the codec: pick as if unset, but say so
+        warnings.warn(f"CHAT_JSON={forced!r} is not one of {', '.join(_BACKENDS)}; choosing automatically",
+                      RuntimeWarning, stacklevel=2)
+        forced = None
+    for name in ([forced] if forced else ["orjson", "msgspec", "json"]):
+        try:
+            use(name)
+            return
+        except ImportError:
+            continue
+    use("json")
+
+
+_auto()
@@ -0,0 +1,55 @@
+# tools/dispatch.py
+from typing import Any, Callable, NamedTuple
+
+
+class Handler(NamedTuple):
+    fn: Callable
+    auth: bool  # requires a logged-in session
+
+
+class Registry:
+    """
+    Bảng type -> handler dùng cho route() của server_async và _route() của mock_server.
+    Hai server gọi handler cùng một kiểu: fn(session, conn, data).
+    Tra cứu là một phép dict nên chi phí không phụ thuộc số loại lệnh;
+    mỗi handler tự khai báo có cần đăng nhập hay không.
+    timing: hook tuỳ chọn, gọi timing(type, giây) sau mỗi handler (None = không đo gì).
+    """
+
+    def __init__(self) -> None:
+        self.handlers: dict[str, Handler] = {}
+        self.timing: Callable[[str, float], None] | None = None
+
+    def on(self, typ: str, auth: bool = True) -> Callable[[Callable], Callable]:
+        def register(fn: Callable) -> Callable:
+            if typ in self.handlers:
+                raise ValueError(f"duplicate handler for {typ}")
+            self.handlers[typ] = Handler(fn, auth)
+            return fn
+        return register
+
+    def get(self, typ: Any) -> Handler | None:
+        return self.handlers.get(typ) if isinstance(typ, str) else None
+
+
+class TypeStats:
+    """Số lần gọi, tổng và lớn nhất thời gian xử lý theo loại lệnh; gán vào Registry.timing."""
+
+    def __init__(self) -> None:
+        self.stats: dict[str, list] = {}  # type -> [count, total_s, max_s]
+
+    def __call__(self, typ: str, seconds: float) -> None:
+        s = self.stats.get(typ)
+        if s is None:
+            self.stats[typ] = [1, seconds, seconds]
+            return
+        s[0] += 1
+        s[1] += seconds
+        if seconds > s[2]:
+            s[2] = seconds
+
+    def report(self) -> str:
+        lines = [f"{'type':<26} {'count':>8} {'avg us':>9} {'max us':>9} {'total s':>8}"]
+        for typ, (n, total, mx) in sorted(self.stats.items(), key=lambda kv: -kv[1][1]):
+            lines.append(f"{typ:<26} {n:>8} {total / n * 1e6:>9.1f} {mx * 1e6:>9.1f} {total:>8.3f}")
+        return "\n".join(lines)
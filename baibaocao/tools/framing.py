@@ -0,0 +1,81 @@
+# tools/framing.py
+
+
+class FrameTooLarge(ValueError):
+    """Một dòng dài hơn max_frame; kết nối nên bị đóng vì không còn đồng bộ được."""
+
+
+class LineFramer:
+    """
+    Tách luồng byte JSON-lines thành từng frame trong thời gian tuyến tính.
+    Dữ liệu được nối vào một bytearray, chỉ quét '\\n' trên phần mới nhận,
+    và phần đã tiêu thụ bị xoá một lần cho mỗi lần feed() (không copy lại buffer cho từng dòng).
+    Dòng rỗng bị bỏ qua; dòng dài hơn max_frame gây FrameTooLarge thay vì bị đệm vô hạn.
+    """
+
+    def __init__(self, max_frame: int = 1 << 20) -> None:
+        self.max_frame = max_frame
+        self._buf = bytearray()
+
+    def feed(self, data: bytes) -> list[bytes]:
+        buf = self._buf
+        scan = len(buf)  # the buffered tail has no newline yet
+        buf += data
+        frames: list[bytes] = []
+        start = 0
+        while True:
+            nl = buf.find(b"\n", scan)
+            if nl < 0:
+                break
+            if nl - start > self.max_frame:
+                raise FrameTooLarge(f"frame of {nl - start} bytes exceeds {self.max_frame}")
+            if nl > start:
+                frames.append(bytes(buf[start:nl]))
+            start = scan = nl + 1
+        if start:
+            del buf[:start]
+        if len(buf) > self.max_frame:
+            raise FrameTooLarge(f"partial frame of {len(buf)} bytes exceeds {self.max_frame}")
+        return frames
+
+    def pending(self) -> int:
+        """Số byte của dòng chưa hoàn chỉnh đang được đệm."""
+        return len(self._buf)
+
+    def take_rest(self) -> bytes:
+        """Lấy ra (và xoá) phần byte còn đệm, vd khi kết nối chuyển sang frame nhị phân sau HELLO."""
+        rest = bytes(self._buf)
+        self._buf.clear()
+        return rest
+
+
+class LengthFramer:
+    """
+    Tách luồng frame có tiền tố độ dài (u32 big-endian + thân), dùng cho tools/binproto.py.
+    feed() trả về các thân frame hoàn chỉnh; frame khai báo dài hơn max_frame gây FrameTooLarge.
+    """
+
+    def __init__(self, max_frame: int = 1 << 20) -> None:
+        self.max_frame = max_frame
+        self._buf = bytearray()
+
+    def feed(self, data: bytes) -> list[bytes]:
+        buf = self._buf
+        buf += data
+        frames: list[bytes] = []
+        pos = 0
+        end = len(buf)
+        while end - pos >= 4:
+            n = int.from_bytes(buf[pos:pos + 4], "big")
+            if n > self.max_frame:
+                raise FrameTooLarge(f"frame of {n} bytes exceeds {self.max_frame}")
+            if end - pos - 4 < n:
+                break
+            frames.append(bytes(buf[pos + 4:pos + 4 + n]))
+            pos += 4 + n
+        if pos:
+            del buf[:pos]
+        return frames
+
+    def pending(self) -> int:
+        return len(self._buf)
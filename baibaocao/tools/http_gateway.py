@@ -1,23 +1,35 @@
 # tools/http_gateway.py
-import json
 import os
 import socket
+import sys
 import threading
 import time
 import uuid
 from http.server import HTTPServer, SimpleHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools import binproto, codec
+from tools.framing import FrameTooLarge, LengthFramer, LineFramer
+
 
 HOST, PORT = "127.0.0.1", 8080
 MOCK_HOST, MOCK_PORT = "127.0.0.1", 5555
+# longest backend line accepted; history pages can be much larger than a single request
+MAX_FRAME = 64 << 20
+# wire format asked of the backend with HELLO: "json" (default) or "bin1" (tools/binproto.py)
+BACKEND_WIRE = os.environ.get("CHAT_WIRE", "json")
 
 
 class Session:
     def __init__(self) -> None:
         self.lock = threading.Lock()
         self.sock: socket.socket | None = None
-        self.recv_buf = b""
+        self.framer: LineFramer | LengthFramer = LineFramer(MAX_FRAME)
+        self.encode = codec.encode_line
+        self.decode = codec.loads
+        self.rx_rest = b""
         self.queue_lock = threading.Lock()
         self.queue: list[dict] = []
         self.pending_lock = threading.Lock()
@@ -31,6 +43,12 @@ class Session:
                 return
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.connect((MOCK_HOST, MOCK_PORT))
+            if BACKEND_WIRE != "json":
+                fmt, rest = binproto.negotiate(s, BACKEND_WIRE)
+                if fmt == binproto.FORMAT:
+                    self.framer = LengthFramer(MAX_FRAME)
+                    self.encode, self.decode = binproto.encode_frame, binproto.decode
+                    self.rx_rest = rest  # bytes that arrived right after HELLO_OK
             self.sock = s
             t = threading.Thread(target=self._reader_loop, daemon=True)
             t.start()
@@ -40,17 +58,18 @@ class Session:
         s = self.sock
         try:
             while True:
-                data = s.recv(4096)
+                data, self.rx_rest = self.rx_rest or s.recv(65536), b""
                 if not data:
                     break
-                self.recv_buf += data
-                while b"\n" in self.recv_buf:
-                    line, self.recv_buf = self.recv_buf.split(b"\n", 1)
-                    if not line:
-                        continue
+                try:
+                    frames = self.framer.feed(data)
+                except FrameTooLarge as e:
+                    print(f"Dropping backend connection: {e}")
+                    break
+                for frame in frames:
                     try:
-                        msg = json.loads(line.decode())
-                    except json.JSONDecodeError:
+                        msg = self.decode(frame)
+                    except ValueError:
                         continue
                     # push to poll queue
                     with self.queue_lock:
@@ -78,6 +97,7 @@ _SESS_LOCK = threading.Lock()
 _EXPECTED_BY_REQUEST = {
     "AUTH_LOGIN": {"AUTH_OK", "AUTH_FAIL"},
     "AUTH_REGISTER": {"AUTH_OK", "AUTH_FAIL"},
+    "AUTH_RESUME": {"AUTH_OK", "AUTH_FAIL"},
     "FRIEND_REQUEST": {"FRIEND_REQUEST_SENT", "ERROR"},
     "FRIEND_ACCEPT": {"FRIEND_ACCEPTED", "ERROR"},
     "FRIEND_LIST": {"FRIEND_LIST_RESULT", "ERROR"},
@@ -99,6 +119,10 @@ _EXPECTED_BY_REQUEST = {
     "GROUP_MSG_SEND": {"GROUP_MSG_RECV", "ERROR"},
     "MSG_RECALL": {"MSG_RECALL_UPDATE", "ERROR"},
     "MSG_REACT": {"MSG_REACT_UPDATE", "ERROR"},
+    "BATCH": {"BATCH_RESULT", "ERROR"},
+    # the first chunk answers the request, later chunks (has_more) arrive through /api/poll
+    "SYNC": {"SYNC_RESULT", "ERROR"},
+    "CONV_LIST": {"CONV_LIST_RESULT", "ERROR"},
 }
 
 
@@ -113,7 +137,7 @@ def get_session(sid: str) -> Session:
 
 class Handler(SimpleHTTPRequestHandler):
     def _send_json(self, code: int, obj):
-        payload = json.dumps(obj).encode()
+        payload = codec.dumps(obj)
         self.send_response(code)
         self.send_header("Content-Type", "application/json")
         self.send_header("Content-Length", str(len(payload)))
@@ -169,7 +193,7 @@ class Handler(SimpleHTTPRequestHandler):
             length = int(self.headers.get("Content-Length", "0"))
             body = self.rfile.read(length) if length > 0 else b"{}"
             try:
-                obj = json.loads(body.decode())
+                obj = codec.loads(body)
             except Exception:
                 self._send_json(400, {"error": "bad_json"})
                 return
@@ -191,10 +215,10 @@ class Handler(SimpleHTTPRequestHandler):
         with sess.pending_lock:
             sess.pending.append(entry)
         try:
-            line = (json.dumps(request) + "\n").encode()
+            frame = sess.encode(request)
             with sess.lock:
                 assert sess.sock is not None
-                sess.sock.sendall(line)
+                sess.sock.sendall(frame)
             if entry["event"].wait(timeout=5.0):
                 return entry["response"] or {"type": "ERROR", "data": {"code": "EMPTY"}}
             raise Exception("Request timeout")
@@ -1,19 +1,28 @@
 # tools/mock_server.py
-import socket, threading, json, hashlib, time
+import socket, threading, hashlib, time, os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools import codec
+from tools.dispatch import Registry
+from tools.framing import FrameTooLarge, LineFramer
+from tools.records import Message
 
 HOST, PORT = "127.0.0.1", 5555
+MAX_FRAME = 1 << 20  # longest accepted request line, in bytes
 
 # users
-_users = {}         # username -> {"password_hash":..., "user_id":...}
+_users = {}         # username -> {"password_hash":..., "user_id":..., "username":...}
+_users_by_id = {}   # user_id -> same record as in _users
 _user_conns = {}    # user_id -> socket
 _next_uid = 1
 _lock = threading.Lock()
 
 # messages (share for 1-1 and group)
-# record 1-1: {"id", "from_user_id", "to_user_id", "content", "created_at", "reply_to_id", "recalled", "seen_by": set(), "reactions": {emoji: set(uids)}}
-# record group: {"id", "group_id", "from_user_id", "content", "created_at", "reply_to_id", "recalled", "seen_by": set(), "reactions": {...}}
+# records are tools.records.Message (1-1: group_id None, group: to_user_id None)
 _messages = []
 _next_msg_id = 1
+_last_read = {}         # (user_id, ("dm", a, b) | ("group", gid)) -> id of the last message read
 _msg_lock = threading.Lock()
 
 # friends
@@ -29,6 +38,7 @@ _blk_lock = threading.Lock()
 # groups
 _groups = {}            # group_id -> {"name": str, "owner_id": int, "avatar": str|None}
 _group_members = {}     # group_id -> set(user_id)
+_user_groups = {}       # user_id -> set(group_id), reverse of _group_members
 _next_gid = 1
 _grp_lock = threading.Lock()
 
@@ -43,7 +53,7 @@ def _hash(pw: str) -> str:
 
 def _send(conn, obj: dict):
     try:
-        conn.sendall((json.dumps(obj) + "\n").encode())
+        conn.sendall(codec.encode_line(obj))
     except Exception:
         pass
 
@@ -53,28 +63,32 @@ def _broadcast_to_user(user_id: int, obj: dict):
         _send(conn, obj)
 
 def _username_of(uid: int) -> str:
-    for uname, rec in _users.items():
-        if rec["user_id"] == uid:
-            return uname
-    return f"user_{uid}"
+    rec = _users_by_id.get(uid)
+    return rec["username"] if rec else f"user_{uid}"
 
 def _group_member_count(gid: int) -> int:
     return len(_group_members.get(gid, set()))
 
+def _add_group_member(gid: int, uid: int):
+    # caller holds _grp_lock
+    _group_members.setdefault(gid, set()).add(uid)
+    _user_groups.setdefault(uid, set()).add(gid)
+
+def _groups_of(uid: int) -> list:
+    return [{"group_id": gid, "name": _groups[gid]["name"], "member_count": _group_member_count(gid)}
+            for gid in sorted(_user_groups.get(uid, set()))]
+
 def _find_msg(mid: int):
     for m in _messages:
-        if m["id"] == mid:
+        if m.id == mid:
             return m
     return None
 
 def _reactions_summary(rec):
-    return {k: len(v) for k, v in rec.get("reactions", {}).items()}
+    return rec.reactions_summary()
 
 def _user_exists(uid: int) -> bool:
-    for uname, rec in _users.items():
-        if rec.get("user_id") == uid:
-            return True
-    return False
+    return uid in _users_by_id
 
 def _to_int(val):
     try:
@@ -83,500 +97,553 @@ def _to_int(val):
         return val
 
 
-def _route(conn, session: dict, msg: dict):
-    global _next_uid, _next_msg_id, _next_req_id, _next_gid, _next_ginv_id
-    typ = msg.get("type")
-    data = msg.get("data") or {}
-
-    # ---- ping ----
-    if typ == "PING":
-        _send(conn, {"type": "PONG", "data": {}})
-        return
-
-    # ---- auth ----
-    if typ == "AUTH_REGISTER":
-        u, p = data.get("username"), data.get("password")
-        if not u or not p:
-            _send(conn, {"type": "AUTH_FAIL", "data": {"reason": "missing_fields"}}); return
-        with _lock:
-            if u in _users:
-                _send(conn, {"type": "AUTH_FAIL", "data": {"reason": "user_exists"}}); return
-            _users[u] = {"password_hash": _hash(p), "user_id": _next_uid}
-            _friendships[_next_uid] = set()
-            _next_uid += 1
-        uid = _users[u]["user_id"]
-        _send(conn, {"type": "AUTH_OK", "data": {"username": u, "user_id": uid}})
-        return
-
-    if typ == "AUTH_LOGIN":
-        u, p = data.get("username"), data.get("password")
-        rec = _users.get(u)
-        if not rec or rec["password_hash"] != _hash(p):
-            _send(conn, {"type": "AUTH_FAIL", "data": {"reason": "invalid_credentials"}}); return
-        session["user_id"] = rec["user_id"]; session["username"] = u
-        _user_conns[rec["user_id"]] = conn
-        _send(conn, {"type": "AUTH_OK", "data": {"username": u, "user_id": rec["user_id"]}})
-        return
-
-    # ---- guard ----
-    if not session.get("user_id"):
-        _send(conn, {"type": "ERROR", "data": {"code": "UNAUTH"}})
-        return
+_HANDLERS = Registry()
+
+
+# ---- ping ----
+@_HANDLERS.on("PING", auth=False)
+def _on_ping(session: dict, conn, data: dict):
+    _send(conn, {"type": "PONG", "data": {}})
+
+
+# ---- auth ----
+@_HANDLERS.on("AUTH_REGISTER", auth=False)
+def _on_auth_register(session: dict, conn, data: dict):
+    global _next_uid
+    u, p = data.get("username"), data.get("password")
+    if not u or not p:
+        _send(conn, {"type": "AUTH_FAIL", "data": {"reason": "missing_fields"}}); return
+    with _lock:
+        if u in _users:
+            _send(conn, {"type": "AUTH_FAIL", "data": {"reason": "user_exists"}}); return
+        _users[u] = {"password_hash": _hash(p), "user_id": _next_uid, "username": u}
+        _users_by_id[_next_uid] = _users[u]
+        _friendships[_next_uid] = set()
+        _next_uid += 1
+    uid = _users[u]["user_id"]
+    _send(conn, {"type": "AUTH_OK", "data": {"username": u, "user_id": uid}})
+
+
+@_HANDLERS.on("AUTH_LOGIN", auth=False)
+def _on_auth_login(session: dict, conn, data: dict):
+    u, p = data.get("username"), data.get("password")
+    rec = _users.get(u)
+    if not rec or rec["password_hash"] != _hash(p):
+        _send(conn, {"type": "AUTH_FAIL", "data": {"reason": "invalid_credentials"}}); return
+    session["user_id"] = rec["user_id"]; session["username"] = u
+    _user_conns[rec["user_id"]] = conn
+    _send(conn, {"type": "AUTH_OK", "data": {"username": u, "user_id": rec["user_id"]}})
+
+
+# ---- friends ----
+@_HANDLERS.on("FRIEND_REQUEST")
+def _on_friend_request(session: dict, conn, data: dict):
+    global _next_req_id
     me = session["user_id"]
-
-    # ---- friends ----
-    if typ == "FRIEND_REQUEST":
-        to_uid = _to_int(data.get("to_user_id"))
-        if not isinstance(to_uid, int) or to_uid == me:
-            _send(conn, {"type": "ERROR", "data": {"code": "BAD_FRIEND_REQUEST"}}); return
-        with _req_lock:
-            req_id = _next_req_id; _next_req_id += 1
-            _friend_requests.append({"id": req_id, "from_user_id": me, "to_user_id": to_uid, "status": "pending"})
-        _send(conn, {"type": "FRIEND_REQUEST_SENT", "data": {"request_id": req_id, "to_user_id": to_uid}})
-        _broadcast_to_user(to_uid, {"type": "FRIEND_REQUEST_INCOMING",
-                                    "data": {"request_id": req_id, "from_user_id": me,
-                                             "from_username": _username_of(me)}})
-        return
-
-    if typ == "FRIEND_ACCEPT":
-        req_id = data.get("request_id")
-        with _req_lock:
-            req = next((r for r in _friend_requests if r["id"] == req_id), None)
-            if not req or req["to_user_id"] != me or req["status"] != "pending":
-                _send(conn, {"type": "ERROR", "data": {"code": "BAD_FRIEND_ACCEPT"}}); return
-            req["status"] = "accepted"
-        a, b = req["from_user_id"], req["to_user_id"]
-        _friendships.setdefault(a, set()).add(b)
-        _friendships.setdefault(b, set()).add(a)
-        payload = {"type": "FRIEND_ACCEPTED", "data": {"user_id1": a, "user_id2": b}}
-        _send(conn, payload)
-        _broadcast_to_user(a, payload)
-        # Push updated friend lists to both participants so UI can refresh without manual fetch
-        for u in (a, b):
-            friends = [{"user_id": uid, "username": _username_of(uid), "status": "accepted"}
-                       for uid in sorted(_friendships.get(u, set()))]
-            with _req_lock:
-                pending_in = [{"request_id": r["id"], "from_user_id": r["from_user_id"],
-                               "from_username": _username_of(r["from_user_id"])}
-                              for r in _friend_requests if r["to_user_id"] == u and r["status"] == "pending"]
-                pending_out = [{"request_id": r["id"], "to_user_id": r["to_user_id"],
-                                "to_username": _username_of(r["to_user_id"])}
-                               for r in _friend_requests if r["from_user_id"] == u and r["status"] == "pending"]
-            _broadcast_to_user(u, {"type": "FRIEND_LIST_RESULT",
-                                   "data": {"friends": friends, "pending_in": pending_in, "pending_out": pending_out}})
-        return
-
-    if typ == "FRIEND_LIST":
+    to_uid = _to_int(data.get("to_user_id"))
+    if not isinstance(to_uid, int) or to_uid == me:
+        _send(conn, {"type": "ERROR", "data": {"code": "BAD_FRIEND_REQUEST"}}); return
+    with _req_lock:
+        req_id = _next_req_id; _next_req_id += 1
+        _friend_requests.append({"id": req_id, "from_user_id": me, "to_user_id": to_uid, "status": "pending"})
+    _send(conn, {"type": "FRIEND_REQUEST_SENT", "data": {"request_id": req_id, "to_user_id": to_uid}})
+    _broadcast_to_user(to_uid, {"type": "FRIEND_REQUEST_INCOMING",
+                                "data": {"request_id": req_id, "from_user_id": me,
+                                         "from_username": _username_of(me)}})
+
+
+@_HANDLERS.on("FRIEND_ACCEPT")
+def _on_friend_accept(session: dict, conn, data: dict):
+    me = session["user_id"]
+    req_id = data.get("request_id")
+    with _req_lock:
+        req = next((r for r in _friend_requests if r["id"] == req_id), None)
+        if not req or req["to_user_id"] != me or req["status"] != "pending":
+            _send(conn, {"type": "ERROR", "data": {"code": "BAD_FRIEND_ACCEPT"}}); return
+        req["status"] = "accepted"
+    a, b = req["from_user_id"], req["to_user_id"]
+    _friendships.setdefault(a, set()).add(b)
+    _friendships.setdefault(b, set()).add(a)
+    payload = {"type": "FRIEND_ACCEPTED", "data": {"user_id1": a, "user_id2": b}}
+    _send(conn, payload)
+    _broadcast_to_user(a, payload)
+    # Push updated friend lists to both participants so UI can refresh without manual fetch
+    for u in (a, b):
         friends = [{"user_id": uid, "username": _username_of(uid), "status": "accepted"}
-                   for uid in sorted(_friendships.get(me, set()))]
+                   for uid in sorted(_friendships.get(u, set()))]
         with _req_lock:
             pending_in = [{"request_id": r["id"], "from_user_id": r["from_user_id"],
                            "from_username": _username_of(r["from_user_id"])}
-                          for r in _friend_requests if r["to_user_id"] == me and r["status"] == "pending"]
+                          for r in _friend_requests if r["to_user_id"] == u and r["status"] == "pending"]
             pending_out = [{"request_id": r["id"], "to_user_id": r["to_user_id"],
                             "to_username": _username_of(r["to_user_id"])}
-                           for r in _friend_requests if r["from_user_id"] == me and r["status"] == "pending"]
-        _send(conn, {"type": "FRIEND_LIST_RESULT",
-                     "data": {"friends": friends, "pending_in": pending_in, "pending_out": pending_out}})
-        return
-
-    if typ == "FRIEND_BLOCK":
-        uid = data.get("user_id")
-        if not isinstance(uid, int) or uid == me:
-            _send(conn, {"type": "ERROR", "data": {"code": "BAD_BLOCK"}}); return
-        with _blk_lock:
-            _blocked.add((me, uid))
-        _send(conn, {"type": "FRIEND_BLOCKED", "data": {"user_id": uid}})
-        return
-
-    if typ == "FRIEND_UNBLOCK":
-        uid = data.get("user_id")
-        with _blk_lock:
-            _blocked.discard((me, uid))
-        _send(conn, {"type": "FRIEND_UNBLOCKED", "data": {"user_id": uid}})
-        return
+                           for r in _friend_requests if r["from_user_id"] == u and r["status"] == "pending"]
+        _broadcast_to_user(u, {"type": "FRIEND_LIST_RESULT",
+                               "data": {"friends": friends, "pending_in": pending_in, "pending_out": pending_out}})
 
-    # ---- messaging 1-1 ----
-    if typ == "MSG_SEND":
-        to_uid = data.get("to_user_id")
-        content = (data.get("content") or "").strip()
-        reply_to_id = data.get("reply_to_id")
-        if not to_uid or not content:
-            _send(conn, {"type": "ERROR", "data": {"code": "BAD_MSG"}}); return
-        with _blk_lock:
-            if (to_uid, me) in _blocked:   # người nhận đã block người gửi
-                _send(conn, {"type": "ERROR", "data": {"code": "BLOCKED_BY_PEER"}}); return
-        with _msg_lock:
-            mid = _next_msg_id; _next_msg_id += 1
-            rec = {"id": mid, "from_user_id": me, "to_user_id": to_uid,
-                   "content": content, "created_at": time.time(), "reply_to_id": reply_to_id,
-                   "recalled": False, "seen_by": set(), "reactions": {}}
-            _messages.append(rec)
-        payload = {"type": "MSG_RECV",
-                   "data": {"message_id": rec["id"], "from_user_id": me, "to_user_id": to_uid,
-                            "content": content, "created_at": rec["created_at"], "reply_to_id": reply_to_id,
-                            "recalled": False, "reactions_summary": {}}}
-        _send(conn, payload)
-        _broadcast_to_user(to_uid, payload)
-        return
-
-    if typ == "MSG_HISTORY":
-        peer_id = data.get("peer_id"); before_id = data.get("before_id"); limit = int(data.get("limit") or 50)
-        with _msg_lock:
-            conv = [m for m in _messages if ("group_id" not in m) and
-                   ((m["from_user_id"] == me and m["to_user_id"] == peer_id) or
-                    (m["from_user_id"] == peer_id and m["to_user_id"] == me))]
-            conv.sort(key=lambda x: x["id"], reverse=True)
-            if before_id:
-                conv = [m for m in conv if m["id"] < before_id]
-            batch = conv[:limit]; has_more = len(conv) > limit
-            batch_sorted = sorted(batch, key=lambda x: x["id"])
-            res = {"peer_id": peer_id,
-                   "messages": [{"message_id": m["id"], "from_user_id": m["from_user_id"], "to_user_id": m["to_user_id"],
-                                 "content": m["content"], "created_at": m["created_at"], "reply_to_id": m.get("reply_to_id"),
-                                 "recalled": m.get("recalled", False), "reactions_summary": _reactions_summary(m)}
-                                for m in batch_sorted],
-                   "has_more": has_more}
-        _send(conn, {"type": "MSG_HISTORY_RESULT", "data": res})
-        return
 
-    # ---- groups ----
-    if typ == "GROUP_CREATE":
-        name = (data.get("name") or "").strip()
-        avatar = data.get("avatar")
-        if not name:
-            _send(conn, {"type": "ERROR", "data": {"code": "BAD_GROUP_NAME"}}); return
-        with _grp_lock:
-            gid = _next_gid; _next_gid += 1
-            _groups[gid] = {"name": name, "owner_id": me, "avatar": avatar}
-            _group_members[gid] = {me}
-        _send(conn, {"type": "GROUP_CREATED", "data": {"group_id": gid, "name": name}})
-        return
+@_HANDLERS.on("FRIEND_LIST")
+def _on_friend_list(session: dict, conn, data: dict):
+    me = session["user_id"]
+    friends = [{"user_id": uid, "username": _username_of(uid), "status": "accepted"}
+               for uid in sorted(_friendships.get(me, set()))]
+    with _req_lock:
+        pending_in = [{"request_id": r["id"], "from_user_id": r["from_user_id"],
+                       "from_username": _username_of(r["from_user_id"])}
+                      for r in _friend_requests if r["to_user_id"] == me and r["status"] == "pending"]
+        pending_out = [{"request_id": r["id"], "to_user_id": r["to_user_id"],
+                        "to_username": _username_of(r["to_user_id"])}
+                       for r in _friend_requests if r["from_user_id"] == me and r["status"] == "pending"]
+    _send(conn, {"type": "FRIEND_LIST_RESULT",
+                 "data": {"friends": friends, "pending_in": pending_in, "pending_out": pending_out}})
+
+
+@_HANDLERS.on("FRIEND_BLOCK")
+def _on_friend_block(session: dict, conn, data: dict):
+    me = session["user_id"]
+    uid = data.get("user_id")
+    if not isinstance(uid, int) or uid == me:
+        _send(conn, {"type": "ERROR", "data": {"code": "BAD_BLOCK"}}); return
+    with _blk_lock:
+        _blocked.add((me, uid))
+    _send(conn, {"type": "FRIEND_BLOCKED", "data": {"user_id": uid}})
 
-    if typ == "GROUP_ADD":
-        # Interpret GROUP_ADD as sending an invitation instead of immediate join
-        gid = data.get("group_id"); uid = data.get("user_id")
-        info = _groups.get(gid)
-        if not info or info["owner_id"] != me or not isinstance(uid, int):
-            print(f"[GROUP_ADD] BAD_GROUP_ADD by {me}: gid={gid}, uid={uid}, info_ok={bool(info)} owner_ok={info and info['owner_id']==me}")
-            _send(conn, {"type": "ERROR", "data": {"code": "BAD_GROUP_ADD"}}); return
-        if not _user_exists(uid):
-            _send(conn, {"type": "ERROR", "data": {"code": "USER_NOT_FOUND"}}); return
-        if uid in _group_members.get(gid, set()):
-            _send(conn, {"type": "ERROR", "data": {"code": "ALREADY_MEMBER"}}); return
-        with _ginv_lock:
-            existing = next((r for r in _group_invites if r["group_id"] == gid and r["to_user_id"] == uid and r["status"] == "pending"), None)
-            if existing:
-                inv_id = existing["id"]
-                print(f"[GROUP_INVITE] reuse pending invite_id={inv_id} gid={gid} from={me} to={uid}")
-            else:
-                inv_id = _next_ginv_id
-                _next_ginv_id += 1
-                _group_invites.append({
-                    "id": inv_id,
-                    "group_id": gid,
-                    "from_user_id": me,
-                    "to_user_id": uid,
-                    "status": "pending"
-                })
-                print(f"[GROUP_INVITE] created invite_id={inv_id} gid={gid} from={me} to={uid}")
-        # notify owner (sender) event (no auto list refresh here)
-        payload_sender = {"type": "GROUP_INVITE_SENT",
-                          "data": {"invite_id": inv_id, "group_id": gid, "to_user_id": uid}}
-        _send(conn, payload_sender)
-        print(f"[GROUP_INVITE] sent to sender {me}: {payload_sender}")
-        # notify invitee (new + legacy)
-        payload_invitee = {"type": "GROUP_INVITE_INCOMING",
-                           "data": {"invite_id": inv_id, "group_id": gid,
-                                     "group_name": info["name"],
-                                     "from_user_id": me, "from_username": _username_of(me)}}
-        _broadcast_to_user(uid, payload_invitee)
-        legacy_inv = {"type": "GROUP_INVITATION",
-                      "data": {"group_id": gid, "group_name": info["name"], "from_user_id": me}}
-        _broadcast_to_user(uid, legacy_inv)
-        print(f"[GROUP_INVITE] incoming pushed to {uid}: {payload_invitee} and legacy {legacy_inv}")
-        return
 
-    if typ == "GROUP_INVITE_LIST":
-        # Return pending invites for current user
-        with _ginv_lock:
-            incoming = [{"invite_id": r["id"], "group_id": r["group_id"], "from_user_id": r["from_user_id"],
-                         "from_username": _username_of(r["from_user_id"]),
-                         "group_name": _groups.get(r["group_id"], {}).get("name")}
-                        for r in _group_invites if r["to_user_id"] == me and r["status"] == "pending"]
-            outgoing = [{"invite_id": r["id"], "group_id": r["group_id"], "to_user_id": r["to_user_id"],
-                         "to_username": _username_of(r["to_user_id"]),
-                         "group_name": _groups.get(r["group_id"], {}).get("name")}
-                        for r in _group_invites if r["from_user_id"] == me and r["status"] == "pending"]
-        _send(conn, {"type": "GROUP_INVITE_LIST_RESULT", "data": {"incoming": incoming, "outgoing": outgoing}})
-        return
+@_HANDLERS.on("FRIEND_UNBLOCK")
+def _on_friend_unblock(session: dict, conn, data: dict):
+    me = session["user_id"]
+    uid = data.get("user_id")
+    with _blk_lock:
+        _blocked.discard((me, uid))
+    _send(conn, {"type": "FRIEND_UNBLOCKED", "data": {"user_id": uid}})
 
-    if typ == "GROUP_INVITE_ACCEPT":
-        inv_id = data.get("invite_id"); gid = data.get("group_id"); gname = data.get("group_name")
-        created_from_fallback = False
-        # Resolve by invite_id, group_id or group_name; if nothing given and only one pending -> pick it
-        with _ginv_lock:
-            # Try by invite_id/group_id first
-            inv = next((r for r in _group_invites if r["status"] == "pending" and r["to_user_id"] == me and
-                        ((inv_id and r["id"] == inv_id) or (not inv_id and gid and r["group_id"] == gid))), None)
-            # Try by group_name
-            if not inv and gname:
-                inv = next((r for r in _group_invites if r["status"] == "pending" and r["to_user_id"] == me and
-                            _groups.get(r["group_id"], {}).get("name") == gname), None)
-            # If still not found and no identifiers -> pick single pending if unique
-            if not inv and not inv_id and not gid and not gname:
-                pending = [r for r in _group_invites if r["status"] == "pending" and r["to_user_id"] == me]
-                inv = pending[0] if len(pending) == 1 else None
-            # If we have a valid group_id but no pending invite -> accept anyway (fallback)
-            if not inv and (gid or gname):
-                if not gid and gname:
-                    # resolve gid from group name (best effort)
-                    for _gid, g in _groups.items():
-                        if g.get("name") == gname:
-                            gid = _gid; break
-                if gid in _groups:
-                    created_from_fallback = True
-                    inv = {"id": 0, "group_id": gid, "from_user_id": _groups.get(gid, {}).get("owner_id", 0)}
-            elif inv:
-                inv["status"] = "accepted"
-            else:
-                _send(conn, {"type": "ERROR", "data": {"code": "BAD_GROUP_INVITE_ACCEPT"}}); return
-        gid = inv["group_id"]
-        if gid not in _groups:
-            _send(conn, {"type": "ERROR", "data": {"code": "BAD_GROUP"}}); return
-        with _grp_lock:
-            _group_members.setdefault(gid, set()).add(me)
-            members = list(_group_members.get(gid, set()))
-        # notify both sides (new event)
-        payload = {"type": "GROUP_INVITE_ACCEPTED", "data": {"invite_id": inv.get("id", 0), "group_id": gid, "user_id": me, "fallback": created_from_fallback}}
-        _send(conn, payload)
-        if inv.get("from_user_id"):
-            _broadcast_to_user(inv["from_user_id"], payload)
-        # legacy convenience: push updated group lists to all members so member_count syncs
-        for uid2 in members:
-            mine = [{"group_id": k, "name": v["name"], "member_count": len(_group_members.get(k, set()))}
-                    for k, v in _groups.items() if uid2 in _group_members.get(k, set())]
-            _broadcast_to_user(uid2, {"type": "GROUP_LIST_RESULT", "data": {"groups": mine}})
-        return
 
-    if typ == "GROUP_INVITE_DECLINE":
-        inv_id = data.get("invite_id"); gid = data.get("group_id"); gname = data.get("group_name")
-        with _ginv_lock:
-            # resolve invite by id or group_id
+# ---- messaging 1-1 ----
+@_HANDLERS.on("MSG_SEND")
+def _on_msg_send(session: dict, conn, data: dict):
+    global _next_msg_id
+    me = session["user_id"]
+    to_uid = data.get("to_user_id")
+    content = (data.get("content") or "").strip()
+    reply_to_id = data.get("reply_to_id")
+    if not to_uid or not content:
+        _send(conn, {"type": "ERROR", "data": {"code": "BAD_MSG"}}); return
+    with _blk_lock:
+        if (to_uid, me) in _blocked:   # người nhận đã block người gửi
+            _send(conn, {"type": "ERROR", "data": {"code": "BLOCKED_BY_PEER"}}); return
+    with _msg_lock:
+        mid = _next_msg_id; _next_msg_id += 1
+        rec = Message(me, content, time.time(), to_user_id=to_uid, reply_to_id=reply_to_id, id=mid)
+        _messages.append(rec)
+    payload = {"type": "MSG_RECV",
+               "data": {"message_id": rec.id, "from_user_id": me, "to_user_id": to_uid,
+                        "content": content, "created_at": rec.created_at, "reply_to_id": reply_to_id,
+                        "recalled": False, "reactions_summary": {}}}
+    _send(conn, payload)
+    _broadcast_to_user(to_uid, payload)
+
+
+@_HANDLERS.on("MSG_HISTORY")
+def _on_msg_history(session: dict, conn, data: dict):
+    me = session["user_id"]
+    peer_id = data.get("peer_id"); before_id = data.get("before_id"); limit = int(data.get("limit") or 50)
+    with _msg_lock:
+        conv = [m for m in _messages if m.group_id is None and
+               ((m.from_user_id == me and m.to_user_id == peer_id) or
+                (m.from_user_id == peer_id and m.to_user_id == me))]
+        conv.sort(key=lambda x: x.id, reverse=True)
+        if before_id:
+            conv = [m for m in conv if m.id < before_id]
+        batch = conv[:limit]; has_more = len(conv) > limit
+        batch_sorted = sorted(batch, key=lambda x: x.id)
+        key = ("dm", min(me, peer_id), max(me, peer_id)) if isinstance(peer_id, int) else None
+        # seen: the recipient's read watermark has reached the message
+        res = {"peer_id": peer_id,
+               "messages": [{"message_id": m.id, "from_user_id": m.from_user_id, "to_user_id": m.to_user_id,
+                             "content": m.content, "created_at": m.created_at, "reply_to_id": m.reply_to_id,
+                             "recalled": m.recalled, "reactions_summary": _reactions_summary(m),
+                             "seen": _last_read.get((m.to_user_id, key), 0) >= m.id}
+                            for m in batch_sorted],
+               "has_more": has_more}
+    _send(conn, {"type": "MSG_HISTORY_RESULT", "data": res})
+
+
+# ---- groups ----
+@_HANDLERS.on("GROUP_CREATE")
+def _on_group_create(session: dict, conn, data: dict):
+    global _next_gid
+    me = session["user_id"]
+    name = (data.get("name") or "").strip()
+    avatar = data.get("avatar")
+    if not name:
+        _send(conn, {"type": "ERROR", "data": {"code": "BAD_GROUP_NAME"}}); return
+    with _grp_lock:
+        gid = _next_gid; _next_gid += 1
+        _groups[gid] = {"name": name, "owner_id": me, "avatar": avatar}
+        _group_members[gid] = set()
+        _add_group_member(gid, me)
+    _send(conn, {"type": "GROUP_CREATED", "data": {"group_id": gid, "name": name}})
+
+
+@_HANDLERS.on("GROUP_ADD")
+def _on_group_add(session: dict, conn, data: dict):
+    global _next_ginv_id
+    me = session["user_id"]
+    # Interpret GROUP_ADD as sending an invitation instead of immediate join
+    gid = data.get("group_id"); uid = data.get("user_id")
+    info = _groups.get(gid)
+    if not info or info["owner_id"] != me or not isinstance(uid, int):
+        print(f"[GROUP_ADD] BAD_GROUP_ADD by {me}: gid={gid}, uid={uid}, info_ok={bool(info)} owner_ok={info and info['owner_id']==me}")
+        _send(conn, {"type": "ERROR", "data": {"code": "BAD_GROUP_ADD"}}); return
+    if not _user_exists(uid):
+        _send(conn, {"type": "ERROR", "data": {"code": "USER_NOT_FOUND"}}); return
+    if uid in _group_members.get(gid, set()):
+        _send(conn, {"type": "ERROR", "data": {"code": "ALREADY_MEMBER"}}); return
+    with _ginv_lock:
+        existing = next((r for r in _group_invites if r["group_id"] == gid and r["to_user_id"] == uid and r["status"] == "pending"), None)
+        if existing:
+            inv_id = existing["id"]
+            print(f"[GROUP_INVITE] reuse pending invite_id={inv_id} gid={gid} from={me} to={uid}")
+        else:
+            inv_id = _next_ginv_id
+            _next_ginv_id += 1
+            _group_invites.append({
+                "id": inv_id,
+                "group_id": gid,
+                "from_user_id": me,
+                "to_user_id": uid,
+                "status": "pending"
+            })
+            print(f"[GROUP_INVITE] created invite_id={inv_id} gid={gid} from={me} to={uid}")
+    # notify owner (sender) event (no auto list refresh here)
+    payload_sender = {"type": "GROUP_INVITE_SENT",
+                      "data": {"invite_id": inv_id, "group_id": gid, "to_user_id": uid}}
+    _send(conn, payload_sender)
+    print(f"[GROUP_INVITE] sent to sender {me}: {payload_sender}")
+    # notify invitee (new + legacy)
+    payload_invitee = {"type": "GROUP_INVITE_INCOMING",
+                       "data": {"invite_id": inv_id, "group_id": gid,
+                                 "group_name": info["name"],
+                                 "from_user_id": me, "from_username": _username_of(me)}}
+    _broadcast_to_user(uid, payload_invitee)
+    legacy_inv = {"type": "GROUP_INVITATION",
+                  "data": {"group_id": gid, "group_name": info["name"], "from_user_id": me}}
+    _broadcast_to_user(uid, legacy_inv)
+    print(f"[GROUP_INVITE] incoming pushed to {uid}: {payload_invitee} and legacy {legacy_inv}")
+
+
+@_HANDLERS.on("GROUP_INVITE_LIST")
+def _on_group_invite_list(session: dict, conn, data: dict):
+    me = session["user_id"]
+    # Return pending invites for current user
+    with _ginv_lock:
+        incoming = [{"invite_id": r["id"], "group_id": r["group_id"], "from_user_id": r["from_user_id"],
+                     "from_username": _username_of(r["from_user_id"]),
+                     "group_name": _groups.get(r["group_id"], {}).get("name")}
+                    for r in _group_invites if r["to_user_id"] == me and r["status"] == "pending"]
+        outgoing = [{"invite_id": r["id"], "group_id": r["group_id"], "to_user_id": r["to_user_id"],
+                     "to_username": _username_of(r["to_user_id"]),
+                     "group_name": _groups.get(r["group_id"], {}).get("name")}
+                    for r in _group_invites if r["from_user_id"] == me and r["status"] == "pending"]
+    _send(conn, {"type": "GROUP_INVITE_LIST_RESULT", "data": {"incoming": incoming, "outgoing": outgoing}})
+
+
+@_HANDLERS.on("GROUP_INVITE_ACCEPT")
+def _on_group_invite_accept(session: dict, conn, data: dict):
+    me = session["user_id"]
+    inv_id = data.get("invite_id"); gid = data.get("group_id"); gname = data.get("group_name")
+    created_from_fallback = False
+    # Resolve by invite_id, group_id or group_name; if nothing given and only one pending -> pick it
+    with _ginv_lock:
+        # Try by invite_id/group_id first
+        inv = next((r for r in _group_invites if r["status"] == "pending" and r["to_user_id"] == me and
+                    ((inv_id and r["id"] == inv_id) or (not inv_id and gid and r["group_id"] == gid))), None)
+        # Try by group_name
+        if not inv and gname:
             inv = next((r for r in _group_invites if r["status"] == "pending" and r["to_user_id"] == me and
-                        ((inv_id and r["id"] == inv_id) or (not inv_id and gid and r["group_id"] == gid))), None)
-            # try by group_name
-            if not inv and gname:
-                inv = next((r for r in _group_invites if r["status"] == "pending" and r["to_user_id"] == me and
-                            _groups.get(r["group_id"], {}).get("name") == gname), None)
-            # if no identifiers and exactly one pending -> choose it
-            if not inv and not inv_id and not gid and not gname:
-                pending = [r for r in _group_invites if r["status"] == "pending" and r["to_user_id"] == me]
-                inv = pending[0] if len(pending) == 1 else None
-            if not inv and (gid or gname):
-                # Fallback: no pending but have group identifier -> treat as declined (no-op)
-                if not gid and gname:
-                    for _gid, g in _groups.items():
-                        if g.get("name") == gname:
-                            gid = _gid; break
-                payload = {"type": "GROUP_INVITE_DECLINED", "data": {"invite_id": 0, "group_id": gid or 0, "user_id": me, "fallback": True}}
-                _send(conn, payload)
-                owner = _groups.get(gid, {}).get("owner_id") if gid else None
-                if owner:
-                    _broadcast_to_user(owner, payload)
-                return
-            if not inv:
-                _send(conn, {"type": "ERROR", "data": {"code": "BAD_GROUP_INVITE_DECLINE"}}); return
-            inv["status"] = "declined"
-        payload = {"type": "GROUP_INVITE_DECLINED", "data": {"invite_id": inv["id"], "group_id": inv["group_id"], "user_id": me}}
-        _send(conn, payload)
-        _broadcast_to_user(inv["from_user_id"], payload)
-        return
-
-    # ----- Legacy compatibility for older web UI -----
-    if typ == "GROUP_ACCEPT_INVITATION":
-        gid = data.get("group_id")
-        with _ginv_lock:
-            inv = next((r for r in _group_invites if r["group_id"] == gid and r["to_user_id"] == me and r["status"] == "pending"), None)
-            if not inv:
-                _send(conn, {"type": "ERROR", "data": {"code": "BAD_GROUP_INVITE_ACCEPT"}}); return
+                        _groups.get(r["group_id"], {}).get("name") == gname), None)
+        # If still not found and no identifiers -> pick single pending if unique
+        if not inv and not inv_id and not gid and not gname:
+            pending = [r for r in _group_invites if r["status"] == "pending" and r["to_user_id"] == me]
+            inv = pending[0] if len(pending) == 1 else None
+        # If we have a valid group_id but no pending invite -> accept anyway (fallback)
+        if not inv and (gid or gname):
+            if not gid and gname:
+                # resolve gid from group name (best effort)
+                for _gid, g in _groups.items():
+                    if g.get("name") == gname:
+                        gid = _gid; break
+            if gid in _groups:
+                created_from_fallback = True
+                inv = {"id": 0, "group_id": gid, "from_user_id": _groups.get(gid, {}).get("owner_id", 0)}
+        elif inv:
             inv["status"] = "accepted"
-        with _grp_lock:
-            _group_members.setdefault(gid, set()).add(me)
-            members = list(_group_members.get(gid, set()))
-        payload = {"type": "GROUP_INVITE_ACCEPTED", "data": {"invite_id": inv["id"], "group_id": gid, "user_id": me}}
-        _send(conn, payload)
+        else:
+            _send(conn, {"type": "ERROR", "data": {"code": "BAD_GROUP_INVITE_ACCEPT"}}); return
+    gid = inv["group_id"]
+    if gid not in _groups:
+        _send(conn, {"type": "ERROR", "data": {"code": "BAD_GROUP"}}); return
+    with _grp_lock:
+        _add_group_member(gid, me)
+        members = list(_group_members.get(gid, set()))
+    # notify both sides (new event)
+    payload = {"type": "GROUP_INVITE_ACCEPTED", "data": {"invite_id": inv.get("id", 0), "group_id": gid, "user_id": me, "fallback": created_from_fallback}}
+    _send(conn, payload)
+    if inv.get("from_user_id"):
         _broadcast_to_user(inv["from_user_id"], payload)
-        for uid2 in members:
-            mine = [{"group_id": k, "name": v["name"], "member_count": len(_group_members.get(k, set()))}
-                    for k, v in _groups.items() if uid2 in _group_members.get(k, set())]
-            _broadcast_to_user(uid2, {"type": "GROUP_LIST_RESULT", "data": {"groups": mine}})
-        return
+    # legacy convenience: push updated group lists to all members so member_count syncs
+    for uid2 in members:
+        _broadcast_to_user(uid2, {"type": "GROUP_LIST_RESULT", "data": {"groups": _groups_of(uid2)}})
 
-    if typ == "GROUP_REJECT_INVITATION":
-        gid = data.get("group_id")
-        with _ginv_lock:
-            inv = next((r for r in _group_invites if r["group_id"] == gid and r["to_user_id"] == me and r["status"] == "pending"), None)
-            if not inv:
-                _send(conn, {"type": "ERROR", "data": {"code": "BAD_GROUP_INVITE_DECLINE"}}); return
-            inv["status"] = "declined"
-        payload = {"type": "GROUP_INVITE_DECLINED", "data": {"invite_id": inv["id"], "group_id": gid, "user_id": me}}
-        _send(conn, payload)
-        _broadcast_to_user(inv["from_user_id"], payload)
-        return
 
-    if typ == "GROUP_LIST":
-        mine = [{"group_id": gid, "name": g["name"], "member_count": len(_group_members.get(gid, set()))}
-                for gid, g in _groups.items() if me in _group_members.get(gid, set())]
-        _send(conn, {"type": "GROUP_LIST_RESULT", "data": {"groups": mine}})
-        return
+@_HANDLERS.on("GROUP_INVITE_DECLINE")
+def _on_group_invite_decline(session: dict, conn, data: dict):
+    me = session["user_id"]
+    inv_id = data.get("invite_id"); gid = data.get("group_id"); gname = data.get("group_name")
+    with _ginv_lock:
+        # resolve invite by id or group_id
+        inv = next((r for r in _group_invites if r["status"] == "pending" and r["to_user_id"] == me and
+                    ((inv_id and r["id"] == inv_id) or (not inv_id and gid and r["group_id"] == gid))), None)
+        # try by group_name
+        if not inv and gname:
+            inv = next((r for r in _group_invites if r["status"] == "pending" and r["to_user_id"] == me and
+                        _groups.get(r["group_id"], {}).get("name") == gname), None)
+        # if no identifiers and exactly one pending -> choose it
+        if not inv and not inv_id and not gid and not gname:
+            pending = [r for r in _group_invites if r["status"] == "pending" and r["to_user_id"] == me]
+            inv = pending[0] if len(pending) == 1 else None
+        if not inv and (gid or gname):
+            # Fallback: no pending but have group identifier -> treat as declined (no-op)
+            if not gid and gname:
+                for _gid, g in _groups.items():
+                    if g.get("name") == gname:
+                        gid = _gid; break
+            payload = {"type": "GROUP_INVITE_DECLINED", "data": {"invite_id": 0, "group_id": gid or 0, "user_id": me, "fallback": True}}
+            _send(conn, payload)
+            owner = _groups.get(gid, {}).get("owner_id") if gid else None
+            if owner:
+                _broadcast_to_user(owner, payload)
+            return
+        if not inv:
+            _send(conn, {"type": "ERROR", "data": {"code": "BAD_GROUP_INVITE_DECLINE"}}); return
+        inv["status"] = "declined"
+    payload = {"type": "GROUP_INVITE_DECLINED", "data": {"invite_id": inv["id"], "group_id": inv["group_id"], "user_id": me}}
+    _send(conn, payload)
+    _broadcast_to_user(inv["from_user_id"], payload)
 
-    if typ == "GROUP_MSG_SEND":
-        gid = data.get("group_id"); content = (data.get("content") or "").strip()
-        reply_to_id = data.get("reply_to_id")
-        if not isinstance(gid, int) or not content:
-            _send(conn, {"type": "ERROR", "data": {"code": "BAD_GROUP_MSG"}}); return
-        if me not in _group_members.get(gid, set()):
-            _send(conn, {"type": "ERROR", "data": {"code": "NOT_GROUP_MEMBER"}}); return
-        with _msg_lock:
-            mid = _next_msg_id; _next_msg_id += 1
-            rec = {"id": mid, "group_id": gid, "from_user_id": me,
-                   "content": content, "created_at": time.time(), "reply_to_id": reply_to_id,
-                   "recalled": False, "seen_by": set(), "reactions": {}}
-            _messages.append(rec)
-        payload = {"type": "GROUP_MSG_RECV",
-                   "data": {"message_id": rec["id"], "group_id": gid, "from_user_id": me,
-                            "content": content, "created_at": rec["created_at"], "reply_to_id": reply_to_id,
-                            "recalled": False, "reactions_summary": {}}}
-        for uid in list(_group_members.get(gid, set())):
-            _broadcast_to_user(uid, payload)
-        return
 
-    if typ == "GROUP_HISTORY":
-        gid = data.get("group_id"); before_id = data.get("before_id"); limit = int(data.get("limit") or 50)
-        if me not in _group_members.get(gid, set()):
-            _send(conn, {"type": "ERROR", "data": {"code": "NOT_GROUP_MEMBER"}}); return
-        with _msg_lock:
-            conv = [m for m in _messages if m.get("group_id") == gid]
-            conv.sort(key=lambda x: x["id"], reverse=True)
-            if before_id:
-                conv = [m for m in conv if m["id"] < before_id]
-            batch = conv[:limit]; has_more = len(conv) > limit
-            batch_sorted = sorted(batch, key=lambda x: x["id"])
-            res = {"group_id": gid,
-                   "messages": [{"message_id": m["id"], "group_id": gid, "from_user_id": m["from_user_id"],
-                                 "content": m["content"], "created_at": m["created_at"], "reply_to_id": m.get("reply_to_id"),
-                                 "recalled": m.get("recalled", False), "reactions_summary": _reactions_summary(m)}
-                                for m in batch_sorted],
-                   "has_more": has_more}
-        _send(conn, {"type": "GROUP_HISTORY_RESULT", "data": res})
-        return
+# ----- Legacy compatibility for older web UI -----
+@_HANDLERS.on("GROUP_ACCEPT_INVITATION")
+def _on_group_accept_invitation(session: dict, conn, data: dict):
+    me = session["user_id"]
+    gid = data.get("group_id")
+    with _ginv_lock:
+        inv = next((r for r in _group_invites if r["group_id"] == gid and r["to_user_id"] == me and r["status"] == "pending"), None)
+        if not inv:
+            _send(conn, {"type": "ERROR", "data": {"code": "BAD_GROUP_INVITE_ACCEPT"}}); return
+        inv["status"] = "accepted"
+    with _grp_lock:
+        _add_group_member(gid, me)
+        members = list(_group_members.get(gid, set()))
+    payload = {"type": "GROUP_INVITE_ACCEPTED", "data": {"invite_id": inv["id"], "group_id": gid, "user_id": me}}
+    _send(conn, payload)
+    _broadcast_to_user(inv["from_user_id"], payload)
+    for uid2 in members:
+        _broadcast_to_user(uid2, {"type": "GROUP_LIST_RESULT", "data": {"groups": _groups_of(uid2)}})
+
+
+@_HANDLERS.on("GROUP_REJECT_INVITATION")
+def _on_group_reject_invitation(session: dict, conn, data: dict):
+    me = session["user_id"]
+    gid = data.get("group_id")
+    with _ginv_lock:
+        inv = next((r for r in _group_invites if r["group_id"] == gid and r["to_user_id"] == me and r["status"] == "pending"), None)
+        if not inv:
+            _send(conn, {"type": "ERROR", "data": {"code": "BAD_GROUP_INVITE_DECLINE"}}); return
+        inv["status"] = "declined"
+    payload = {"type": "GROUP_INVITE_DECLINED", "data": {"invite_id": inv["id"], "group_id": gid, "user_id": me}}
+    _send(conn, payload)
+    _broadcast_to_user(inv["from_user_id"], payload)
+
+
+@_HANDLERS.on("GROUP_LIST")
+def _on_group_list(session: dict, conn, data: dict):
+    me = session["user_id"]
+    _send(conn, {"type": "GROUP_LIST_RESULT", "data": {"groups": _groups_of(me)}})
 
-    # ---- interactions (seen / recall / react) ----
-    if typ == "MSG_SEEN":
-        ids = data.get("message_ids") or []
-        updated = []
-        with _msg_lock:
-            for mid in ids:
-                rec = _find_msg(mid)
-                if not rec:
-                    continue
-                rec.setdefault("seen_by", set()).add(me)
-                updated.append(mid)
-        if not updated:
-            return
-        # xác định phạm vi để broadcast
-        payload = {"type": "MSG_SEEN_UPDATE", "data": {"message_ids": updated, "by_user_id": me}}
-        # 1-1
-        peers = set()
-        groups = set()
-        with _msg_lock:
-            for mid in updated:
-                rec = _find_msg(mid)
-                if not rec:
-                    continue
-                if "group_id" in rec:
-                    groups.add(rec["group_id"])
-                else:
-                    other = rec["to_user_id"] if rec["from_user_id"] == me else rec["from_user_id"]
-                    peers.add(other)
-        # gửi cho participants
-        _send(conn, payload)  # gửi lại cho chính mình (optional)
-        for p in peers:
-            _broadcast_to_user(p, payload | {"data": payload["data"] | {"peer_id": p}})
-        for g in groups:
-            members = list(_group_members.get(g, set()))
-            for uid in members:
-                _broadcast_to_user(uid, payload | {"data": payload["data"] | {"group_id": g}})
-        return
 
-    if typ == "MSG_RECALL":
-        mid = data.get("message_id")
-        with _msg_lock:
+@_HANDLERS.on("GROUP_MSG_SEND")
+def _on_group_msg_send(session: dict, conn, data: dict):
+    global _next_msg_id
+    me = session["user_id"]
+    gid = data.get("group_id"); content = (data.get("content") or "").strip()
+    reply_to_id = data.get("reply_to_id")
+    if not isinstance(gid, int) or not content:
+        _send(conn, {"type": "ERROR", "data": {"code": "BAD_GROUP_MSG"}}); return
+    if me not in _group_members.get(gid, set()):
+        _send(conn, {"type": "ERROR", "data": {"code": "NOT_GROUP_MEMBER"}}); return
+    with _msg_lock:
+        mid = _next_msg_id; _next_msg_id += 1
+        rec = Message(me, content, time.time(), group_id=gid, reply_to_id=reply_to_id, id=mid)
+        _messages.append(rec)
+    payload = {"type": "GROUP_MSG_RECV",
+               "data": {"message_id": rec.id, "group_id": gid, "from_user_id": me,
+                        "content": content, "created_at": rec.created_at, "reply_to_id": reply_to_id,
+                        "recalled": False, "reactions_summary": {}}}
+    for uid in list(_group_members.get(gid, set())):
+        _broadcast_to_user(uid, payload)
+
+
+@_HANDLERS.on("GROUP_HISTORY")
+def _on_group_history(session: dict, conn, data: dict):
+    me = session["user_id"]
+    gid = data.get("group_id"); before_id = data.get("before_id"); limit = int(data.get("limit") or 50)
+    if me not in _group_members.get(gid, set()):
+        _send(conn, {"type": "ERROR", "data": {"code": "NOT_GROUP_MEMBER"}}); return
+    with _msg_lock:
+        conv = [m for m in _messages if m.group_id == gid]
+        conv.sort(key=lambda x: x.id, reverse=True)
+        if before_id:
+            conv = [m for m in conv if m.id < before_id]
+        batch = conv[:limit]; has_more = len(conv) > limit
+        batch_sorted = sorted(batch, key=lambda x: x.id)
+        marks = [(uid, _last_read.get((uid, ("group", gid)), 0)) for uid in _group_members.get(gid, ())]
+        # seen_count: members other than the sender whose read watermark has reached the message
+        res = {"group_id": gid,
+               "messages": [{"message_id": m.id, "group_id": gid, "from_user_id": m.from_user_id,
+                             "content": m.content, "created_at": m.created_at, "reply_to_id": m.reply_to_id,
+                             "recalled": m.recalled, "reactions_summary": _reactions_summary(m),
+                             "seen_count": sum(1 for uid, mark in marks if uid != m.from_user_id and mark >= m.id)}
+                            for m in batch_sorted],
+               "has_more": has_more}
+    _send(conn, {"type": "GROUP_HISTORY_RESULT", "data": res})
+
+
+# ---- interactions (seen / recall / react) ----
+@_HANDLERS.on("MSG_SEEN")
+def _on_msg_seen(session: dict, conn, data: dict):
+    me = session["user_id"]
+    ids = data.get("message_ids") or []
+    updated = []
+    with _msg_lock:
+        for mid in ids:
             rec = _find_msg(mid)
-            if not rec or rec.get("recalled"):
-                _send(conn, {"type": "ERROR", "data": {"code": "BAD_RECALL"}}); return
-            if rec["from_user_id"] != me:
-                _send(conn, {"type": "ERROR", "data": {"code": "NOT_OWNER"}}); return
-            rec["recalled"] = True
-            rec["content"] = ""  # xoá nội dung hiển thị
-        payload = {"type": "MSG_RECALL_UPDATE", "data": {"message_id": mid}}
-        # broadcast cho participants
-        if "group_id" in rec:
-            for uid in list(_group_members.get(rec["group_id"], set())):
-                _broadcast_to_user(uid, payload)
-        else:
-            _send(conn, payload)
-            _broadcast_to_user(rec["to_user_id"], payload)
+            if not rec:
+                continue
+            if rec.group_id is not None:
+                key = ("group", rec.group_id)
+            else:
+                key = ("dm", min(rec.from_user_id, rec.to_user_id), max(rec.from_user_id, rec.to_user_id))
+            if rec.id > _last_read.get((me, key), 0):
+                _last_read[(me, key)] = rec.id
+            updated.append(mid)
+    if not updated:
         return
-
-    if typ == "MSG_REACT":
-        mid = data.get("message_id"); reaction = (data.get("reaction") or "").strip()
-        if not reaction:
-            _send(conn, {"type": "ERROR", "data": {"code": "BAD_REACTION"}}); return
-        with _msg_lock:
+    # xác định phạm vi để broadcast
+    payload = {"type": "MSG_SEEN_UPDATE", "data": {"message_ids": updated, "by_user_id": me}}
+    # 1-1
+    peers = set()
+    groups = set()
+    with _msg_lock:
+        for mid in updated:
             rec = _find_msg(mid)
             if not rec:
-                _send(conn, {"type": "ERROR", "data": {"code": "MSG_NOT_FOUND"}}); return
-            rec.setdefault("reactions", {})
-            rec["reactions"].setdefault(reaction, set())
-            if me in rec["reactions"][reaction]:
-                rec["reactions"][reaction].remove(me)
-                action = "remove"
+                continue
+            if rec.group_id is not None:
+                groups.add(rec.group_id)
             else:
-                rec["reactions"][reaction].add(me)
-                action = "add"
-            counts = _reactions_summary(rec)
-        payload = {"type": "MSG_REACT_UPDATE",
-                   "data": {"message_id": mid, "reaction": reaction, "action": action, "by_user_id": me, "counts": counts}}
-        # broadcast
-        if "group_id" in rec:
-            for uid in list(_group_members.get(rec["group_id"], set())):
-                _broadcast_to_user(uid, payload)
-        else:
-            _send(conn, payload)
-            other = rec["to_user_id"] if rec["from_user_id"] == me else rec["from_user_id"]
-            _broadcast_to_user(other, payload)
-        return
+                peers.add(rec.other_party(me))
+    # gửi cho participants
+    _send(conn, payload)  # gửi lại cho chính mình (optional)
+    for p in peers:
+        _broadcast_to_user(p, payload | {"data": payload["data"] | {"peer_id": p}})
+    for g in groups:
+        members = list(_group_members.get(g, set()))
+        for uid in members:
+            _broadcast_to_user(uid, payload | {"data": payload["data"] | {"group_id": g}})
+
+
+@_HANDLERS.on("MSG_RECALL")
+def _on_msg_recall(session: dict, conn, data: dict):
+    me = session["user_id"]
+    mid = data.get("message_id")
+    with _msg_lock:
+        rec = _find_msg(mid)
+        if not rec or rec.recalled:
+            _send(conn, {"type": "ERROR", "data": {"code": "BAD_RECALL"}}); return
+        if rec.from_user_id != me:
+            _send(conn, {"type": "ERROR", "data": {"code": "NOT_OWNER"}}); return
+        rec.recalled = True
+        rec.content = ""  # xoá nội dung hiển thị
+    payload = {"type": "MSG_RECALL_UPDATE", "data": {"message_id": mid}}
+    # broadcast cho participants
+    if rec.group_id is not None:
+        for uid in list(_group_members.get(rec.group_id, set())):
+            _broadcast_to_user(uid, payload)
+    else:
+        _send(conn, payload)
+        _broadcast_to_user(rec.to_user_id, payload)
 
-    _send(conn, {"type": "ERROR", "data": {"code": "UNKNOWN_TYPE", "got": typ}})
+
+@_HANDLERS.on("MSG_REACT")
+def _on_msg_react(session: dict, conn, data: dict):
+    me = session["user_id"]
+    mid = data.get("message_id"); reaction = (data.get("reaction") or "").strip()
+    if not reaction:
+        _send(conn, {"type": "ERROR", "data": {"code": "BAD_REACTION"}}); return
+    with _msg_lock:
+        rec = _find_msg(mid)
+        if not rec:
+            _send(conn, {"type": "ERROR", "data": {"code": "MSG_NOT_FOUND"}}); return
+        action = rec.toggle_reaction(reaction, me)
+        counts = _reactions_summary(rec)
+    payload = {"type": "MSG_REACT_UPDATE",
+               "data": {"message_id": mid, "reaction": reaction, "action": action, "by_user_id": me, "counts": counts}}
+    # broadcast
+    if rec.group_id is not None:
+        for uid in list(_group_members.get(rec.group_id, set())):
+            _broadcast_to_user(uid, payload)
+    else:
+        _send(conn, payload)
+        _broadcast_to_user(rec.other_party(me), payload)
+    return
+
+def _route(session: dict, conn, msg: dict):
+    typ = msg.get("type")
+    handler = _HANDLERS.get(typ)
+    if not session.get("user_id") and (handler is None or handler.auth):
+        _send(conn, {"type": "ERROR", "data": {"code": "UNAUTH"}})
+        return
+    if handler is None:
+        _send(conn, {"type": "ERROR", "data": {"code": "UNKNOWN_TYPE", "got": typ}})
+        return
+    timing = _HANDLERS.timing
+    if timing is None:
+        handler.fn(session, conn, msg.get("data") or {})
+        return
+    t0 = time.perf_counter()
+    try:
+        handler.fn(session, conn, msg.get("data") or {})
+    finally:
+        timing(typ, time.perf_counter() - t0)
 
 
 def handle(conn):
-    buf = b""; session = {}
+    framer = LineFramer(MAX_FRAME); session = {}
     try:
         while True:
-            data = conn.recv(4096)
+            data = conn.recv(65536)
             if not data: break
-            buf += data
-            while b"\n" in buf:
-                line, buf = buf.split(b"\n", 1)
-                if not line: continue
+            try:
+                lines = framer.feed(data)
+            except FrameTooLarge:
+                _send(conn, {"type": "ERROR", "data": {"code": "FRAME_TOO_LARGE", "max": MAX_FRAME}}); break
+            for line in lines:
                 try:
-                    msg = json.loads(line.decode())
-                except json.JSONDecodeError:
+                    msg = codec.loads(line)
+                except ValueError:
                     _send(conn, {"type": "ERROR", "data": {"code": "BAD_JSON"}}); continue
-                _route(conn, session, msg)
+                _route(session, conn, msg)
     finally:
         uid = session.get("user_id")
         if uid and _user_conns.get(uid) is conn:
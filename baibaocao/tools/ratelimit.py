@@ -0,0 +1,121 @@
+# tools/ratelimit.py
+from typing import Dict
+
+
+class TokenBucket:
+    """rate lệnh/giây, dồn tối đa burst lệnh; mỗi lệnh tốn một token."""
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float, now: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def wait(self, now: float) -> float:
+        """Số giây tới khi có một token (0 = có ngay); không lấy token. tokens âm = đã nợ trước (chế độ delay)."""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+def parse_rate(spec: str) -> tuple[float, float]:
+    """"RATE" hoặc "RATE:BURST" (lệnh/giây, lệnh); burst mặc định bằng rate (tối thiểu 1)."""
+    rate, _, burst = spec.partition(":")
+    r = float(rate)
+    b = float(burst) if burst else max(r, 1.0)
+    if r <= 0 or b < 1:
+        raise ValueError(f"bad rate {spec!r}")
+    return r, b
+
+
+class RateLimits:
+    """
+    Giới hạn cho server_async, dùng chung mọi kết nối, kèm bộ đếm để chỉnh ngưỡng.
+    per_conn: (rate, burst) cho mọi lệnh của một kết nối; per_type: type -> (rate, burst) riêng cho type đó.
+    action "error": trả ERROR RATE_LIMITED và bỏ lệnh; "delay": chờ tới khi có token
+    (trong lúc đó không đọc tiếp socket của kết nối đó -> TCP đẩy ngược về client).
+    max_inflight: số lệnh của một kết nối đã nhận mà chưa trả lời (bộ đếm theo kết nối: tăng khi nhận lệnh, giảm
+    khi handler xong; mục BATCH tính như lệnh), 0 = không giới hạn. Mỗi lệnh vượt quá bị từ chối riêng, kèm
+    request_id của nó (error), hoặc chờ tới khi một lệnh trước được trả lời, trong lúc đó không đọc socket (delay).
+    """
+
+    def __init__(self, per_conn: tuple[float, float] | None = None,
+                 per_type: Dict[str, tuple[float, float]] | None = None,
+                 action: str = "error", max_inflight: int = 0) -> None:
+        if action not in ("error", "delay"):
+            raise ValueError(f"unknown action {action!r}")
+        self.per_conn = per_conn
+        self.per_type = per_type or {}
+        self.action = action
+        self.max_inflight = max_inflight
+        self.counts: Dict[str, list] = {}  # type -> [allowed, limited, delayed, delay_s, clamped]
+        self.inflight_limited = 0  # commands over max_inflight: rejected (error) or run after a yield (delay)
+
+    @property
+    def enabled(self) -> bool:
+        return self.per_conn is not None or bool(self.per_type)
+
+    def connection(self, now: float) -> "ConnLimiter":
+        return ConnLimiter(self, now)
+
+    def _count(self, typ: str) -> list:
+        c = self.counts.get(typ)
+        if c is None:
+            c = self.counts[typ] = [0, 0, 0, 0.0, 0]
+        return c
+
+    def clamped(self, typ: str) -> None:
+        # a request whose limit was lowered to the server maximum
+        self._count(typ)[4] += 1
+
+    def report(self) -> str:
+        lines = [f"{'type':<26} {'allowed':>8} {'limited':>8} {'delayed':>8} {'delay s':>8} {'clamped':>8}"]
+        for typ, (ok, limited, delayed, delay_s, clamped) in sorted(self.counts.items(), key=lambda kv: -kv[1][0]):
+            lines.append(f"{typ:<26} {ok:>8} {limited:>8} {delayed:>8} {delay_s:>8.2f} {clamped:>8}")
+        lines.append(f"over max_inflight: {self.inflight_limited}")
+        return "\n".join(lines)
+
+
+class ConnLimiter:
+    """Các bucket của một kết nối: một cho cả kết nối, và một cho mỗi type có cấu hình riêng (tạo khi cần)."""
+
+    __slots__ = ("limits", "bucket", "by_type")
+
+    def __init__(self, limits: RateLimits, now: float) -> None:
+        self.limits = limits
+        self.bucket = TokenBucket(*limits.per_conn, now) if limits.per_conn else None
+        self.by_type: Dict[str, TokenBucket] = {}
+
+    def check(self, typ: str, now: float) -> float:
+        """
+        0 nếu lệnh được nhận ngay, nếu không thì số giây phải chờ. Chế độ error: lệnh bị từ chối, không tốn token;
+        chế độ delay: token được lấy trước (bucket nợ), lệnh được xử lý sau đúng số giây đó.
+        """
+        limits = self.limits
+        tb = self.by_type.get(typ)
+        if tb is None and typ in limits.per_type:
+            tb = self.by_type[typ] = TokenBucket(*limits.per_type[typ], now)
+        wait = 0.0
+        if self.bucket is not None:
+            wait = self.bucket.wait(now)
+        if tb is not None:
+            wait = max(wait, tb.wait(now))
+        c = limits._count(typ)
+        if wait and limits.action == "error":
+            c[1] += 1
+            return wait
+        if self.bucket is not None:
+            self.bucket.take()
+        if tb is not None:
+            tb.take()
+        if wait:
+            c[2] += 1
+            c[3] += wait
+        else:
+            c[0] += 1
+        return wait
@@ -0,0 +1,82 @@
+# tools/records.py
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable
+
+
+class Message:
+    """
+    Bản ghi tin nhắn dùng chung cho server_async và mock_server.
+    Dùng __slots__ thay cho dict; reactions chỉ được tạo khi có người thả cảm xúc
+    lần đầu (phần lớn tin nhắn không có). Mỗi cảm xúc giữ một array id user đã sắp xếp
+    (8 B/người thay vì một entry set), kèm reaction_counts {emoji: số người} được cập nhật
+    ngay khi thêm/bỏ nên lịch sử và MSG_REACT_UPDATE không phải đếm lại. Trạng thái đã xem không nằm ở đây mà là
+    watermark "đã đọc tới tin nào" theo (user, hội thoại) trong store.
+    1-1: group_id is None; nhóm: to_user_id is None.
+    """
+
+    __slots__ = ("id", "group_id", "from_user_id", "to_user_id", "content", "created_at",
+                 "reply_to_id", "recalled", "reactions", "reaction_counts", "seq")
+
+    def __init__(self, from_user_id: int, content: str, created_at: float,
+                 to_user_id: int | None = None, group_id: int | None = None,
+                 reply_to_id: int | None = None, id: int = 0) -> None:
+        self.id = id
+        self.group_id = group_id
+        self.from_user_id = from_user_id
+        self.to_user_id = to_user_id
+        self.content = content
+        self.created_at = created_at
+        self.reply_to_id = reply_to_id
+        self.recalled = False
+        self.reactions: Dict[str, array] | None = None  # emoji -> sorted user ids
+        self.reaction_counts: Dict[str, int] | None = None
+        self.seq = 0  # change_seq of the last change the store made to it (sent with the push)
+
+    def copy(self) -> "Message":
+        m = Message(self.from_user_id, self.content, self.created_at, self.to_user_id, self.group_id,
+                    self.reply_to_id, self.id)
+        m.recalled = self.recalled
+        m.reactions = {k: array("q", v) for k, v in self.reactions.items()} if self.reactions else None
+        m.reaction_counts = self.reaction_counts  # replaced on change, never modified in place
+        m.seq = self.seq
+        return m
+
+    def toggle_reaction(self, reaction: str, uid: int) -> str:
+        if self.reactions is None:
+            self.reactions = {}
+        users = self.reactions.get(reaction)
+        if users is None:
+            users = self.reactions[reaction] = array("q")
+        i = bisect_left(users, uid)
+        if i < len(users) and users[i] == uid:
+            del users[i]
+            action = "remove"
+        else:
+            users.insert(i, uid)
+            action = "add"
+        # a new counts dict per change: summaries already handed out stay as they were
+        counts = dict(self.reaction_counts or ())
+        if users:
+            counts[reaction] = len(users)
+        else:
+            del self.reactions[reaction]
+            counts.pop(reaction, None)
+        self.reaction_counts = counts
+        return action
+
+    def load_reactions(self, reactions: Dict[str, Iterable[int]] | None) -> None:
+        # from a snapshot / segment row: {emoji: [user ids]}
+        self.reactions = {k: array("q", sorted(v)) for k, v in reactions.items() if v} if reactions else None
+        self.reaction_counts = {k: len(v) for k, v in self.reactions.items()} if self.reactions else None
+
+    def reactions_rows(self) -> Dict[str, list[int]] | None:
+        return {k: v.tolist() for k, v in self.reactions.items()} if self.reactions else None
+
+    def reactions_summary(self) -> Dict[str, int]:
+        # the maintained counts, shared: callers must not modify the dict
+        return self.reaction_counts or {}
+
+    def other_party(self, uid: int) -> int | None:
+        # 1-1 only: the participant that is not `uid`
+        return self.to_user_id if self.from_user_id == uid else self.from_user_id
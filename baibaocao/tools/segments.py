@@ -0,0 +1,141 @@
+# tools/segments.py
+import json
+import mmap
+import os
+import sys
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Any
+
+from tools.records import Message
+
+
+_MAGIC = b"SEG1"
+_SWAP = sys.byteorder != "little"  # segment files are little-endian
+
+
+def encode_message(m: Message) -> list:
+    # same 10-field layout as State.snapshot(); field 8 (the old seen_by) is always None,
+    # read state lives in per-conversation watermarks
+    return [m.id, m.group_id, m.from_user_id, m.to_user_id, m.content, m.created_at, m.reply_to_id, m.recalled,
+            None, m.reactions_rows()]
+
+
+def decode_message(row: list) -> Message:
+    mid, gid, frm, to, content, created_at, reply_to_id, recalled, _, reactions = row
+    rec = Message(frm, content, created_at, to_user_id=to, group_id=gid, reply_to_id=reply_to_id, id=mid)
+    rec.recalled = recalled
+    rec.load_reactions(reactions)
+    return rec
+
+
+def _u64(values) -> bytes:
+    arr = array("Q", values)
+    if _SWAP:
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _read_u64(buf: Any) -> array:
+    arr = array("Q")
+    arr.frombytes(buf)
+    if _SWAP:
+        arr.byteswap()
+    return arr
+
+
+class SegmentDir:
+    """
+    Thư mục segment bất biến chứa tin nhắn cũ (cold) của server_async.
+    Mỗi segment là một đoạn liên tiếp (theo id) của một hội thoại:
+        "SEG1" | count: u64 | ids: count x u64 | offsets: (count + 1) x u64 | bản ghi JSON
+    File được đọc qua mmap; chỉ giữ tối đa `max_open` segment đang mở (LRU).
+    """
+
+    def __init__(self, directory: str, max_open: int = 64) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_open = max_open
+        self._open: "OrderedDict[int, tuple]" = OrderedDict()  # seg -> (file, mmap, ids, offsets)
+        self._unsynced: list[str] = []
+
+    def path(self, seg: int) -> str:
+        return os.path.join(self.directory, f"seg-{seg:08d}.dat")
+
+    def write(self, seg: int, recs: list[Message]) -> None:
+        body = [json.dumps(encode_message(m), ensure_ascii=False, separators=(",", ":")).encode() for m in recs]
+        n = len(recs)
+        pos = len(_MAGIC) + 8 + 16 * n + 8
+        offsets = [pos]
+        for b in body:
+            pos += len(b)
+            offsets.append(pos)
+        self._close(seg)
+        with open(self.path(seg), "wb") as f:
+            f.write(_MAGIC + _u64([n]) + _u64(m.id for m in recs) + _u64(offsets) + b"".join(body))
+        self._unsynced.append(self.path(seg))
+
+    def sync(self) -> None:
+        """fsync các segment đã ghi từ lần sync trước (gọi trước khi ghi snapshot tham chiếu tới chúng)."""
+        paths, self._unsynced = self._unsynced, []
+        for p in paths:
+            fd = os.open(p, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _segment(self, seg: int) -> tuple:
+        ent = self._open.get(seg)
+        if ent is not None:
+            self._open.move_to_end(seg)
+            return ent
+        f = open(self.path(seg), "rb")
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mm[:4] != _MAGIC:
+            mm.close()
+            f.close()
+            raise ValueError(f"bad segment file {self.path(seg)}")
+        n = _read_u64(mm[4:12])[0]
+        ids = _read_u64(mm[12:12 + 8 * n])
+        offsets = _read_u64(mm[12 + 8 * n:20 + 16 * n])
+        ent = self._open[seg] = (f, mm, ids, offsets)
+        if len(self._open) > self.max_open:
+            self._close(next(iter(self._open)))
+        return ent
+
+    def _close(self, seg: int) -> None:
+        ent = self._open.pop(seg, None)
+        if ent is not None:
+            ent[1].close()
+            ent[0].close()
+
+    def ids(self, seg: int) -> array:
+        """Các id (tăng dần) trong segment."""
+        return self._segment(seg)[2]
+
+    def read(self, seg: int, lo: int, hi: int) -> list[Message]:
+        """Tin ở vị trí [lo, hi) của segment."""
+        _, mm, _, offsets = self._segment(seg)
+        return [decode_message(json.loads(mm[offsets[i]:offsets[i + 1]])) for i in range(lo, hi)]
+
+    def get(self, seg: int, mid: int) -> Message | None:
+        ids = self.ids(seg)
+        i = bisect_left(ids, mid)
+        if i == len(ids) or ids[i] != mid:
+            return None
+        return self.read(seg, i, i + 1)[0]
+
+    def discard_from(self, seg: int) -> None:
+        """Xoá các segment >= seg (ghi sau snapshot cuối, sẽ được ghi lại khi replay log)."""
+        for name in os.listdir(self.directory):
+            if name.startswith("seg-") and name.endswith(".dat") and name[4:-4].isdigit():
+                n = int(name[4:-4])
+                if n >= seg:
+                    self._close(n)
+                    os.remove(os.path.join(self.directory, name))
+
+    def close(self) -> None:
+        for seg in list(self._open):
+            self._close(seg)
@@ -1,32 +1,108 @@
 # tools/server_async.py
+import argparse
 import asyncio
-import json
 import hashlib
+import hmac
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
 import time
-from typing import Dict, Set, Any
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from heapq import merge, nlargest
+from typing import Callable, Dict, Iterable, Set, Any
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools import binproto, codec
+from tools.bus import Broker, BusClient
+from tools.dispatch import Registry, TypeStats
+from tools.framing import FrameTooLarge, LengthFramer, LineFramer
+from tools.ratelimit import RateLimits, parse_rate
+from tools.records import Message
+from tools.segments import SegmentDir, decode_message
+from tools.storage import SQLiteStore, Store, last_message_summary
+from tools.tokens import TokenSigner, secret_from_env
+from tools.wal import WriteAheadLog
 
 
 HOST, PORT = "127.0.0.1", 5555
+MAX_FRAME = 1 << 20  # longest accepted request line, in bytes
+# (level, option, value) applied to every accepted socket: --no-nodelay (asyncio sets TCP_NODELAY on accept)
+SOCKET_OPTS: list[tuple[int, int, int]] = []
+# set on the listening sockets, which accepted sockets inherit: --sndbuf, --rcvbuf
+# (the receive buffer of the listener also sizes the window scale offered in the handshake)
+LISTEN_OPTS: list[tuple[int, int, int]] = []
 
 
 def _hash(pw: str) -> str:
     return hashlib.sha256(pw.encode()).hexdigest()
 
 
-class State:
-    def __init__(self) -> None:
+_AUTH_EXECUTOR: ThreadPoolExecutor | None = None
+
+
+async def hash_password(pw: str) -> str:
+    """_hash() trên thread pool riêng: một cơn đăng nhập hàng loạt không chặn việc giao tin."""
+    global _AUTH_EXECUTOR
+    if _AUTH_EXECUTOR is None:
+        _AUTH_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="auth")
+    return await asyncio.get_running_loop().run_in_executor(_AUTH_EXECUTOR, _hash, pw)
+
+
+class State(Store):
+    """Store trong RAM (mặc định); bền vững nhờ journal -> tools/wal.py."""
+
+    def __init__(self, segments: SegmentDir | None = None, hot_messages: int = 1000) -> None:
         # users
-        self.users: Dict[str, Dict[str, Any]] = {}  # username -> {password_hash, user_id}
-        self.user_conns: Dict[int, asyncio.StreamWriter] = {}  # user_id -> writer
+        self.users: Dict[str, Dict[str, Any]] = {}  # username -> {password_hash, user_id, username}
+        self.users_by_id: Dict[int, Dict[str, Any]] = {}  # user_id -> same record as in users
         self.next_uid: int = 1
 
-        # messages
-        self.messages: list[dict] = []
+        # messages (dense: slot i holds message id i + 1, ids are never reused);
+        # a slot is the Message itself, or the number of the cold segment it was spilled to
+        self.messages: list[Message | int] = []
         self.next_msg_id: int = 1
+        # conversation key -> hot tail of that conversation, append-only in id order
+        self.conversations: Dict[tuple, list[Message]] = {}
+
+        # hot/cold tiering: once a conversation holds 2 * hot_messages in RAM, the oldest
+        # hot_messages are written to an immutable segment (tools/segments.py)
+        self.segments = segments
+        self.hot_messages = hot_messages
+        self.cold: Dict[tuple, list[tuple[int, int, int]]] = {}  # key -> [(first_id, last_id, seg)], oldest first
+        self.seg_keys: Dict[int, tuple] = {}  # seg -> conversation key, to check access before reading a segment
+        self.next_seg: int = 0
+
+        # SYNC: every new message, recall and reaction change takes the next change_seq;
+        # per conversation, (seqs, message ids) in seq order, as compact arrays. Only the latest
+        # seq of a message matters (SYNC sends it once, in its current state): _compact drops the rest
+        self.change_seq: int = 0
+        self.changes: Dict[tuple, tuple[array, array]] = {}
+        self.dm_peers: Dict[int, Set[int]] = {}  # user_id -> users they have a 1-1 conversation with
+
+        # read state: per (user, conversation) the id of the last message read (watermark),
+        # plus for CONV_LIST how many messages the user sent there and how many of the others' messages
+        # are at or below the watermark; unread is total minus both. Counts only, no id lists:
+        # last_sent and own_read (own messages at or below the watermark) let mark_seen tell how many
+        # of the messages it passes are the user's own
+        self.conv_total: Dict[tuple, int] = {}
+        # user_id -> key -> [sent, seen, last_read, last_sent, own_read]
+        self.reads: Dict[int, Dict[tuple, list]] = {}
 
         # friends
         self.friendships: Dict[int, Set[int]] = {}
-        self.friend_requests: list[dict] = []  # {id, from_user_id, to_user_id, status}
+        self.friend_requests: Dict[int, dict] = {}  # pending only: req_id -> {id, from_user_id, to_user_id, status}
+        self.friend_requests_done: Dict[int, dict] = {}  # accepted/declined, out of the hot path
+        self.requests_in: Dict[int, Dict[int, dict]] = {}   # to_user_id -> {req_id: req} (pending)
+        self.requests_out: Dict[int, Dict[int, dict]] = {}  # from_user_id -> {req_id: req} (pending)
         self.next_req_id: int = 1
 
         # blocks
@@ -35,481 +111,1643 @@ class State:
         # groups
         self.groups: Dict[int, dict] = {}           # gid -> {name, owner_id, avatar}
         self.group_members: Dict[int, Set[int]] = {}  # gid -> set(user_id)
+        self.user_groups: Dict[int, Set[int]] = {}    # user_id -> set(gid), reverse of group_members
         self.next_gid: int = 1
 
+        # persistence: every mutation below is passed to journal (WriteAheadLog.append) if set
+        self.journal: Callable[[dict], Any] | None = None
+
+    def _log(self, record: dict) -> None:
+        if self.journal is not None:
+            self.journal(record)
+
+    def add_user(self, username: str, password_hash: str) -> Dict[str, Any] | None:
+        if username in self.users:
+            return None
+        rec = {"password_hash": password_hash, "user_id": self.next_uid, "username": username}
+        self.next_uid += 1
+        self.users[username] = rec
+        self.users_by_id[rec["user_id"]] = rec
+        self.friendships[rec["user_id"]] = set()
+        self._log({"op": "user", "username": username, "password_hash": password_hash})
+        return rec
+
+    def get_user(self, username: str) -> Dict[str, Any] | None:
+        return self.users.get(username)
+
+    def user_exists(self, uid: int) -> bool:
+        return uid in self.users_by_id
+
     def username_of(self, uid: int) -> str:
-        for uname, rec in self.users.items():
-            if rec["user_id"] == uid:
-                return uname
-        return f"user_{uid}"
+        rec = self.users_by_id.get(uid)
+        return rec["username"] if rec else f"user_{uid}"
+
+    def add_friend_request(self, from_uid: int, to_uid: int) -> dict:
+        req = {"id": self.next_req_id, "from_user_id": from_uid, "to_user_id": to_uid, "status": "pending"}
+        self.next_req_id += 1
+        self.friend_requests[req["id"]] = req
+        self.requests_out.setdefault(from_uid, {})[req["id"]] = req
+        self.requests_in.setdefault(to_uid, {})[req["id"]] = req
+        self._log({"op": "freq", "from": from_uid, "to": to_uid})
+        return req
+
+    def get_friend_request(self, req_id: int) -> dict | None:
+        return self.friend_requests.get(req_id)
+
+    def resolve_friend_request(self, req: dict, status: str) -> None:
+        req["status"] = status
+        self.friend_requests.pop(req["id"], None)
+        self.requests_out.get(req["from_user_id"], {}).pop(req["id"], None)
+        self.requests_in.get(req["to_user_id"], {}).pop(req["id"], None)
+        self.friend_requests_done[req["id"]] = req
+
+    def accept_friend_request(self, req: dict) -> None:
+        self.resolve_friend_request(req, "accepted")
+        a, b = req["from_user_id"], req["to_user_id"]
+        self.friendships.setdefault(a, set()).add(b)
+        self.friendships.setdefault(b, set()).add(a)
+        self._log({"op": "freq_accept", "id": req["id"]})
+
+    def remove_friendship(self, a: int, b: int) -> None:
+        if a in self.friendships:
+            self.friendships[a].discard(b)
+        if b in self.friendships:
+            self.friendships[b].discard(a)
+        self._log({"op": "unfriend", "a": a, "b": b})
+
+    def are_friends(self, a: int, b: int) -> bool:
+        return b in self.friendships.get(a, ()) and a in self.friendships.get(b, ())
+
+    def friend_list(self, uid: int) -> dict:
+        return {
+            "friends": [{"user_id": fid, "username": self.username_of(fid), "status": "accepted"}
+                        for fid in sorted(self.friendships.get(uid, ()))],
+            "pending_in": [{"request_id": r["id"], "from_user_id": r["from_user_id"],
+                            "from_username": self.username_of(r["from_user_id"])}
+                           for r in self.pending_in(uid)],
+            "pending_out": [{"request_id": r["id"], "to_user_id": r["to_user_id"],
+                             "to_username": self.username_of(r["to_user_id"])}
+                            for r in self.pending_out(uid)],
+        }
+
+    def block(self, blocker: int, blocked: int) -> None:
+        self.blocked.add((blocker, blocked))
+        self._log({"op": "block", "a": blocker, "b": blocked})
+
+    def unblock(self, blocker: int, blocked: Any) -> None:
+        self.blocked.discard((blocker, blocked))
+        self._log({"op": "unblock", "a": blocker, "b": blocked})
+
+    def is_blocked(self, blocker: int, blocked: int) -> bool:
+        return (blocker, blocked) in self.blocked
+
+    def pending_in(self, uid: int) -> list[dict]:
+        return list(self.requests_in.get(uid, {}).values())
+
+    def pending_out(self, uid: int) -> list[dict]:
+        return list(self.requests_out.get(uid, {}).values())
+
+    def create_group(self, owner_id: int, name: str, avatar: Any) -> int:
+        gid = self.next_gid
+        self.next_gid += 1
+        self.groups[gid] = {"name": name, "owner_id": owner_id, "avatar": avatar}
+        self.group_members[gid] = set()
+        self._add_member(gid, owner_id)
+        self._log({"op": "group", "owner": owner_id, "name": name, "avatar": avatar})
+        return gid
+
+    def get_group(self, gid: Any) -> dict | None:
+        return self.groups.get(gid)
+
+    def _add_member(self, gid: int, uid: int) -> None:
+        self.group_members.setdefault(gid, set()).add(uid)
+        self.user_groups.setdefault(uid, set()).add(gid)
+
+    def add_group_member(self, gid: int, uid: int) -> None:
+        if not self.is_member(gid, uid):
+            # a new member starts with the existing history counted as read
+            key = self.group_key(gid)
+            conv = self.conversations.get(key)
+            r = self._reads(uid, key)
+            r[1] = self.conv_total.get(key, 0) - r[0]
+            r[2] = conv[-1].id if conv else 0
+            r[4] = r[0]
+        self._add_member(gid, uid)
+        self._log({"op": "member", "gid": gid, "uid": uid})
+
+    def members_of(self, gid: Any) -> Set[int]:
+        return self.group_members.get(gid, set())
+
+    def is_member(self, gid: Any, uid: int) -> bool:
+        return uid in self.group_members.get(gid, ())
+
+    def group_summary(self, gid: int) -> dict:
+        return {"group_id": gid, "name": self.groups[gid]["name"],
+                "member_count": len(self.group_members.get(gid, ()))}
+
+    def groups_of(self, uid: int) -> list[dict]:
+        return [self.group_summary(gid) for gid in sorted(self.user_groups.get(uid, ()))]
 
-    def reactions_summary(self, rec: dict) -> Dict[str, int]:
-        return {k: len(v) for k, v in rec.get("reactions", {}).items()}
+    def add_message(self, rec: Message) -> Message:
+        rec.id = self.next_msg_id
+        self.next_msg_id += 1
+        self.messages.append(rec)
+        key = self.conv_key_of(rec)
+        conv = self.conversations.setdefault(key, [])
+        conv.append(rec)
+        self.conv_total[key] = self.conv_total.get(key, 0) + 1
+        rec.seq = self._touch(key, rec.id)
+        r = self._reads(rec.from_user_id, key)
+        r[0] += 1
+        r[3] = rec.id
+        if rec.group_id is None:
+            self.dm_peers.setdefault(rec.from_user_id, set()).add(rec.to_user_id)
+            self.dm_peers.setdefault(rec.to_user_id, set()).add(rec.from_user_id)
+        if self.segments is not None and len(conv) >= 2 * self.hot_messages:
+            self._spill(key, conv)
+        self._log({"op": "msg", "group_id": rec.group_id, "from": rec.from_user_id, "to": rec.to_user_id,
+                   "content": rec.content, "created_at": rec.created_at, "reply_to_id": rec.reply_to_id})
+        return rec
+
+    def _spill(self, key: tuple, conv: list[Message]) -> None:
+        chunk = conv[:self.hot_messages]
+        seg = self.next_seg
+        self.next_seg += 1
+        self.segments.write(seg, chunk)
+        del conv[:self.hot_messages]
+        for rec in chunk:
+            self.messages[rec.id - 1] = seg
+        self.cold.setdefault(key, []).append((chunk[0].id, chunk[-1].id, seg))
+        self.seg_keys[seg] = key
+
+    def _touch(self, key: tuple, mid: int) -> int:
+        self.change_seq += 1
+        log = self.changes.get(key)
+        if log is None:
+            log = self.changes[key] = (array("q"), array("q"))
+        log[0].append(self.change_seq)
+        log[1].append(mid)
+        # at most one stale entry per live one: amortized O(1), the log stays under 2x the messages
+        if len(log[0]) >= max(2 * self.conv_total.get(key, 0), CHANGES_COMPACT_MIN):
+            self._compact(key)
+        return self.change_seq
+
+    def _compact(self, key: tuple) -> None:
+        seqs, mids = self.changes[key]
+        last = {mid: j for j, mid in enumerate(mids)}  # later positions overwrite earlier ones
+        keep = sorted(last.values())
+        self.changes[key] = (array("q", [seqs[j] for j in keep]), array("q", [mids[j] for j in keep]))
+
+    def _reads(self, uid: int, key: tuple) -> list:
+        per_user = self.reads.get(uid)
+        if per_user is None:
+            per_user = self.reads[uid] = {}
+        r = per_user.get(key)
+        if r is None:
+            r = per_user[key] = [0, 0, 0, 0, 0]
+        return r
+
+    def mark_seen(self, recs: list[Message], uid: int) -> None:
+        upto: Dict[tuple, int] = {}
+        for rec in recs:
+            key = self.conv_key_of(rec)
+            if rec.id > upto.get(key, 0):
+                upto[key] = rec.id
+        advanced = []
+        for key, mid in upto.items():
+            r = self._reads(uid, key)
+            sent, _, last_read, last_sent, own_read = r
+            if mid > last_read:
+                # the others' messages in (old watermark, mid]: all of them minus the user's own, which
+                # are none, all those not read yet, or (watermark stopping below the user's last message)
+                # counted in that range
+                if last_sent <= last_read:
+                    own = 0
+                elif last_sent <= mid:
+                    own = sent - own_read
+                else:
+                    own = self._sent_between(key, last_read, mid, uid)
+                r[1] += self._position(key, mid) - self._position(key, last_read) - own
+                r[2] = mid
+                r[4] += own
+                advanced.append(mid)
+        if advanced:
+            self._log({"op": "seen", "ids": advanced, "uid": uid})
+
+    def _position(self, key: tuple, mid: int) -> int:
+        # how many messages of key have id <= mid: a bisect in the hot tail, segment sizes for the cold part
+        n = bisect_right(self.conversations.get(key, []), mid, key=lambda m: m.id)
+        for first, last, seg in self.cold.get(key, ()):
+            if first > mid:
+                break
+            ids = self.segments.ids(seg)
+            n += len(ids) if last <= mid else bisect_right(ids, mid)
+        return n
+
+    def _sent_between(self, key: tuple, lo: int, hi: int, uid: int) -> int:
+        # messages of uid in key with lo < id <= hi
+        conv = self.conversations.get(key, [])
+        by_id = lambda m: m.id
+        n = sum(m.from_user_id == uid
+                for m in conv[bisect_right(conv, lo, key=by_id):bisect_right(conv, hi, key=by_id)])
+        for first, last, seg in self.cold.get(key, ()):
+            if first > hi:
+                break
+            if last > lo:
+                ids = self.segments.ids(seg)
+                n += sum(m.from_user_id == uid
+                         for m in self.segments.read(seg, bisect_right(ids, lo), bisect_right(ids, hi)))
+        return n
+
+    def read_marks(self, key: tuple) -> Dict[int, int]:
+        users = self.group_members.get(key[1], ()) if key[0] == "group" else key[1:]
+        marks = {}
+        for uid in users:
+            r = self.reads.get(uid, {}).get(key)
+            if r is not None and r[2]:
+                marks[uid] = r[2]
+        return marks
+
+    def recall_message(self, rec: Message) -> None:
+        # only the copy changes: rec may be the record an in-flight capture() still holds.
+        # seq is not part of a snapshot, and the caller reads it from rec (see Store)
+        stored = self._writable(rec)
+        stored.recalled = True
+        stored.content = ""
+        stored.seq = rec.seq = self._touch(self.conv_key_of(rec), rec.id)
+        self._log({"op": "recall", "id": rec.id})
+
+    def toggle_reaction(self, rec: Message, reaction: str, uid: int) -> tuple[str, Dict[str, int]]:
+        stored = self._writable(rec)
+        action = stored.toggle_reaction(reaction, uid)
+        stored.seq = rec.seq = self._touch(self.conv_key_of(rec), rec.id)
+        self._log({"op": "react", "id": rec.id, "reaction": reaction, "uid": uid})
+        return action, stored.reactions_summary()
+
+    def _writable(self, rec: Message) -> Message:
+        # the record a mutation applies to. A stored Message is never changed in place, a snapshot
+        # being written on the WAL thread may still hold it (capture): the change goes to a copy that
+        # takes its place in messages and in the hot tail (copy-on-write). A cold message stays in RAM
+        # from its first change on (the segment file is immutable), and later reads prefer this copy
+        # (_read_cold); rec is then the caller's own copy read from the segment and is kept as is
+        slot = self.messages[rec.id - 1]
+        if type(slot) is int:
+            self.messages[rec.id - 1] = rec
+            return rec
+        new = self.messages[rec.id - 1] = slot.copy()
+        conv = self.conversations.get(self.conv_key_of(new), [])
+        i = bisect_left(conv, new.id, key=lambda m: m.id)
+        if i < len(conv) and conv[i].id == new.id:
+            conv[i] = new
+        return new
+
+    def get_message(self, mid: Any) -> Message | None:
+        # ids are allocated sequentially from 1, so the id is the list position
+        if type(mid) is not int or mid < 1 or mid > len(self.messages):
+            return None
+        slot = self.messages[mid - 1]
+        if type(slot) is int:
+            # cold: a copy read from the segment, not kept in RAM
+            return self.segments.get(slot, mid)
+        return slot
+
+    def get_messages(self, mids) -> list[Message]:
+        return [rec for rec in map(self.get_message, mids) if rec is not None]
+
+    def visible_messages(self, mids, uid: int) -> list[Message]:
+        out = []
+        for mid in mids:
+            if type(mid) is not int or mid < 1 or mid > len(self.messages):
+                continue
+            slot = self.messages[mid - 1]
+            key = self.seg_keys[slot] if type(slot) is int else self.conv_key_of(slot)
+            if uid not in (self.group_members.get(key[1], ()) if key[0] == "group" else key[1:]):
+                continue  # decided before any segment read
+            rec = self.segments.get(slot, mid) if type(slot) is int else slot
+            if rec is not None:
+                out.append(rec)
+        return out
+
+    @staticmethod
+    def dm_key(a: int, b: int) -> tuple:
+        return ("dm", a, b) if a <= b else ("dm", b, a)
+
+    @staticmethod
+    def group_key(gid: int) -> tuple:
+        return ("group", gid)
+
+    def conv_key_of(self, rec: Message) -> tuple:
+        if rec.group_id is not None:
+            return self.group_key(rec.group_id)
+        return self.dm_key(rec.from_user_id, rec.to_user_id)
+
+    def history_page(self, key: tuple, before_id: int | None, limit: int) -> tuple[list[Message], bool]:
+        """Trả về (tối đa `limit` tin cũ hơn before_id theo thứ tự id tăng dần, has_more)."""
+        conv = self.conversations.get(key, [])
+        limit = max(limit, 0)
+        end = bisect_left(conv, before_id, key=lambda m: m.id) if before_id else len(conv)
+        start = max(0, end - limit)
+        page = conv[start:end]
+        cold = self.cold.get(key)
+        if start > 0 or not cold:
+            return page, start > 0
+        # the page reaches past the hot tail: continue in the segments, newest first
+        need = limit - len(page)
+        chunks: list[list[Message]] = []
+        has_more = False
+        for first, last, seg in reversed(cold):
+            if before_id and first >= before_id:
+                continue
+            if need == 0:
+                has_more = True
+                break
+            ids = self.segments.ids(seg)
+            hi = bisect_left(ids, before_id) if before_id and before_id <= last else len(ids)
+            lo = max(0, hi - need)
+            chunks.append(self._read_cold(seg, lo, hi))
+            need -= hi - lo
+            if lo > 0:
+                has_more = True
+                break
+        older = [m for chunk in reversed(chunks) for m in chunk]
+        return older + page, has_more
+
+    def conversations_of(self, uid: int) -> list[tuple]:
+        return ([self.group_key(gid) for gid in self.user_groups.get(uid, ())]
+                + [self.dm_key(uid, peer) for peer in self.dm_peers.get(uid, ())])
+
+    def sync_page(self, uid: int, since: int | None, limit: int) -> tuple[list[Message], int, bool]:
+        if since is None:
+            return [], self.change_seq, False
+        limit = max(limit, 1)
+        tails = []
+        for key in self.conversations_of(uid):
+            log = self.changes.get(key)
+            if log is not None:
+                i = bisect_right(log[0], since)
+                if i < len(log[0]):
+                    tails.append(_log_tail(log, i))
+        # k-way merge by seq; a message changed several times is sent once, in its current state
+        picked: Dict[int, None] = {}
+        cursor = since
+        for seq, mid in merge(*tails):
+            if len(picked) >= limit and mid not in picked:
+                return self.get_messages(sorted(picked)), cursor, True
+            picked[mid] = None
+            cursor = seq
+        return self.get_messages(sorted(picked)), self.change_seq, False
+
+    def inbox_page(self, uid: int, before_id: int | None, limit: int) -> tuple[list[dict], bool]:
+        limit = max(limit, 0)
+        lasts = []
+        for key in self.conversations_of(uid):
+            conv = self.conversations.get(key)  # the hot tail is never empty once a message exists
+            if conv and (not before_id or conv[-1].id < before_id):
+                lasts.append((key, conv[-1]))
+        top = nlargest(limit + 1, lasts, key=lambda e: e[1].id)
+        reads = self.reads.get(uid, {})
+        out = []
+        for key, last in top[:limit]:
+            if key[0] == "group":
+                entry = {"group_id": key[1], "name": self.groups[key[1]]["name"]}
+            else:
+                peer = last.other_party(uid)
+                entry = {"peer_id": peer, "username": self.username_of(peer)}
+            sent, seen, *_ = reads.get(key, (0, 0))
+            entry["last_message"] = last_message_summary(last)
+            entry["unread"] = max(self.conv_total.get(key, 0) - sent - seen, 0)
+            out.append(entry)
+        return out, len(top) > limit
+
+    def _read_cold(self, seg: int, lo: int, hi: int) -> list[Message]:
+        # pinned copies (touched since the spill) win over the segment contents
+        out = []
+        for rec in self.segments.read(seg, lo, hi):
+            slot = self.messages[rec.id - 1]
+            out.append(rec if type(slot) is int else slot)
+        return out
+
+    # ---- persistence (tools/wal.py) ----
+    def apply(self, r: dict) -> None:
+        """Replay one journal record produced by the mutators above."""
+        journal, self.journal = self.journal, None
+        try:
+            op = r["op"]
+            if op == "user":
+                self.add_user(r["username"], r["password_hash"])
+            elif op == "freq":
+                self.add_friend_request(r["from"], r["to"])
+            elif op == "freq_accept":
+                self.accept_friend_request(self.friend_requests[r["id"]])
+            elif op == "unfriend":
+                self.remove_friendship(r["a"], r["b"])
+            elif op == "block":
+                self.block(r["a"], r["b"])
+            elif op == "unblock":
+                self.unblock(r["a"], r["b"])
+            elif op == "group":
+                self.create_group(r["owner"], r["name"], r["avatar"])
+            elif op == "member":
+                self.add_group_member(r["gid"], r["uid"])
+            elif op == "msg":
+                self.add_message(Message(r["from"], r["content"], r["created_at"], to_user_id=r["to"],
+                                         group_id=r["group_id"], reply_to_id=r["reply_to_id"]))
+            elif op == "seen":
+                self.mark_seen(self.get_messages(r["ids"]), r["uid"])
+            elif op == "recall":
+                self.recall_message(self.get_message(r["id"]))
+            elif op == "react":
+                self.toggle_reaction(self.get_message(r["id"]), r["reaction"], r["uid"])
+        finally:
+            self.journal = journal
+
+    def snapshot(self) -> dict:
+        return self.capture()()
+
+    def capture(self) -> Callable[[], dict]:
+        """
+        Phần của snapshot phải chạy trên luồng event loop: chụp các tham chiếu, rẻ (không tỉ lệ với số tin).
+        Trả về hàm dựng snapshot (list thuần) mà luồng WAL gọi rồi ghi, trong khi loop vẫn tiếp tục đổi State.
+        """
+        # stored Messages are never changed in place (_writable): a copy of the list of references is enough;
+        # change log arrays and cold lists are only appended to (or replaced, _compact): their current
+        # length is enough; sets and lists changed in place get a shallow copy here
+        nxt = [self.next_uid, self.next_msg_id, self.next_req_id, self.next_gid, self.next_seg, self.change_seq]
+        users = list(self.users_by_id.values())
+        friendships = [(uid, tuple(fs)) for uid, fs in self.friendships.items()]
+        requests = [*self.friend_requests_done.values(),
+                    *({**r} for r in self.friend_requests.values())]  # pending ones change status later
+        blocked = list(self.blocked)
+        groups = [(gid, g, tuple(self.group_members.get(gid, ()))) for gid, g in self.groups.items()]
+        messages = list(self.messages)
+        cold = [(key, segs, len(segs)) for key, segs in self.cold.items()]
+        changes = [(key, seqs, mids, len(seqs)) for key, (seqs, mids) in self.changes.items()]
+        conv_total = list(self.conv_total.items())
+        reads = [(uid, key, tuple(r)) for uid, per_user in self.reads.items() for key, r in per_user.items()]
+
+        def build() -> dict:
+            return {
+                "next": nxt,
+                "users": [[r["user_id"], r["username"], r["password_hash"]] for r in users],
+                "friendships": [[uid, sorted(fs)] for uid, fs in friendships],
+                "friend_requests": [[r["id"], r["from_user_id"], r["to_user_id"], r["status"]] for r in requests],
+                "blocked": [list(b) for b in blocked],
+                "groups": [[gid, g["name"], g["owner_id"], g["avatar"], sorted(members)]
+                           for gid, g, members in groups],
+                "messages": [[m.id, m.group_id, m.from_user_id, m.to_user_id, m.content, m.created_at,
+                              m.reply_to_id, m.recalled, None, m.reactions_rows()]
+                             for m in messages if type(m) is not int],
+                # cold messages stay in their segment files; only the references go in the snapshot
+                "segments": [[list(key), first, last, seg] for key, segs, n in cold
+                             for first, last, seg in segs[:n]],
+                "changes": [[list(key), seqs[:n].tolist(), mids[:n].tolist()] for key, seqs, mids, n in changes],
+                "conv_total": [[list(key), n] for key, n in conv_total],
+                "reads": [[uid, list(key), *r] for uid, key, r in reads],
+            }
+        return build
+
+    def restore(self, snap: dict) -> None:
+        self.next_uid, self.next_msg_id, self.next_req_id, self.next_gid, *rest = snap["next"]
+        self.next_seg = rest[0] if rest else 0
+        self.change_seq = rest[1] if len(rest) > 1 else 0
+        for uid, username, pw_hash in snap["users"]:
+            rec = {"password_hash": pw_hash, "user_id": uid, "username": username}
+            self.users[username] = rec
+            self.users_by_id[uid] = rec
+        for uid, friends in snap["friendships"]:
+            self.friendships[uid] = set(friends)
+        for req_id, frm, to, status in sorted(snap["friend_requests"]):
+            req = {"id": req_id, "from_user_id": frm, "to_user_id": to, "status": status}
+            if status == "pending":
+                self.friend_requests[req_id] = req
+                self.requests_out.setdefault(frm, {})[req_id] = req
+                self.requests_in.setdefault(to, {})[req_id] = req
+            else:
+                self.friend_requests_done[req_id] = req
+        self.blocked = {(a, b) for a, b in snap["blocked"]}
+        for gid, name, owner, avatar, members in snap["groups"]:
+            self.groups[gid] = {"name": name, "owner_id": owner, "avatar": avatar}
+            self.group_members[gid] = set()
+            for uid in members:
+                self._add_member(gid, uid)
+        self.messages = [None] * (self.next_msg_id - 1)
+        cold_upto: Dict[tuple, int] = {}
+        segs = snap.get("segments") or []
+        if segs and self.segments is None:
+            raise ValueError("snapshot references cold segments, start the server with tiering enabled")
+        for key, first, last, seg in segs:
+            key = tuple(key)
+            self.cold.setdefault(key, []).append((first, last, seg))
+            self.seg_keys[seg] = key
+            cold_upto[key] = last
+            for mid in self.segments.ids(seg):
+                self.messages[mid - 1] = seg
+        for row in snap["messages"]:
+            rec = decode_message(row)
+            self.messages[rec.id - 1] = rec
+            key = self.conv_key_of(rec)
+            if rec.id > cold_upto.get(key, 0):
+                self.conversations.setdefault(key, []).append(rec)
+        for key, seqs, mids in snap.get("changes") or []:
+            self.changes[tuple(key)] = (array("q", seqs), array("q", mids))
+        for key, n in snap.get("conv_total") or []:
+            self.conv_total[tuple(key)] = n
+        for uid, key, sent, *r in snap.get("reads") or []:
+            if type(sent) is list:
+                # older snapshots: the ids the user sent instead of the counts
+                seen, last_read = r
+                r = [seen, last_read, sent[-1] if sent else 0, bisect_right(sent, last_read)]
+                sent = len(sent)
+            self.reads.setdefault(uid, {})[tuple(key)] = [sent, *r]
+        for key in (*self.conversations, *self.cold):
+            if key[0] == "dm":
+                self.dm_peers.setdefault(key[1], set()).add(key[2])
+                self.dm_peers.setdefault(key[2], set()).add(key[1])
+
+
+CHANGES_COMPACT_MIN = 64  # a conversation's change log is not compacted below this many entries
+
+
+def _log_tail(log: tuple[array, array], i: int):
+    seqs, mids = log
+    for j in range(i, len(seqs)):
+        yield seqs[j], mids[j]
 
 
 STATE = State()
+# backend used by route(): STATE by default, SQLiteStore with --storage sqlite:PATH
+STORE: Store = STATE
+# presence is not storage: user_id -> logged-in connection
+USER_CONNS: Dict[int, "Connection"] = {}
+# AUTH_OK carries a token from here; AUTH_RESUME with it skips the password check
+SESSIONS = TokenSigner(secret_from_env(), ttl=7 * 24 * 3600)
+# --workers N: link to the broker that reaches users connected to the other workers
+BUS: BusClient | None = None
+_DB_EXECUTOR: ThreadPoolExecutor | None = None
+
+
+async def db(fn: Callable, *args):
+    """Gọi phương thức của STORE; store blocking (SQLite) chạy trên thread pool, không chặn event loop."""
+    if not STORE.blocking:
+        return fn(*args)
+    global _DB_EXECUTOR
+    if _DB_EXECUTOR is None:
+        _DB_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="db")
+    return await asyncio.get_running_loop().run_in_executor(_DB_EXECUTOR, fn, *args)
+
+
+# outbound queue limits per connection, in bytes waiting to be written (see Connection)
+OUTBOX_SOFT_LIMIT = 256 * 1024   # above this, ephemeral pushes are dropped
+OUTBOX_HARD_LIMIT = 1024 * 1024  # above this, the client is disconnected
+# a connection's writer waits for the socket only above this many bytes in the transport buffer
+DRAIN_THRESHOLD = 64 * 1024
+# pushes a client can miss without ending up in a wrong state (it re-fetches lists/seen marks)
+EPHEMERAL_TYPES = {"MSG_SEEN_UPDATE", "FRIEND_LIST_UPDATE", "GROUP_LIST_UPDATE"}
+# admission control (--rate-limit, --type-limit, --limit-action, --max-inflight); nothing is limited by default
+LIMITS = RateLimits()
+HISTORY_MAX = 200  # messages per MSG_HISTORY / GROUP_HISTORY page; a larger limit is lowered to this
+# commands of one connection received and not answered yet before the server stops reading its socket
+PIPELINE_DEPTH = 256
 
 
-async def send(writer: asyncio.StreamWriter, obj: dict) -> None:
+def encode(obj: dict) -> bytes:
+    return codec.encode_line(obj)
+
+
+def encode_or_error(enc: Callable[[dict], bytes], obj: dict) -> bytes:
+    # a value the wire format cannot carry (e.g. an int past 64 bits echoed from a request)
+    # is answered with an ERROR instead of ending the connection
     try:
-        data = (json.dumps(obj) + "\n").encode()
-        writer.write(data)
-        await writer.drain()
-    except Exception:
-        pass
+        return enc(obj)
+    except (TypeError, ValueError):
+        typ = obj.get("type")
+        return enc({"type": "ERROR", "data": {"code": "UNENCODABLE", "got": typ if isinstance(typ, str) else None}})
 
 
-async def broadcast_to_user(user_id: int, obj: dict) -> None:
-    w = STATE.user_conns.get(user_id)
-    if w is not None:
+# wire formats a client can pick with HELLO; JSON-lines is what every connection starts with
+WIRE_ENCODERS: Dict[str, Callable[[dict], bytes]] = {"json": encode, binproto.FORMAT: binproto.encode_frame}
+
+
+class Connection:
+    """
+    Một kết nối client: hàng đợi gửi có giới hạn + task ghi riêng.
+    push() không bao giờ chờ socket, nên một thành viên chậm không làm trễ fanout
+    tới những người khác hay kết nối của người gửi.
+    Client chậm: quá OUTBOX_SOFT_LIMIT thì bỏ các push ephemeral, quá OUTBOX_HARD_LIMIT thì ngắt kết nối.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self.writer = writer
+        self.peer = writer.get_extra_info("peername")
+        self.outbox: deque[bytes] = deque()
+        self.pending = 0    # bytes queued and not yet handed to the transport
+        self.dropped = 0    # ephemeral frames dropped because the client was slow
+        self.closed = False
+        self.fmt = "json"
+        self.encode = encode
+        self.limiter = LIMITS.connection(time.monotonic()) if LIMITS.enabled else None
+        self.inflight = 0   # commands received and not answered yet (queued or running)
+        self._wakeup = asyncio.Event()
+        self._flushed = asyncio.Event()
+        self._answered = asyncio.Event()
+        self._task = asyncio.create_task(self._write_loop())
+
+    def push(self, obj: dict) -> bool:
+        return self.push_frame(encode_or_error(self.encode, obj), obj.get("type") in EPHEMERAL_TYPES)
+
+    def set_format(self, fmt: str) -> None:
+        self.fmt = fmt
+        self.encode = WIRE_ENCODERS[fmt]
+
+    def push_frame(self, data: bytes, ephemeral: bool = False) -> bool:
+        """Queue an already encoded frame; the same bytes object may be shared by many connections."""
+        if self.closed:
+            return False
+        size = self.pending + len(data)
+        if size > OUTBOX_SOFT_LIMIT and ephemeral:
+            self.dropped += 1
+            return False
+        if size > OUTBOX_HARD_LIMIT:
+            print(f"Disconnecting slow consumer {self.peer}: {self.pending} bytes queued")
+            self.abort()
+            return False
+        self.outbox.append(data)
+        self.pending += len(data)
+        self._wakeup.set()
+        return True
+
+    async def _write_loop(self) -> None:
+        # every frame pushed during one loop iteration goes out in a single writelines();
+        # drain (and yield to the loop) only when the transport buffer is over DRAIN_THRESHOLD
+        transport = self.writer.transport
         try:
-            await send(w, obj)
-        except Exception as e:
-            print(f"Error broadcasting to user {user_id}: {e}")
-            # Remove dead connection
-            STATE.user_conns.pop(user_id, None)
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                if not self.outbox:
+                    continue
+                frames = list(self.outbox)
+                self.outbox.clear()
+                self.writer.writelines(frames)
+                self.pending -= sum(map(len, frames))
+                self._flushed.set()
+                if transport.get_write_buffer_size() > DRAIN_THRESHOLD:
+                    await self.writer.drain()
+        except (ConnectionError, RuntimeError):
+            self.abort()
 
+    def answered(self) -> None:
+        # a command's handler (executor work included) has finished
+        self.inflight -= 1
+        self._answered.set()
 
-def find_msg(mid: int) -> dict | None:
-    for m in STATE.messages:
-        if m["id"] == mid:
-            return m
-    return None
+    async def inflight_below(self, n: int) -> None:
+        """Chờ tới khi số lệnh đang chờ trả lời < n (hoặc kết nối đã đóng)."""
+        while self.inflight >= n and not self.closed:
+            self._answered.clear()
+            await self._answered.wait()
 
+    async def drained(self) -> None:
+        """Chờ tới khi mọi frame đã xếp hàng được chuyển cho transport (dùng khi trả về nhiều frame liên tiếp)."""
+        while self.pending and not self.closed:
+            self._flushed.clear()
+            await self._flushed.wait()
+
+    def abort(self) -> None:
+        # drop everything queued and reset the socket; the reader side then ends handle_client
+        if self.closed:
+            return
+        self.closed = True
+        self.outbox.clear()
+        self.pending = 0
+        self._flushed.set()
+        self._answered.set()
+        self._task.cancel()
+        self.writer.transport.abort()
+
+    async def close(self) -> None:
+        # hand whatever is still queued (e.g. a final ERROR) to the transport, which flushes it on close
+        if not self.closed and self.outbox:
+            self.writer.writelines(self.outbox)
+            self.outbox.clear()
+        self.closed = True
+        self._flushed.set()
+        self._answered.set()
+        self._task.cancel()
+        try:
+            self.writer.close()
+            await self.writer.wait_closed()
+        except Exception:
+            pass
+
+
+class BatchCollector:
+    """Frames addressed to the connection running a BATCH item; they are returned in BATCH_RESULT."""
+
+    __slots__ = ("conn", "replies")
+
+    def __init__(self, conn: Connection) -> None:
+        self.conn = conn
+        self.replies: list[dict] = []
+
+
+# set by the BATCH handler around each item, per task, so other clients' pushes are unaffected
+_BATCH: ContextVar[BatchCollector | None] = ContextVar("batch", default=None)
 
-async def route(session: dict, writer: asyncio.StreamWriter, msg: dict) -> None:
-    typ = msg.get("type")
-    data = msg.get("data") or {}
 
-    # ping
-    if typ == "PING":
-        await send(writer, {"type": "PONG", "data": {}})
+async def send(conn: Connection, obj: dict) -> None:
+    batch = _BATCH.get()
+    if batch is not None and batch.conn is conn:
+        batch.replies.append(obj)
         return
+    conn.push(obj)
 
-    # auth
-    if typ == "AUTH_REGISTER":
-        u, p = data.get("username"), data.get("password")
-        if not u or not p:
-            await send(writer, {"type": "AUTH_FAIL", "data": {"reason": "missing_fields"}})
-            return
-        if u in STATE.users:
-            await send(writer, {"type": "AUTH_FAIL", "data": {"reason": "user_exists"}})
-            return
-        STATE.users[u] = {"password_hash": _hash(p), "user_id": STATE.next_uid}
-        STATE.friendships[STATE.next_uid] = set()
-        STATE.next_uid += 1
-        uid = STATE.users[u]["user_id"]
-        await send(writer, {"type": "AUTH_OK", "data": {"username": u, "user_id": uid}})
-        return
-
-    if typ == "AUTH_LOGIN":
-        u, p = data.get("username"), data.get("password")
-        rec = STATE.users.get(u)
-        if not rec or rec["password_hash"] != _hash(p):
-            await send(writer, {"type": "AUTH_FAIL", "data": {"reason": "invalid_credentials"}})
-            return
-        session["user_id"] = rec["user_id"]
-        session["username"] = u
-        STATE.user_conns[rec["user_id"]] = writer
-        await send(writer, {"type": "AUTH_OK", "data": {"username": u, "user_id": rec["user_id"]}})
+
+async def broadcast_to_user(user_id: int, obj: dict) -> None:
+    conn = USER_CONNS.get(user_id)
+    if conn is not None:
+        await send(conn, obj)
+    elif BUS is not None:
+        BUS.publish(obj, [user_id])
+
+
+def fanout(obj: dict, user_ids: Iterable[int] = (), conn: Connection | None = None) -> None:
+    """
+    Encode obj once per wire format and queue the same frame on conn (the requester)
+    and every online user in user_ids. With --workers, users not connected here go to the bus.
+    """
+    frames: Dict[str, bytes] = {}
+    ephemeral = obj["type"] in EPHEMERAL_TYPES
+    batch = _BATCH.get()
+    if BUS is None:
+        conns = [USER_CONNS.get(uid) for uid in user_ids]
+    else:
+        conns, remote = [], []
+        for uid in user_ids:
+            c = USER_CONNS.get(uid)
+            if c is None:
+                remote.append(uid)
+            else:
+                conns.append(c)
+        if remote:
+            BUS.publish(obj, remote)
+    if conn is not None:
+        conns.append(conn)
+    for c in conns:
+        if c is None:
+            continue
+        if batch is not None and c is batch.conn:
+            batch.replies.append(obj)
+            continue
+        data = frames.get(c.fmt)
+        if data is None:
+            data = frames[c.fmt] = encode_or_error(c.encode, obj)
+        c.push_frame(data, ephemeral)
+
+
+HANDLERS = Registry()
+
+
+# ping
+@HANDLERS.on("PING", auth=False)
+async def _on_ping(session: dict, conn: Connection, data: dict) -> None:
+    await send(conn, {"type": "PONG", "data": {}})
+
+
+# auth
+@HANDLERS.on("AUTH_REGISTER", auth=False)
+async def _on_auth_register(session: dict, conn: Connection, data: dict) -> None:
+    u, p = data.get("username"), data.get("password")
+    if not u or not p:
+        await send(conn, {"type": "AUTH_FAIL", "data": {"reason": "missing_fields"}})
         return
+    rec = await db(STORE.add_user, u, await hash_password(p))
+    if rec is None:
+        await send(conn, {"type": "AUTH_FAIL", "data": {"reason": "user_exists"}})
+        return
+    await send(conn, {"type": "AUTH_OK", "data": {"username": u, "user_id": rec["user_id"]}})
+
+
+def _log_in(session: dict, conn: Connection, rec: dict) -> dict:
+    uid, username = rec["user_id"], rec["username"]
+    session["user_id"] = uid
+    session["username"] = username
+    USER_CONNS[uid] = conn
+    if BUS is not None:
+        BUS.online(uid)
+    return {"type": "AUTH_OK", "data": {"username": username, "user_id": uid, "token": SESSIONS.issue(rec)}}
+
 
-    # guard
-    if not session.get("user_id"):
-        await send(writer, {"type": "ERROR", "data": {"code": "UNAUTH"}})
+@HANDLERS.on("AUTH_LOGIN", auth=False)
+async def _on_auth_login(session: dict, conn: Connection, data: dict) -> None:
+    u, p = data.get("username"), data.get("password")
+    rec = await db(STORE.get_user, u) if isinstance(u, str) and isinstance(p, str) else None
+    if not rec or not hmac.compare_digest(rec["password_hash"], await hash_password(p)):
+        await send(conn, {"type": "AUTH_FAIL", "data": {"reason": "invalid_credentials"}})
         return
+    await send(conn, _log_in(session, conn, rec))
+
+
+@HANDLERS.on("AUTH_RESUME", auth=False)
+async def _on_auth_resume(session: dict, conn: Connection, data: dict) -> None:
+    # reconnect with the token from an earlier AUTH_OK: one HMAC instead of a password hash.
+    # The account must still be the one the token was issued for (same username and password hash):
+    # an id may belong to someone else by now, e.g. an in-memory store after a restart
+    claim = SESSIONS.verify(data.get("token"))
+    rec = await db(STORE.get_user, await db(STORE.username_of, claim[0])) if claim is not None else None
+    if rec is None or rec["user_id"] != claim[0] or not hmac.compare_digest(SESSIONS.fingerprint(rec), claim[1]):
+        await send(conn, {"type": "AUTH_FAIL", "data": {"reason": "invalid_token"}})
+        return
+    await send(conn, _log_in(session, conn, rec))
+
+
+# friends
+@HANDLERS.on("FRIEND_REQUEST")
+async def _on_friend_request(session: dict, conn: Connection, data: dict) -> None:
     me = session["user_id"]
+    to_uid = data.get("to_user_id")
+    if not isinstance(to_uid, int) or to_uid == me:
+        await send(conn, {"type": "ERROR", "data": {"code": "BAD_FRIEND_REQUEST"}})
+        return
+    req_id = (await db(STORE.add_friend_request, me, to_uid))["id"]
+    await send(conn, {"type": "FRIEND_REQUEST_SENT", "data": {"request_id": req_id, "to_user_id": to_uid}})
+    await broadcast_to_user(to_uid, {"type": "FRIEND_REQUEST_INCOMING",
+                                     "data": {"request_id": req_id, "from_user_id": me,
+                                               "from_username": session["username"]}})
 
-    # friends
-    if typ == "FRIEND_REQUEST":
-        to_uid = data.get("to_user_id")
-        if not isinstance(to_uid, int) or to_uid == me:
-            await send(writer, {"type": "ERROR", "data": {"code": "BAD_FRIEND_REQUEST"}})
-            return
-        req_id = STATE.next_req_id
-        STATE.next_req_id += 1
-        STATE.friend_requests.append({"id": req_id, "from_user_id": me, "to_user_id": to_uid, "status": "pending"})
-        await send(writer, {"type": "FRIEND_REQUEST_SENT", "data": {"request_id": req_id, "to_user_id": to_uid}})
-        await broadcast_to_user(to_uid, {"type": "FRIEND_REQUEST_INCOMING",
-                                         "data": {"request_id": req_id, "from_user_id": me,
-                                                   "from_username": STATE.username_of(me)}})
-        return
-
-    if typ == "FRIEND_ACCEPT":
-        req_id = data.get("request_id")
-        req = next((r for r in STATE.friend_requests if r["id"] == req_id), None)
-        if not req or req["to_user_id"] != me or req["status"] != "pending":
-            await send(writer, {"type": "ERROR", "data": {"code": "BAD_FRIEND_ACCEPT"}})
-            return
-        req["status"] = "accepted"
-        a, b = req["from_user_id"], req["to_user_id"]
-        STATE.friendships.setdefault(a, set()).add(b)
-        STATE.friendships.setdefault(b, set()).add(a)
-        payload = {"type": "FRIEND_ACCEPTED", "data": {"user_id1": a, "user_id2": b}}
-        await send(writer, payload)
-        await broadcast_to_user(a, payload)
-        
-        # Gửi thông báo cập nhật danh sách bạn bè cho cả 2 user
-        await asyncio.gather(
-            broadcast_to_user(a, {"type": "FRIEND_LIST_UPDATE", "data": {}}),
-            broadcast_to_user(b, {"type": "FRIEND_LIST_UPDATE", "data": {}}),
-            return_exceptions=True
-        )
-        return
-
-    if typ == "FRIEND_REMOVE":
-        uid = data.get("user_id")
-        if not isinstance(uid, int) or uid == me:
-            await send(writer, {"type": "ERROR", "data": {"code": "BAD_FRIEND_REMOVE"}})
-            return
-        # remove friendship both directions
-        if me in STATE.friendships:
-            STATE.friendships[me].discard(uid)
-        if uid in STATE.friendships:
-            STATE.friendships[uid].discard(me)
-        payload = {"type": "FRIEND_REMOVED", "data": {"user_id": uid}}
-        await send(writer, payload)
-        await broadcast_to_user(uid, {"type": "FRIEND_REMOVED", "data": {"user_id": me}})
-        
-        # Gửi thông báo cập nhật danh sách bạn bè cho cả 2 user
-        await asyncio.gather(
-            broadcast_to_user(me, {"type": "FRIEND_LIST_UPDATE", "data": {}}),
-            broadcast_to_user(uid, {"type": "FRIEND_LIST_UPDATE", "data": {}}),
-            return_exceptions=True
-        )
-        return
-
-    if typ == "FRIEND_LIST":
-        friends = [{"user_id": uid, "username": STATE.username_of(uid), "status": "accepted"}
-                   for uid in sorted(STATE.friendships.get(me, set()))]
-        pending_in = [{"request_id": r["id"], "from_user_id": r["from_user_id"],
-                       "from_username": STATE.username_of(r["from_user_id"]) }
-                      for r in STATE.friend_requests if r["to_user_id"] == me and r["status"] == "pending"]
-        pending_out = [{"request_id": r["id"], "to_user_id": r["to_user_id"],
-                        "to_username": STATE.username_of(r["to_user_id"]) }
-                       for r in STATE.friend_requests if r["from_user_id"] == me and r["status"] == "pending"]
-        await send(writer, {"type": "FRIEND_LIST_RESULT",
-                            "data": {"friends": friends, "pending_in": pending_in, "pending_out": pending_out}})
-        return
-
-    if typ == "FRIEND_BLOCK":
-        uid = data.get("user_id")
-        if not isinstance(uid, int) or uid == me:
-            await send(writer, {"type": "ERROR", "data": {"code": "BAD_BLOCK"}})
-            return
-        STATE.blocked.add((me, uid))
-        await send(writer, {"type": "FRIEND_BLOCKED", "data": {"user_id": uid}})
+
+@HANDLERS.on("FRIEND_ACCEPT")
+async def _on_friend_accept(session: dict, conn: Connection, data: dict) -> None:
+    me = session["user_id"]
+    req_id = data.get("request_id")
+    req = await db(STORE.get_friend_request, req_id) if isinstance(req_id, int) else None
+    if not req or req["to_user_id"] != me:
+        await send(conn, {"type": "ERROR", "data": {"code": "BAD_FRIEND_ACCEPT"}})
         return
+    await db(STORE.accept_friend_request, req)
+    a, b = req["from_user_id"], req["to_user_id"]
+    fanout({"type": "FRIEND_ACCEPTED", "data": {"user_id1": a, "user_id2": b}}, (a,), conn)
+    
+    # Gửi thông báo cập nhật danh sách bạn bè cho cả 2 user
+    fanout({"type": "FRIEND_LIST_UPDATE", "data": {}}, (a, b))
 
-    if typ == "FRIEND_UNBLOCK":
-        uid = data.get("user_id")
-        STATE.blocked.discard((me, uid))
-        await send(writer, {"type": "FRIEND_UNBLOCKED", "data": {"user_id": uid}})
+
+@HANDLERS.on("FRIEND_REMOVE")
+async def _on_friend_remove(session: dict, conn: Connection, data: dict) -> None:
+    me = session["user_id"]
+    uid = data.get("user_id")
+    if not isinstance(uid, int) or uid == me:
+        await send(conn, {"type": "ERROR", "data": {"code": "BAD_FRIEND_REMOVE"}})
         return
+    # remove friendship both directions
+    await db(STORE.remove_friendship, me, uid)
+    payload = {"type": "FRIEND_REMOVED", "data": {"user_id": uid}}
+    await send(conn, payload)
+    await broadcast_to_user(uid, {"type": "FRIEND_REMOVED", "data": {"user_id": me}})
+    
+    # Gửi thông báo cập nhật danh sách bạn bè cho cả 2 user
+    fanout({"type": "FRIEND_LIST_UPDATE", "data": {}}, (me, uid))
 
-    # 1-1 messages
-    if typ == "MSG_SEND":
-        to_uid = data.get("to_user_id")
-        content = (data.get("content") or "").strip()
-        reply_to_id = data.get("reply_to_id")
-        if not to_uid or not content:
-            await send(writer, {"type": "ERROR", "data": {"code": "BAD_MSG"}})
-            return
-        if to_uid == me:
-            await send(writer, {"type": "ERROR", "data": {"code": "BAD_MSG_SELF"}})
-            return
-        if (to_uid, me) in STATE.blocked:
-            await send(writer, {"type": "ERROR", "data": {"code": "BLOCKED_BY_PEER"}})
-            return
-        # Check if they are friends
-        if to_uid not in STATE.friendships.get(me, set()) or me not in STATE.friendships.get(to_uid, set()):
-            await send(writer, {"type": "ERROR", "data": {"code": "NOT_FRIENDS"}})
-            return
-        mid = STATE.next_msg_id
-        STATE.next_msg_id += 1
-        rec = {"id": mid, "from_user_id": me, "to_user_id": to_uid, "content": content,
-               "created_at": time.time(), "reply_to_id": reply_to_id, "recalled": False,
-               "seen_by": set(), "reactions": {}}
-        STATE.messages.append(rec)
-        payload = {"type": "MSG_RECV",
-                   "data": {"message_id": rec["id"], "from_user_id": me, "to_user_id": to_uid,
-                             "content": content, "created_at": rec["created_at"], "reply_to_id": reply_to_id,
-                             "recalled": False, "reactions_summary": {}}}
-        await send(writer, payload)
-        await broadcast_to_user(to_uid, payload)
-        return
-
-    if typ == "MSG_HISTORY":
-        peer_id = data.get("peer_id"); before_id = data.get("before_id"); limit = int(data.get("limit") or 50)
-        conv = [m for m in STATE.messages if ("group_id" not in m) and
-                ((m["from_user_id"] == me and m["to_user_id"] == peer_id) or
-                 (m["from_user_id"] == peer_id and m["to_user_id"] == me))]
-        conv.sort(key=lambda x: x["id"], reverse=True)
-        if before_id:
-            conv = [m for m in conv if m["id"] < before_id]
-        batch = conv[:limit]; has_more = len(conv) > limit
-        batch_sorted = sorted(batch, key=lambda x: x["id"])
-        res = {"peer_id": peer_id,
-               "messages": [{"message_id": m["id"], "from_user_id": m["from_user_id"], "to_user_id": m["to_user_id"],
-                              "content": m["content"], "created_at": m["created_at"], "reply_to_id": m.get("reply_to_id"),
-                              "recalled": m.get("recalled", False), "reactions_summary": STATE.reactions_summary(m)}
-                             for m in batch_sorted],
-               "has_more": has_more}
-        await send(writer, {"type": "MSG_HISTORY_RESULT", "data": res})
-        return
-
-    # groups
-    if typ == "GROUP_CREATE":
-        name = (data.get("name") or "").strip(); avatar = data.get("avatar")
-        if not name:
-            await send(writer, {"type": "ERROR", "data": {"code": "BAD_GROUP_NAME"}})
-            return
-        gid = STATE.next_gid; STATE.next_gid += 1
-        STATE.groups[gid] = {"name": name, "owner_id": me, "avatar": avatar}
-        STATE.group_members[gid] = {me}
-        await send(writer, {"type": "GROUP_CREATED", "data": {"group_id": gid, "name": name}})
+
+@HANDLERS.on("FRIEND_LIST")
+async def _on_friend_list(session: dict, conn: Connection, data: dict) -> None:
+    me = session["user_id"]
+    await send(conn, {"type": "FRIEND_LIST_RESULT", "data": await db(STORE.friend_list, me)})
+
+
+@HANDLERS.on("FRIEND_BLOCK")
+async def _on_friend_block(session: dict, conn: Connection, data: dict) -> None:
+    me = session["user_id"]
+    uid = data.get("user_id")
+    if not isinstance(uid, int) or uid == me:
+        await send(conn, {"type": "ERROR", "data": {"code": "BAD_BLOCK"}})
         return
+    await db(STORE.block, me, uid)
+    await send(conn, {"type": "FRIEND_BLOCKED", "data": {"user_id": uid}})
 
-    if typ == "GROUP_ADD":
-        gid = data.get("group_id"); uid = data.get("user_id")
-        info = STATE.groups.get(gid)
-        if not info or info["owner_id"] != me or not isinstance(uid, int):
-            await send(writer, {"type": "ERROR", "data": {"code": "BAD_GROUP_ADD"}})
-            return
-        
-        print(f"GROUP_ADD: User {me} adding user {uid} to group {gid}")
-        
-        # Kiểm tra user có tồn tại không
-        user_exists = any(rec["user_id"] == uid for rec in STATE.users.values())
-        if not user_exists:
-            await send(writer, {"type": "ERROR", "data": {"code": "USER_NOT_FOUND"}})
-            return
-        
-        # Gửi lời mời thay vì thêm trực tiếp
-        if uid != me:  # Không gửi cho chính mình
-            invitation_msg = {"type": "GROUP_INVITATION", "data": {
-                "group_id": gid, 
-                "group_name": info["name"], 
-                "from_user_id": me
-            }}
-            print(f"Sending invitation to user {uid}: {invitation_msg}")
-            await broadcast_to_user(uid, invitation_msg)
-        
-        # Thông báo cho người thêm thành viên
-        mine = [{"group_id": k, "name": v["name"], "member_count": len(STATE.group_members.get(k, set()))}
-                for k, v in STATE.groups.items() if me in STATE.group_members.get(k, set())]
-        await send(writer, {"type": "GROUP_LIST_RESULT", "data": {"groups": mine}})
-        
-        return
-
-    if typ == "GROUP_ACCEPT_INVITATION":
-        gid = data.get("group_id")
-        info = STATE.groups.get(gid)
-        if not info:
-            await send(writer, {"type": "ERROR", "data": {"code": "GROUP_NOT_FOUND"}})
-            return
-        print(f"GROUP_ACCEPT_INVITATION: User {me} accepting invitation to group {gid}")
-        STATE.group_members.setdefault(gid, set()).add(me)
-        group_info = {"group_id": gid, "name": info["name"], "member_count": len(STATE.group_members.get(gid, set()))}
-        await send(writer, {"type": "GROUP_ACCEPTED", "data": {"group": group_info}})
-        
-        # Gửi thông báo cập nhật danh sách nhóm cho tất cả thành viên trong nhóm
-        update_tasks = []
-        for member_id in STATE.group_members.get(gid, set()):
-            if member_id != me:  # Không gửi cho chính mình vì đã gửi GROUP_ACCEPTED rồi
-                update_tasks.append(broadcast_to_user(member_id, {"type": "GROUP_LIST_UPDATE", "data": {}}))
-        
-        # Gửi tất cả thông báo cập nhật cùng lúc
-        if update_tasks:
-            await asyncio.gather(*update_tasks, return_exceptions=True)
-        
-        # Gửi thông báo cập nhật cho chính mình ngay lập tức
-        await send(writer, {"type": "GROUP_LIST_UPDATE", "data": {}})
-        return
-
-    if typ == "GROUP_REJECT_INVITATION":
-        gid = data.get("group_id")
-        info = STATE.groups.get(gid)
-        if not info:
-            await send(writer, {"type": "ERROR", "data": {"code": "GROUP_NOT_FOUND"}})
-            return
-        await send(writer, {"type": "GROUP_REJECTED", "data": {"group_id": gid}})
-        
-        # Thông báo cho chủ nhóm biết lời mời bị từ chối
-        owner_id = info["owner_id"]
-        if owner_id != me:
-            await broadcast_to_user(owner_id, {"type": "GROUP_INVITATION_REJECTED", "data": {"group_id": gid, "user_id": me}})
+
+@HANDLERS.on("FRIEND_UNBLOCK")
+async def _on_friend_unblock(session: dict, conn: Connection, data: dict) -> None:
+    me = session["user_id"]
+    uid = data.get("user_id")
+    await db(STORE.unblock, me, uid)
+    await send(conn, {"type": "FRIEND_UNBLOCKED", "data": {"user_id": uid}})
+
+
+# 1-1 messages
+@HANDLERS.on("MSG_SEND")
+async def _on_msg_send(session: dict, conn: Connection, data: dict) -> None:
+    me = session["user_id"]
+    to_uid = data.get("to_user_id")
+    content = (data.get("content") or "").strip()
+    reply_to_id = data.get("reply_to_id")
+    if not to_uid or not content:
+        await send(conn, {"type": "ERROR", "data": {"code": "BAD_MSG"}})
+        return
+    if to_uid == me:
+        await send(conn, {"type": "ERROR", "data": {"code": "BAD_MSG_SELF"}})
         return
+    if await db(STORE.is_blocked, to_uid, me):
+        await send(conn, {"type": "ERROR", "data": {"code": "BLOCKED_BY_PEER"}})
+        return
+    # Check if they are friends
+    if not await db(STORE.are_friends, me, to_uid):
+        await send(conn, {"type": "ERROR", "data": {"code": "NOT_FRIENDS"}})
+        return
+    rec = await db(STORE.add_message, Message(me, content, time.time(), to_user_id=to_uid, reply_to_id=reply_to_id))
+    payload = {"type": "MSG_RECV",
+               "data": {"message_id": rec.id, "from_user_id": me, "to_user_id": to_uid,
+                         "content": content, "created_at": rec.created_at, "reply_to_id": reply_to_id,
+                         "recalled": False, "reactions_summary": {}, "seq": rec.seq}}
+    fanout(payload, (to_uid,), conn)
+
 
-    if typ == "GROUP_LIST":
-        mine = [{"group_id": gid, "name": g["name"], "member_count": len(STATE.group_members.get(gid, set()))}
-                for gid, g in STATE.groups.items() if me in STATE.group_members.get(gid, set())]
-        await send(writer, {"type": "GROUP_LIST_RESULT", "data": {"groups": mine}})
+@HANDLERS.on("MSG_HISTORY")
+async def _on_msg_history(session: dict, conn: Connection, data: dict) -> None:
+    me = session["user_id"]
+    peer_id = data.get("peer_id"); before_id = data.get("before_id"); limit = _history_limit("MSG_HISTORY", data)
+    if limit is None:
+        await send(conn, {"type": "ERROR", "data": {"code": "BAD_LIMIT", "max": HISTORY_MAX}})
         return
+    if isinstance(peer_id, int):
+        batch_sorted, has_more = await db(STORE.history_page, State.dm_key(me, peer_id), before_id, limit)
+        marks = await db(STORE.read_marks, State.dm_key(me, peer_id)) if batch_sorted else {}
+    else:
+        batch_sorted, has_more, marks = [], False, {}
+    # seen: the recipient's read watermark has reached the message
+    res = {"peer_id": peer_id,
+           "messages": [{"message_id": m.id, "from_user_id": m.from_user_id, "to_user_id": m.to_user_id,
+                          "content": m.content, "created_at": m.created_at, "reply_to_id": m.reply_to_id,
+                          "recalled": m.recalled, "reactions_summary": m.reactions_summary(),
+                          "seen": marks.get(m.to_user_id, 0) >= m.id}
+                         for m in batch_sorted],
+           "has_more": has_more}
+    await send(conn, {"type": "MSG_HISTORY_RESULT", "data": res})
 
-    if typ == "GROUP_MSG_SEND":
-        gid = data.get("group_id"); content = (data.get("content") or "").strip(); reply_to_id = data.get("reply_to_id")
-        if not isinstance(gid, int) or not content:
-            await send(writer, {"type": "ERROR", "data": {"code": "BAD_GROUP_MSG"}})
-            return
-        if me not in STATE.group_members.get(gid, set()):
-            await send(writer, {"type": "ERROR", "data": {"code": "NOT_GROUP_MEMBER"}})
-            return
-        mid = STATE.next_msg_id; STATE.next_msg_id += 1
-        rec = {"id": mid, "group_id": gid, "from_user_id": me, "content": content,
-               "created_at": time.time(), "reply_to_id": reply_to_id, "recalled": False,
-               "seen_by": set(), "reactions": {}}
-        STATE.messages.append(rec)
-        payload = {"type": "GROUP_MSG_RECV",
-                   "data": {"message_id": rec["id"], "group_id": gid, "from_user_id": me,
-                             "content": content, "created_at": rec["created_at"], "reply_to_id": reply_to_id,
-                             "recalled": False, "reactions_summary": {}}}
-        for uid in list(STATE.group_members.get(gid, set())):
-            await broadcast_to_user(uid, payload)
-        return
-
-    if typ == "GROUP_HISTORY":
-        gid = data.get("group_id"); before_id = data.get("before_id"); limit = int(data.get("limit") or 50)
-        if me not in STATE.group_members.get(gid, set()):
-            await send(writer, {"type": "ERROR", "data": {"code": "NOT_GROUP_MEMBER"}})
-            return
-        conv = [m for m in STATE.messages if m.get("group_id") == gid]
-        conv.sort(key=lambda x: x["id"], reverse=True)
-        if before_id:
-            conv = [m for m in conv if m["id"] < before_id]
-        batch = conv[:limit]; has_more = len(conv) > limit
-        batch_sorted = sorted(batch, key=lambda x: x["id"])
-        res = {"group_id": gid,
-               "messages": [{"message_id": m["id"], "group_id": gid, "from_user_id": m["from_user_id"],
-                              "content": m["content"], "created_at": m["created_at"], "reply_to_id": m.get("reply_to_id"),
-                              "recalled": m.get("recalled", False), "reactions_summary": STATE.reactions_summary(m)}
-                             for m in batch_sorted],
-               "has_more": has_more}
-        await send(writer, {"type": "GROUP_HISTORY_RESULT", "data": res})
-        return
-
-    # interactions
-    if typ == "MSG_SEEN":
-        ids = data.get("message_ids") or []
-        updated: list[int] = []
-        for mid in ids:
-            rec = find_msg(mid)
-            if not rec:
-                continue
-            rec.setdefault("seen_by", set()).add(me)
-            updated.append(mid)
-        if not updated:
-            return
-        payload = {"type": "MSG_SEEN_UPDATE", "data": {"message_ids": updated, "by_user_id": me}}
-        peers: Set[int] = set(); groups: Set[int] = set()
-        for mid in updated:
-            rec = find_msg(mid)
-            if not rec:
-                continue
-            if "group_id" in rec:
-                groups.add(rec["group_id"])
-            else:
-                other = rec["to_user_id"] if rec["from_user_id"] == me else rec["from_user_id"]
-                peers.add(other)
-        await send(writer, payload)
-        for p in peers:
-            await broadcast_to_user(p, {"type": "MSG_SEEN_UPDATE", "data": payload["data"] | {"peer_id": p}})
-        for g in groups:
-            for uid in list(STATE.group_members.get(g, set())):
-                await broadcast_to_user(uid, {"type": "MSG_SEEN_UPDATE", "data": payload["data"] | {"group_id": g}})
-        return
-
-    if typ == "MSG_RECALL":
-        mid = data.get("message_id")
-        rec = find_msg(mid)
-        if not rec or rec.get("recalled"):
-            await send(writer, {"type": "ERROR", "data": {"code": "BAD_RECALL"}})
-            return
-        if rec["from_user_id"] != me:
-            await send(writer, {"type": "ERROR", "data": {"code": "NOT_OWNER"}})
-            return
-        rec["recalled"] = True
-        rec["content"] = ""
-        payload = {"type": "MSG_RECALL_UPDATE", "data": {"message_id": mid}}
-        if "group_id" in rec:
-            for uid in list(STATE.group_members.get(rec["group_id"], set())):
-                await broadcast_to_user(uid, payload)
+
+# groups
+@HANDLERS.on("GROUP_CREATE")
+async def _on_group_create(session: dict, conn: Connection, data: dict) -> None:
+    me = session["user_id"]
+    name = (data.get("name") or "").strip(); avatar = data.get("avatar")
+    if not name:
+        await send(conn, {"type": "ERROR", "data": {"code": "BAD_GROUP_NAME"}})
+        return
+    gid = await db(STORE.create_group, me, name, avatar)
+    await send(conn, {"type": "GROUP_CREATED", "data": {"group_id": gid, "name": name}})
+
+
+@HANDLERS.on("GROUP_ADD")
+async def _on_group_add(session: dict, conn: Connection, data: dict) -> None:
+    me = session["user_id"]
+    gid = data.get("group_id"); uid = data.get("user_id")
+    info = await db(STORE.get_group, gid)
+    if not info or info["owner_id"] != me or not isinstance(uid, int):
+        await send(conn, {"type": "ERROR", "data": {"code": "BAD_GROUP_ADD"}})
+        return
+    
+    print(f"GROUP_ADD: User {me} adding user {uid} to group {gid}")
+    
+    # Kiểm tra user có tồn tại không
+    if not await db(STORE.user_exists, uid):
+        await send(conn, {"type": "ERROR", "data": {"code": "USER_NOT_FOUND"}})
+        return
+    
+    # Gửi lời mời thay vì thêm trực tiếp
+    if uid != me:  # Không gửi cho chính mình
+        invitation_msg = {"type": "GROUP_INVITATION", "data": {
+            "group_id": gid, 
+            "group_name": info["name"], 
+            "from_user_id": me
+        }}
+        print(f"Sending invitation to user {uid}: {invitation_msg}")
+        await broadcast_to_user(uid, invitation_msg)
+    
+    # Thông báo cho người thêm thành viên
+    await send(conn, {"type": "GROUP_LIST_RESULT", "data": {"groups": await db(STORE.groups_of, me)}})
+    
+
+
+@HANDLERS.on("GROUP_ACCEPT_INVITATION")
+async def _on_group_accept_invitation(session: dict, conn: Connection, data: dict) -> None:
+    me = session["user_id"]
+    gid = data.get("group_id")
+    info = await db(STORE.get_group, gid)
+    if not info:
+        await send(conn, {"type": "ERROR", "data": {"code": "GROUP_NOT_FOUND"}})
+        return
+    print(f"GROUP_ACCEPT_INVITATION: User {me} accepting invitation to group {gid}")
+    await db(STORE.add_group_member, gid, me)
+    group_info = await db(STORE.group_summary, gid)
+    await send(conn, {"type": "GROUP_ACCEPTED", "data": {"group": group_info}})
+    
+    # Gửi thông báo cập nhật danh sách nhóm cho tất cả thành viên trong nhóm
+    # (chính mình nhận qua conn, không qua USER_CONNS)
+    members = await db(STORE.members_of, gid)
+    fanout({"type": "GROUP_LIST_UPDATE", "data": {}}, (uid for uid in members if uid != me), conn)
+
+
+@HANDLERS.on("GROUP_REJECT_INVITATION")
+async def _on_group_reject_invitation(session: dict, conn: Connection, data: dict) -> None:
+    me = session["user_id"]
+    gid = data.get("group_id")
+    info = await db(STORE.get_group, gid)
+    if not info:
+        await send(conn, {"type": "ERROR", "data": {"code": "GROUP_NOT_FOUND"}})
+        return
+    await send(conn, {"type": "GROUP_REJECTED", "data": {"group_id": gid}})
+    
+    # Thông báo cho chủ nhóm biết lời mời bị từ chối
+    owner_id = info["owner_id"]
+    if owner_id != me:
+        await broadcast_to_user(owner_id, {"type": "GROUP_INVITATION_REJECTED", "data": {"group_id": gid, "user_id": me}})
+
+
+@HANDLERS.on("GROUP_LIST")
+async def _on_group_list(session: dict, conn: Connection, data: dict) -> None:
+    me = session["user_id"]
+    await send(conn, {"type": "GROUP_LIST_RESULT", "data": {"groups": await db(STORE.groups_of, me)}})
+
+
+@HANDLERS.on("GROUP_MSG_SEND")
+async def _on_group_msg_send(session: dict, conn: Connection, data: dict) -> None:
+    me = session["user_id"]
+    gid = data.get("group_id"); content = (data.get("content") or "").strip(); reply_to_id = data.get("reply_to_id")
+    if not isinstance(gid, int) or not content:
+        await send(conn, {"type": "ERROR", "data": {"code": "BAD_GROUP_MSG"}})
+        return
+    members = await db(STORE.members_of, gid)
+    if me not in members:
+        await send(conn, {"type": "ERROR", "data": {"code": "NOT_GROUP_MEMBER"}})
+        return
+    rec = await db(STORE.add_message, Message(me, content, time.time(), group_id=gid, reply_to_id=reply_to_id))
+    payload = {"type": "GROUP_MSG_RECV",
+               "data": {"message_id": rec.id, "group_id": gid, "from_user_id": me,
+                         "content": content, "created_at": rec.created_at, "reply_to_id": reply_to_id,
+                         "recalled": False, "reactions_summary": {}, "seq": rec.seq}}
+    fanout(payload, members)
+
+
+@HANDLERS.on("GROUP_HISTORY")
+async def _on_group_history(session: dict, conn: Connection, data: dict) -> None:
+    me = session["user_id"]
+    gid = data.get("group_id"); before_id = data.get("before_id"); limit = _history_limit("GROUP_HISTORY", data)
+    if limit is None:
+        await send(conn, {"type": "ERROR", "data": {"code": "BAD_LIMIT", "max": HISTORY_MAX}})
+        return
+    if not await db(STORE.is_member, gid, me):
+        await send(conn, {"type": "ERROR", "data": {"code": "NOT_GROUP_MEMBER"}})
+        return
+    batch_sorted, has_more = await db(STORE.history_page, State.group_key(gid), before_id, limit)
+    marks = await db(STORE.read_marks, State.group_key(gid)) if batch_sorted else {}
+    # seen_count: members other than the sender whose read watermark has reached the message,
+    # one bisect per message over the sorted watermarks
+    wms = sorted(marks.values())
+    res = {"group_id": gid,
+           "messages": [{"message_id": m.id, "group_id": gid, "from_user_id": m.from_user_id,
+                          "content": m.content, "created_at": m.created_at, "reply_to_id": m.reply_to_id,
+                          "recalled": m.recalled, "reactions_summary": m.reactions_summary(),
+                          "seen_count": len(wms) - bisect_left(wms, m.id) - (marks.get(m.from_user_id, 0) >= m.id)}
+                         for m in batch_sorted],
+           "has_more": has_more}
+    await send(conn, {"type": "GROUP_HISTORY_RESULT", "data": res})
+
+
+# interactions
+@HANDLERS.on("MSG_SEEN")
+async def _on_msg_seen(session: dict, conn: Connection, data: dict) -> None:
+    me = session["user_id"]
+    ids = data.get("message_ids") or []
+    # only messages of the user's own conversations move their read watermarks
+    seen_recs = await db(STORE.visible_messages, ids, me)
+    if not seen_recs:
+        return
+    updated = [rec.id for rec in seen_recs]
+    await db(STORE.mark_seen, seen_recs, me)
+    payload = {"type": "MSG_SEEN_UPDATE", "data": {"message_ids": updated, "by_user_id": me}}
+    peers: Set[int] = set(); groups: Set[int] = set()
+    for rec in seen_recs:
+        if rec.group_id is not None:
+            groups.add(rec.group_id)
         else:
-            await send(writer, payload)
-            await broadcast_to_user(rec["to_user_id"], payload)
+            peers.add(rec.other_party(me))
+    await send(conn, payload)
+    # per-recipient variants: one frame per peer, one shared frame per group
+    for p in peers:
+        fanout({"type": "MSG_SEEN_UPDATE", "data": payload["data"] | {"peer_id": p}}, (p,))
+    for g in groups:
+        fanout({"type": "MSG_SEEN_UPDATE", "data": payload["data"] | {"group_id": g}},
+               await db(STORE.members_of, g))
+
+
+@HANDLERS.on("MSG_RECALL")
+async def _on_msg_recall(session: dict, conn: Connection, data: dict) -> None:
+    me = session["user_id"]
+    mid = data.get("message_id")
+    rec = await db(STORE.get_message, mid)
+    if not rec or rec.recalled:
+        await send(conn, {"type": "ERROR", "data": {"code": "BAD_RECALL"}})
         return
+    if rec.from_user_id != me:
+        await send(conn, {"type": "ERROR", "data": {"code": "NOT_OWNER"}})
+        return
+    await db(STORE.recall_message, rec)
+    payload = {"type": "MSG_RECALL_UPDATE", "data": {"message_id": mid, "seq": rec.seq}}
+    if rec.group_id is not None:
+        fanout(payload, await db(STORE.members_of, rec.group_id))
+    else:
+        fanout(payload, (rec.to_user_id,), conn)
+
 
-    if typ == "MSG_REACT":
-        mid = data.get("message_id"); reaction = (data.get("reaction") or "").strip()
-        if not reaction:
-            await send(writer, {"type": "ERROR", "data": {"code": "BAD_REACTION"}})
+@HANDLERS.on("MSG_REACT")
+async def _on_msg_react(session: dict, conn: Connection, data: dict) -> None:
+    me = session["user_id"]
+    mid = data.get("message_id"); reaction = (data.get("reaction") or "").strip()
+    if not reaction:
+        await send(conn, {"type": "ERROR", "data": {"code": "BAD_REACTION"}})
+        return
+    rec = await db(STORE.get_message, mid)
+    if not rec:
+        await send(conn, {"type": "ERROR", "data": {"code": "MSG_NOT_FOUND"}})
+        return
+    action, counts = await db(STORE.toggle_reaction, rec, reaction, me)
+    payload = {"type": "MSG_REACT_UPDATE",
+               "data": {"message_id": mid, "reaction": reaction, "action": action, "by_user_id": me, "counts": counts,
+                        "seq": rec.seq}}
+    if rec.group_id is not None:
+        fanout(payload, await db(STORE.members_of, rec.group_id))
+    else:
+        fanout(payload, (rec.other_party(me),), conn)
+    return
+
+# inbox
+CONV_LIST_MAX = 200  # conversations per CONV_LIST page
+
+
+@HANDLERS.on("CONV_LIST")
+async def _on_conv_list(session: dict, conn: Connection, data: dict) -> None:
+    # conversations newest first; the next page is before_id = last_message.message_id of the last entry
+    me = session["user_id"]
+    before_id = data.get("before_id"); limit = data.get("limit") or 50
+    if (before_id is not None and type(before_id) is not int) or type(limit) is not int:
+        await send(conn, {"type": "ERROR", "data": {"code": "BAD_CONV_LIST"}})
+        return
+    convs, has_more = await db(STORE.inbox_page, me, before_id, min(limit, CONV_LIST_MAX))
+    await send(conn, {"type": "CONV_LIST_RESULT", "data": {"conversations": convs, "has_more": has_more}})
+
+
+# catch-up after a reconnect
+SYNC_CHUNK = 200  # messages per SYNC_RESULT frame
+
+
+def _sync_item(m: Message) -> dict:
+    item = {"message_id": m.id, "from_user_id": m.from_user_id, "content": m.content,
+            "created_at": m.created_at, "reply_to_id": m.reply_to_id, "recalled": m.recalled,
+            "reactions_summary": m.reactions_summary()}
+    if m.group_id is not None:
+        item["group_id"] = m.group_id
+    else:
+        item["to_user_id"] = m.to_user_id
+    return item
+
+
+@HANDLERS.on("SYNC")
+async def _on_sync(session: dict, conn: Connection, data: dict) -> None:
+    # every message of the user's conversations created, recalled or reacted to after the cursor,
+    # as SYNC_RESULT frames of up to SYNC_CHUNK messages; each frame carries the cursor to resume
+    # from, the last one has has_more false. Without "since" only the current cursor is returned.
+    me = session["user_id"]
+    since = data.get("since")
+    if since is not None and (type(since) is not int or since < 0):
+        await send(conn, {"type": "ERROR", "data": {"code": "BAD_SYNC"}})
+        return
+    while True:
+        recs, cursor, has_more = await db(STORE.sync_page, me, since, SYNC_CHUNK)
+        await send(conn, {"type": "SYNC_RESULT", "data": {"messages": [_sync_item(m) for m in recs],
+                                                           "cursor": cursor, "has_more": has_more}})
+        if not has_more:
             return
-        rec = find_msg(mid)
-        if not rec:
-            await send(writer, {"type": "ERROR", "data": {"code": "MSG_NOT_FOUND"}})
+        since = cursor
+        # one chunk queued at a time: a long catch-up must not trip OUTBOX_HARD_LIMIT
+        await conn.drained()
+
+
+# batches
+MAX_BATCH = 500  # commands per BATCH frame
+# a batch cannot log in, nest or stream
+_NOT_BATCHABLE = {"BATCH", "AUTH_REGISTER", "AUTH_LOGIN", "AUTH_RESUME", "HELLO", "SYNC"}
+
+
+@HANDLERS.on("BATCH")
+async def _on_batch(session: dict, conn: Connection, data: dict) -> None:
+    # run the items in order; whatever each one would have sent back to this connection
+    # is returned in a single BATCH_RESULT, one {request_id, ok, replies} per item in item order
+    items = data.get("items")
+    if not isinstance(items, list) or len(items) > MAX_BATCH:
+        await send(conn, {"type": "ERROR", "data": {"code": "BAD_BATCH", "max": MAX_BATCH}})
+        return
+    seen_ids = set()
+    for item in items:
+        rid = item.get("request_id") if isinstance(item, dict) else None
+        if rid is None:
+            continue
+        if not isinstance(rid, (str, int)) or rid in seen_ids:
+            # nothing runs: replies could not be told apart
+            reason = "duplicate_request_id" if rid in seen_ids else "bad_request_id"
+            await send(conn, {"type": "ERROR", "data": {"code": "BAD_BATCH", "reason": reason, "request_id": rid}})
             return
-        rec.setdefault("reactions", {})
-        rec["reactions"].setdefault(reaction, set())
-        if me in rec["reactions"][reaction]:
-            rec["reactions"][reaction].remove(me)
-            action = "remove"
-        else:
-            rec["reactions"][reaction].add(me)
-            action = "add"
-        counts = STATE.reactions_summary(rec)
-        payload = {"type": "MSG_REACT_UPDATE",
-                   "data": {"message_id": mid, "reaction": reaction, "action": action, "by_user_id": me, "counts": counts}}
-        if "group_id" in rec:
-            for uid in list(STATE.group_members.get(rec["group_id"], set())):
-                await broadcast_to_user(uid, payload)
+        seen_ids.add(rid)
+    results: list[dict] = []
+    for i, item in enumerate(items):
+        batch = BatchCollector(conn)
+        if not isinstance(item, dict) or item.get("type") in _NOT_BATCHABLE:
+            batch.replies.append({"type": "ERROR", "data": {"code": "BAD_BATCH_ITEM"}})
+        elif await _over_inflight(i):
+            # items count like pipelined commands: item i has i others of this BATCH ahead of it
+            batch.replies.append(_inflight_error(item))
         else:
-            await send(writer, payload)
-            other = rec["to_user_id"] if rec["from_user_id"] == me else rec["from_user_id"]
-            await broadcast_to_user(other, payload)
+            token = _BATCH.set(batch)
+            try:
+                await route(session, conn, item)
+            finally:
+                _BATCH.reset(token)
+        results.append({"request_id": item.get("request_id") if isinstance(item, dict) else None,
+                        "ok": all(r["type"] != "ERROR" for r in batch.replies), "replies": batch.replies})
+    await send(conn, {"type": "BATCH_RESULT", "data": {"results": results}})
+
+
+async def route(session: dict, conn: Connection, msg: dict) -> None:
+    typ = msg.get("type")
+    handler = HANDLERS.get(typ)
+    if conn.limiter is not None and not await _admit(conn, typ if handler is not None else "UNKNOWN"):
         return
+    if not session.get("user_id") and (handler is None or handler.auth):
+        await send(conn, {"type": "ERROR", "data": {"code": "UNAUTH"}})
+        return
+    if handler is None:
+        await send(conn, {"type": "ERROR", "data": {"code": "UNKNOWN_TYPE", "got": typ}})
+        return
+    timing = HANDLERS.timing
+    if timing is None:
+        await handler.fn(session, conn, msg.get("data") or {})
+        return
+    t0 = time.perf_counter()
+    try:
+        await handler.fn(session, conn, msg.get("data") or {})
+    finally:
+        timing(typ, time.perf_counter() - t0)
+
+
+async def _admit(conn: Connection, typ: str) -> bool:
+    # token buckets of the connection: reject with RATE_LIMITED, or hold the command until the buckets
+    # allow it (the connection's later commands wait behind it; its reads stop at PIPELINE_DEPTH)
+    wait = conn.limiter.check(typ, time.monotonic())
+    if not wait:
+        return True
+    if LIMITS.action == "error":
+        await send(conn, {"type": "ERROR", "data": {"code": "RATE_LIMITED", "got": typ,
+                                                     "retry_after": round(wait, 3)}})
+        return False
+    await asyncio.sleep(wait)
+    return True
+
+
+async def _over_inflight(queued: int) -> bool:
+    # True if BATCH item number `queued` must be rejected for --max-inflight (items count like pipelined
+    # commands); in delay mode it runs, after the other connections had a turn
+    if not LIMITS.max_inflight or queued < LIMITS.max_inflight:
+        return False
+    LIMITS.inflight_limited += 1
+    if LIMITS.action == "error":
+        return True
+    await asyncio.sleep(0)
+    return False
+
+
+def _inflight_error(msg: Any) -> dict:
+    # one per rejected command, with its request_id so the client knows exactly what to send again
+    data = {"code": "RATE_LIMITED", "reason": "inflight", "max": LIMITS.max_inflight}
+    if isinstance(msg, dict):
+        data["got"] = msg.get("type")
+        data["request_id"] = msg.get("request_id")
+    return {"type": "ERROR", "data": data}
+
 
-    await send(writer, {"type": "ERROR", "data": {"code": "UNKNOWN_TYPE", "got": typ}})
+def _history_limit(typ: str, data: dict) -> int | None:
+    # page size for MSG_HISTORY / GROUP_HISTORY, between 1 and HISTORY_MAX; None if limit is not a number
+    try:
+        limit = int(data.get("limit") or 50)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    if limit > HISTORY_MAX:
+        LIMITS.clamped(typ)
+        return HISTORY_MAX
+    return max(limit, 1)
+
+
+async def _run_commands(session: dict, conn: Connection, commands: asyncio.Queue) -> None:
+    # the connection's commands one at a time, in arrival order, while handle_client keeps reading;
+    # None ends it once everything received before EOF is answered
+    try:
+        while (msg := await commands.get()) is not None:
+            try:
+                await route(session, conn, msg)
+            finally:
+                conn.answered()
+    except Exception:
+        conn.abort()  # ends the reader too; handle_client re-raises the error
+        raise
+
+
+def deliver_remote(obj: dict, uids: list) -> None:
+    # a fanout published by another worker: push to the users connected here, never republish
+    fanout(obj, [uid for uid in uids if uid in USER_CONNS])
 
 
 async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-    addr = writer.get_extra_info("peername")
+    if SOCKET_OPTS:
+        sock = writer.get_extra_info("socket")
+        for opt in SOCKET_OPTS:
+            sock.setsockopt(*opt)
+    conn = Connection(writer)
     session: dict = {}
-    buf = b""
+    framer: LineFramer | LengthFramer = LineFramer(MAX_FRAME)
+    decode = codec.loads
+    commands: asyncio.Queue = asyncio.Queue()
+    runner = asyncio.create_task(_run_commands(session, conn, commands))
+    depth = max(PIPELINE_DEPTH, LIMITS.max_inflight)
     try:
-        while True:
-            data = await reader.read(4096)
+        while not conn.closed:
+            data = await reader.read(65536)
             if not data:
                 break
-            buf += data
-            while b"\n" in buf:
-                line, buf = buf.split(b"\n", 1)
-                if not line:
-                    continue
+            try:
+                frames = framer.feed(data)
+            except FrameTooLarge:
+                await send(conn, {"type": "ERROR", "data": {"code": "FRAME_TOO_LARGE", "max": MAX_FRAME}})
+                break
+            for frame in frames:
                 try:
-                    msg = json.loads(line.decode())
-                except json.JSONDecodeError:
-                    await send(writer, {"type": "ERROR", "data": {"code": "BAD_JSON"}})
+                    msg = decode(frame)
+                except ValueError:
+                    code = "BAD_JSON" if conn.fmt == "json" else "BAD_FRAME"
+                    await send(conn, {"type": "ERROR", "data": {"code": code}})
                     continue
-                await route(session, writer, msg)
+                if msg.get("type") == "HELLO" and conn.fmt == "json":
+                    # reply in JSON, then both sides switch; the client sends nothing until HELLO_OK
+                    await conn.inflight_below(1)  # earlier commands are answered in JSON
+                    fmt = binproto.choose_format(msg)
+                    conn.push({"type": "HELLO_OK", "data": {"format": fmt}})
+                    if fmt != "json":
+                        conn.set_format(fmt)
+                        rest = framer.take_rest()
+                        framer, decode = LengthFramer(MAX_FRAME), binproto.decode
+                        frames.extend(framer.feed(rest))
+                    continue
+                if LIMITS.max_inflight and conn.inflight >= LIMITS.max_inflight:
+                    LIMITS.inflight_limited += 1
+                    if LIMITS.action == "error":
+                        await send(conn, _inflight_error(msg))
+                        continue
+                    await conn.inflight_below(LIMITS.max_inflight)
+                # a client that keeps pipelining stops being read here and TCP pushes back
+                await conn.inflight_below(depth)
+                if conn.closed:
+                    break
+                conn.inflight += 1
+                commands.put_nowait(msg)
+        commands.put_nowait(None)
+        await runner
+    except (ConnectionError, FrameTooLarge):
+        pass
     finally:
+        runner.cancel()
         uid = session.get("user_id")
-        if uid and STATE.user_conns.get(uid) is writer:
-            STATE.user_conns.pop(uid, None)
-        try:
-            writer.close()
-            await writer.wait_closed()
-        except Exception:
-            pass
+        if uid and USER_CONNS.get(uid) is conn:
+            USER_CONNS.pop(uid, None)
+            if BUS is not None:
+                BUS.offline(uid)
+        await conn.close()
 
 
-async def main():
-    server = await asyncio.start_server(handle_client, HOST, PORT)
-    print(f"Async chat server listening on {HOST}:{PORT}")
-    async with server:
-        await server.serve_forever()
+def open_wal(data_dir: str, snapshot_every: int = 100_000) -> WriteAheadLog:
+    # rebuild STATE from snapshot + log, then journal every further mutation
+    wal = WriteAheadLog(data_dir, snapshot_every=snapshot_every)
+    t0 = time.perf_counter()
+    snap, records = wal.recover()
+    if snap is not None:
+        STATE.restore(snap)
+    if STATE.segments is not None:
+        # segments written after the snapshot are rebuilt by the replay below
+        STATE.segments.discard_from(STATE.next_seg)
+    for r in records:
+        STATE.apply(r)
+    print(f"Recovered {len(STATE.users)} users, {len(STATE.messages)} messages "
+          f"({len(records)} log records) from {data_dir} in {time.perf_counter() - t0:.2f}s")
+    wal.start(STATE.capture, STATE.segments.sync if STATE.segments is not None else None)
+    STATE.journal = wal.append
+    return wal
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(description="Async chat server (JSON-lines)")
+    ap.add_argument("--host", default=HOST)
+    ap.add_argument("--port", type=int, default=PORT)
+    ap.add_argument("--data-dir", help="persist state to a write-ahead log in this directory "
+                                       "(default: in-memory only)")
+    ap.add_argument("--snapshot-every", type=int, default=100_000,
+                    help="write a compacted snapshot after this many log records")
+    ap.add_argument("--hot-messages", type=int, default=1000,
+                    help="messages per conversation kept in RAM before older ones spill to segment "
+                         "files (memory storage; 0 keeps everything in RAM)")
+    ap.add_argument("--outbox-soft", type=int, default=OUTBOX_SOFT_LIMIT,
+                    help="bytes queued for a client above which ephemeral pushes are dropped")
+    ap.add_argument("--outbox-max", type=int, default=OUTBOX_HARD_LIMIT,
+                    help="bytes queued for a client above which it is disconnected as a slow consumer")
+    ap.add_argument("--max-frame", type=int, default=MAX_FRAME,
+                    help="reject request lines longer than this many bytes and close the connection")
+    ap.add_argument("--storage", default="memory",
+                    help="'memory' (default) or 'sqlite:PATH'; SQLite queries run on a thread pool")
+    ap.add_argument("--workers", type=int, default=1,
+                    help="run N worker processes sharing the port (SO_REUSEPORT) and a local pub/sub "
+                         "broker for cross-worker delivery; needs --storage sqlite:PATH")
+    ap.add_argument("--bus", help=argparse.SUPPRESS)  # set by the supervisor for each worker
+    ap.add_argument("--loop", choices=("asyncio", "uvloop", "auto"), default="asyncio",
+                    help="event loop: asyncio (default), uvloop (must be installed) or auto (uvloop if installed)")
+    ap.add_argument("--backlog", type=int, default=100, help="listen() backlog")
+    ap.add_argument("--read-limit", type=int, default=1 << 16,
+                    help="StreamReader buffer limit; reading pauses above twice this many bytes")
+    ap.add_argument("--no-nodelay", dest="nodelay", action="store_false",
+                    help="leave Nagle's algorithm on (asyncio sets TCP_NODELAY by default)")
+    ap.add_argument("--sndbuf", type=int, default=0, help="SO_SNDBUF for client sockets (0: OS default)")
+    ap.add_argument("--rcvbuf", type=int, default=0, help="SO_RCVBUF for client sockets (0: OS default)")
+    ap.add_argument("--session-ttl", type=float, default=SESSIONS.ttl,
+                    help="lifetime of AUTH_RESUME tokens in seconds (signing key: $CHAT_SESSION_SECRET, "
+                         "random per start if unset)")
+    ap.add_argument("--type-stats", action="store_true",
+                    help="time every handler and print per-type counts/latency on shutdown")
+    ap.add_argument("--rate-limit", metavar="RATE[:BURST]",
+                    help="token bucket per connection: commands per second, burst (default: no limit)")
+    ap.add_argument("--type-limit", metavar="TYPE=RATE[:BURST]", action="append", default=[],
+                    help="extra token bucket per connection for one command type, e.g. GROUP_MSG_SEND=5:20 "
+                         "(repeatable)")
+    ap.add_argument("--limit-action", choices=("error", "delay"), default="error",
+                    help="over a limit: reply ERROR RATE_LIMITED (default) or delay the command, which also "
+                         "stops reading from that client")
+    ap.add_argument("--max-inflight", type=int, default=0,
+                    help="commands of a client received and not answered yet, BATCH items included; "
+                         "each one over it is rejected with its request_id, or with --limit-action delay "
+                         "waits for an earlier one to be answered (0: no limit)")
+    ap.add_argument("--max-history", type=int, default=HISTORY_MAX,
+                    help="largest MSG_HISTORY / GROUP_HISTORY page; a bigger limit is lowered to this")
+    args = ap.parse_args(argv)
+    if args.storage != "memory" and not args.storage.startswith("sqlite:"):
+        ap.error(f"unknown storage {args.storage!r}")
+    if args.data_dir and args.storage != "memory":
+        ap.error("--data-dir only applies to --storage memory")
+    if args.workers > 1 and not args.storage.startswith("sqlite:"):
+        ap.error("--workers needs a store shared between processes: --storage sqlite:PATH")
+    try:
+        args.rate_limit = parse_rate(args.rate_limit) if args.rate_limit else None
+        types = {}
+        for spec in args.type_limit:
+            typ, _, rate = spec.partition("=")
+            if HANDLERS.get(typ) is None:
+                raise ValueError(f"unknown type {typ!r}")
+            types[typ] = parse_rate(rate)
+        args.type_limit = types
+    except ValueError as e:
+        ap.error(f"rate limits: {e}")
+    return args
+
+
+def use_loop(name: str) -> str:
+    """Cài event loop trước asyncio.run(): "asyncio", "uvloop" (phải cài sẵn) hoặc "auto" (uvloop nếu có)."""
+    if name == "asyncio":
+        return name
+    try:
+        import uvloop
+    except ImportError:
+        if name == "uvloop":
+            raise SystemExit("uvloop is not installed (pip install uvloop)")
+        return "asyncio"
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return "uvloop"
+
+
+async def supervise(args: argparse.Namespace, argv: list[str]) -> None:
+    """
+    --workers N: chạy N tiến trình server_async cùng nghe một cổng (SO_REUSEPORT, kernel chia kết nối),
+    dùng chung file SQLite, và một Broker (tools/bus.py) trên Unix socket để giao tin giữa các worker.
+    """
+    SQLiteStore(args.storage[len("sqlite:"):])  # create the schema once, before the workers race for it
+    # every worker must verify the others' tokens
+    os.environ.setdefault("CHAT_SESSION_SECRET", os.urandom(32).hex())
+    bus_dir = tempfile.mkdtemp(prefix="chat-bus-")
+    path = os.path.join(bus_dir, "bus.sock")
+    broker = Broker()
+    bus_server = await broker.serve(path)
+    cmd = [sys.executable, os.path.abspath(__file__), *argv, "--workers", "1", "--bus", path]
+    procs = [subprocess.Popen(cmd) for _ in range(args.workers)]
+    print(f"Supervisor: {args.workers} workers on {args.host}:{args.port}, bus {path}")
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    except (NotImplementedError, AttributeError):
+        pass
+    try:
+        while all(p.poll() is None for p in procs):
+            await asyncio.sleep(0.5)
+        print("Supervisor: a worker exited, stopping the others")
+    finally:
+        for p in procs:
+            if p.poll() is None:
+                p.terminate()
+        for p in procs:
+            p.wait()
+        bus_server.close()
+        shutil.rmtree(bus_dir, ignore_errors=True)
+        print(f"Supervisor: broker forwarded {broker.forwarded} messages")
+
+
+async def main(argv: list[str] | None = None):
+    global STATE, STORE, BUS, OUTBOX_SOFT_LIMIT, OUTBOX_HARD_LIMIT, MAX_FRAME, SOCKET_OPTS, LISTEN_OPTS, LIMITS
+    global HISTORY_MAX
+    args = parse_args(argv)
+    if args.workers > 1:
+        await supervise(args, sys.argv[1:] if argv is None else argv)
+        return
+    MAX_FRAME = args.max_frame
+    SESSIONS.ttl = args.session_ttl
+    SOCKET_OPTS, LISTEN_OPTS = [], []
+    if not args.nodelay:
+        SOCKET_OPTS.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, 0))
+    if args.sndbuf:
+        LISTEN_OPTS.append((socket.SOL_SOCKET, socket.SO_SNDBUF, args.sndbuf))
+    if args.rcvbuf:
+        LISTEN_OPTS.append((socket.SOL_SOCKET, socket.SO_RCVBUF, args.rcvbuf))
+    OUTBOX_SOFT_LIMIT, OUTBOX_HARD_LIMIT = args.outbox_soft, args.outbox_max
+    LIMITS = RateLimits(args.rate_limit, args.type_limit, args.limit_action, args.max_inflight)
+    HISTORY_MAX = args.max_history
+    seg_tmp = None
+    if args.type_stats:
+        HANDLERS.timing = TypeStats()
+    if args.storage.startswith("sqlite:"):
+        STORE = SQLiteStore(args.storage[len("sqlite:"):])
+        print(f"Using SQLite storage at {STORE.path}")
+    elif args.hot_messages > 0:
+        if args.data_dir:
+            seg_dir = os.path.join(args.data_dir, "segments")
+        else:
+            seg_dir = seg_tmp = tempfile.mkdtemp(prefix="chat-segments-")
+        STATE = STORE = State(SegmentDir(seg_dir), args.hot_messages)
+    wal = open_wal(args.data_dir, args.snapshot_every) if args.data_dir else None
+    stop = asyncio.Event()
+    try:
+        # SIGTERM -> a normal shutdown (exit status 0): stop serving, flush the log below
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    except (NotImplementedError, AttributeError):
+        pass  # Windows
+    try:
+        # kill -USR1 <pid>: print the admission counters without stopping the server
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, lambda: print(LIMITS.report(), flush=True))
+    except (NotImplementedError, AttributeError):
+        pass
+    try:
+        if args.bus:
+            BUS = BusClient(args.bus, deliver_remote)
+            await BUS.connect()
+        server = await asyncio.start_server(handle_client, args.host, args.port, reuse_port=bool(args.bus),
+                                            backlog=args.backlog, limit=args.read_limit, start_serving=False)
+        for sock in server.sockets:
+            for opt in LISTEN_OPTS:
+                sock.setsockopt(*opt)  # before listen(), which start_serving() calls
+        loop_name = type(asyncio.get_running_loop()).__module__.split(".")[0]
+        print(f"Async chat server listening on {args.host}:{args.port} ({loop_name} loop)"
+              + (f" (worker {os.getpid()})" if BUS else ""))
+        async with server:
+            await server.start_serving()
+            await stop.wait()
+    finally:
+        if HANDLERS.timing is not None:
+            print(HANDLERS.timing.report())
+        if LIMITS.counts or LIMITS.inflight_limited:
+            print(LIMITS.report())
+        if BUS is not None:
+            await BUS.close()
+        if wal is not None:
+            wal.close()
+        if _DB_EXECUTOR is not None:
+            _DB_EXECUTOR.shutdown(wait=True)
+        if _AUTH_EXECUTOR is not None:
+            _AUTH_EXECUTOR.shutdown(wait=False)
+        if STATE.segments is not None:
+            STATE.segments.close()
+        if seg_tmp is not None:
+            shutil.rmtree(seg_tmp, ignore_errors=True)
 
 
 if __name__ == "__main__":
+    use_loop(parse_args().loop)
     asyncio.run(main())
 
 
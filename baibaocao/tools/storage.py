@@ -0,0 +1,596 @@
+# tools/storage.py
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterable, Set
+
+from tools.records import Message
+
+
+class Store(ABC):
+    """
+    Giao diện lưu trữ mà route() của server_async dùng.
+    Các phương thức là đồng bộ; store có blocking = True (SQLite) được server
+    gọi qua thread-pool executor, store trong RAM (State) được gọi trực tiếp.
+
+    Message trả về từ store blocking là bản sao: chỉ thay đổi qua các phương
+    thức recall_message / toggle_reaction của store.
+    add_message / recall_message / toggle_reaction ghi số thứ tự thay đổi (cursor SYNC)
+    của lần đổi đó vào rec.seq, để gửi kèm bản tin đẩy tới client.
+    Khoá hội thoại: ("dm", min_uid, max_uid) hoặc ("group", gid).
+    """
+
+    blocking = False
+
+    # ---- users ----
+    @abstractmethod
+    def add_user(self, username: str, password_hash: str) -> Dict[str, Any] | None:
+        """Tạo user, trả về {user_id, username, password_hash}; None nếu username đã tồn tại."""
+
+    @abstractmethod
+    def get_user(self, username: str) -> Dict[str, Any] | None: ...
+
+    @abstractmethod
+    def user_exists(self, uid: int) -> bool: ...
+
+    @abstractmethod
+    def username_of(self, uid: int) -> str: ...
+
+    # ---- friends ----
+    @abstractmethod
+    def add_friend_request(self, from_uid: int, to_uid: int) -> dict: ...
+
+    @abstractmethod
+    def get_friend_request(self, req_id: int) -> dict | None:
+        """Chỉ trả về lời mời đang chờ (pending)."""
+
+    @abstractmethod
+    def accept_friend_request(self, req: dict) -> None: ...
+
+    @abstractmethod
+    def remove_friendship(self, a: int, b: int) -> None: ...
+
+    @abstractmethod
+    def are_friends(self, a: int, b: int) -> bool: ...
+
+    @abstractmethod
+    def friend_list(self, uid: int) -> dict:
+        """{friends, pending_in, pending_out} đúng định dạng FRIEND_LIST_RESULT."""
+
+    @abstractmethod
+    def block(self, blocker: int, blocked: int) -> None: ...
+
+    @abstractmethod
+    def unblock(self, blocker: int, blocked: Any) -> None: ...
+
+    @abstractmethod
+    def is_blocked(self, blocker: int, blocked: int) -> bool: ...
+
+    # ---- groups ----
+    @abstractmethod
+    def create_group(self, owner_id: int, name: str, avatar: Any) -> int: ...
+
+    @abstractmethod
+    def get_group(self, gid: Any) -> dict | None:
+        """{name, owner_id, avatar} hoặc None."""
+
+    @abstractmethod
+    def add_group_member(self, gid: int, uid: int) -> None: ...
+
+    @abstractmethod
+    def members_of(self, gid: Any) -> Set[int]: ...
+
+    @abstractmethod
+    def is_member(self, gid: Any, uid: int) -> bool: ...
+
+    @abstractmethod
+    def group_summary(self, gid: int) -> dict: ...
+
+    @abstractmethod
+    def groups_of(self, uid: int) -> list[dict]: ...
+
+    # ---- messages ----
+    @abstractmethod
+    def add_message(self, rec: Message) -> Message:
+        """Gán id cho rec và lưu lại."""
+
+    @abstractmethod
+    def get_message(self, mid: Any) -> Message | None: ...
+
+    @abstractmethod
+    def get_messages(self, mids: Iterable[Any]) -> list[Message]:
+        """Các tin tồn tại trong mids, giữ nguyên thứ tự."""
+
+    @abstractmethod
+    def visible_messages(self, mids: Iterable[Any], uid: int) -> list[Message]:
+        """Như get_messages nhưng chỉ các tin trong hội thoại của uid (1-1: người gửi/nhận, nhóm: thành viên)."""
+
+    @abstractmethod
+    def history_page(self, key: tuple, before_id: int | None, limit: int) -> tuple[list[Message], bool]:
+        """(tối đa limit tin có id < before_id, tăng dần theo id; has_more). Tin trả về có reactions_summary()."""
+
+    @abstractmethod
+    def mark_seen(self, recs: list[Message], uid: int) -> None:
+        """Đẩy watermark đã đọc của uid trong mỗi hội thoại tới id lớn nhất trong recs (không bao giờ lùi)."""
+
+    @abstractmethod
+    def read_marks(self, key: tuple) -> Dict[int, int]:
+        """{user_id: id tin cuối đã đọc} của các thành viên hội thoại key đã đọc ít nhất một tin."""
+
+    @abstractmethod
+    def recall_message(self, rec: Message) -> None: ...
+
+    @abstractmethod
+    def toggle_reaction(self, rec: Message, reaction: str, uid: int) -> tuple[str, Dict[str, int]]:
+        """Bật/tắt cảm xúc, trả về (action "add"/"remove", counts). counts được giữ sẵn, không đếm lại."""
+
+    # ---- sync ----
+    @abstractmethod
+    def conversations_of(self, uid: int) -> list[tuple]:
+        """Khoá mọi hội thoại của uid: các nhóm và các cuộc 1-1 đã có tin."""
+
+    @abstractmethod
+    def sync_page(self, uid: int, since: int | None, limit: int) -> tuple[list[Message], int, bool]:
+        """
+        Tin mới / bị thu hồi / đổi cảm xúc trong các hội thoại của uid có số thứ tự thay đổi > since:
+        (tối đa limit tin, tăng dần theo id, có reactions_summary(); cursor; has_more).
+        Mỗi tin chỉ xuất hiện một lần, ở trạng thái hiện tại. Hết dữ liệu thì cursor là số thứ tự
+        mới nhất của cả store; since=None chỉ trả về cursor đó.
+        """
+
+    # ---- inbox ----
+    @abstractmethod
+    def inbox_page(self, uid: int, before_id: int | None, limit: int) -> tuple[list[dict], bool]:
+        """
+        Các hội thoại đã có tin của uid, mới nhất trước, chỉ những hội thoại có tin cuối < before_id:
+        (tối đa limit mục đúng định dạng CONV_LIST_RESULT, has_more).
+        Tin cuối và số tin chưa đọc được cập nhật dần khi gửi / MSG_SEEN, không quét lịch sử.
+        """
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY, username TEXT NOT NULL UNIQUE, password_hash TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS friendships (
+    a INTEGER NOT NULL, b INTEGER NOT NULL, PRIMARY KEY (a, b)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS friend_requests (
+    id INTEGER PRIMARY KEY, from_user_id INTEGER NOT NULL, to_user_id INTEGER NOT NULL, status TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS friend_requests_in ON friend_requests (to_user_id, id) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS friend_requests_out ON friend_requests (from_user_id, id) WHERE status = 'pending';
+CREATE TABLE IF NOT EXISTS blocks (
+    blocker INTEGER NOT NULL, blocked INTEGER NOT NULL, PRIMARY KEY (blocker, blocked)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS chat_groups (
+    id INTEGER PRIMARY KEY, name TEXT NOT NULL, owner_id INTEGER NOT NULL, avatar TEXT);
+CREATE TABLE IF NOT EXISTS group_members (
+    group_id INTEGER NOT NULL, user_id INTEGER NOT NULL, PRIMARY KEY (group_id, user_id)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS group_members_by_user ON group_members (user_id, group_id);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY, conv TEXT NOT NULL, group_id INTEGER, from_user_id INTEGER NOT NULL,
+    to_user_id INTEGER, content TEXT NOT NULL, created_at REAL NOT NULL, reply_to_id INTEGER,
+    recalled INTEGER NOT NULL DEFAULT 0);
+CREATE INDEX IF NOT EXISTS messages_by_conv ON messages (conv, id);
+CREATE TABLE IF NOT EXISTS reactions (
+    message_id INTEGER NOT NULL, reaction TEXT NOT NULL, user_id INTEGER NOT NULL,
+    PRIMARY KEY (message_id, reaction, user_id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS reaction_counts (
+    message_id INTEGER NOT NULL, reaction TEXT NOT NULL, n INTEGER NOT NULL,
+    PRIMARY KEY (message_id, reaction)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY, conv TEXT NOT NULL, message_id INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS changes_by_conv ON changes (conv, seq);
+CREATE INDEX IF NOT EXISTS changes_by_msg ON changes (message_id);
+CREATE TABLE IF NOT EXISTS dm_peers (
+    user_id INTEGER NOT NULL, peer_id INTEGER NOT NULL, PRIMARY KEY (user_id, peer_id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS conv_stats (
+    conv TEXT PRIMARY KEY, total INTEGER NOT NULL, last_id INTEGER NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS conv_reads (
+    user_id INTEGER NOT NULL, conv TEXT NOT NULL, sent INTEGER NOT NULL DEFAULT 0,
+    seen INTEGER NOT NULL DEFAULT 0, last_read INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (user_id, conv)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS conv_reads_by_conv ON conv_reads (conv);
+"""
+
+_MSG_COLS = "id, group_id, from_user_id, to_user_id, content, created_at, reply_to_id, recalled"
+
+PREVIEW_CHARS = 100  # last message text kept in a CONV_LIST entry
+
+
+def last_message_summary(rec: Message) -> dict:
+    return {"message_id": rec.id, "from_user_id": rec.from_user_id, "content": rec.content[:PREVIEW_CHARS],
+            "created_at": rec.created_at, "recalled": rec.recalled}
+
+
+def _conv(key: tuple) -> str:
+    return ":".join(str(k) for k in key)
+
+
+def _is_id(v: Any) -> bool:
+    return type(v) is int
+
+
+def _dm_key(a: int, b: int) -> tuple:
+    return ("dm", a, b) if a <= b else ("dm", b, a)
+
+
+def _touch(conn: sqlite3.Connection, mid: int) -> int:
+    # a new change row for a recalled/reacted message, then the older rows of that message go:
+    # SYNC sends a message once, in its current state, so only its latest seq is kept.
+    # Inserting first keeps seq growing (a deleted max rowid would otherwise be handed out again)
+    seq = conn.execute("INSERT INTO changes (conv, message_id) SELECT conv, id FROM messages WHERE id = ?",
+                       (mid,)).lastrowid
+    conn.execute("DELETE FROM changes WHERE message_id = ? AND seq < ?", (mid, seq))
+    return seq
+
+
+def _row_to_msg(row) -> Message:
+    mid, gid, frm, to, content, created_at, reply_to_id, recalled = row
+    rec = Message(frm, content, created_at, to_user_id=to, group_id=gid, reply_to_id=reply_to_id, id=mid)
+    rec.recalled = bool(recalled)
+    return rec
+
+
+class SQLiteStore(Store):
+    """
+    Store trên SQLite (file), cho lịch sử lớn hơn RAM.
+    Mỗi luồng của executor có một connection riêng (journal_mode=WAL nên
+    đọc song song được, ghi được SQLite tuần tự hoá).
+    """
+
+    blocking = True
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        had_counts = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'reaction_counts'").fetchone()
+        conn.executescript(_SCHEMA)
+        if not had_counts:
+            # a database from before reaction_counts: count the existing reactions once
+            conn.execute("INSERT INTO reaction_counts SELECT message_id, reaction, COUNT(*) FROM reactions "
+                         "GROUP BY message_id, reaction")
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # ---- users ----
+    def add_user(self, username: str, password_hash: str) -> Dict[str, Any] | None:
+        conn = self._conn()
+        try:
+            with conn:
+                cur = conn.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)",
+                                   (username, password_hash))
+        except sqlite3.IntegrityError:
+            return None
+        return {"password_hash": password_hash, "user_id": cur.lastrowid, "username": username}
+
+    def get_user(self, username: str) -> Dict[str, Any] | None:
+        row = self._conn().execute("SELECT id, password_hash FROM users WHERE username = ?",
+                                   (username,)).fetchone()
+        return {"password_hash": row[1], "user_id": row[0], "username": username} if row else None
+
+    def user_exists(self, uid: int) -> bool:
+        return self._conn().execute("SELECT 1 FROM users WHERE id = ?", (uid,)).fetchone() is not None
+
+    def username_of(self, uid: int) -> str:
+        row = self._conn().execute("SELECT username FROM users WHERE id = ?", (uid,)).fetchone()
+        return row[0] if row else f"user_{uid}"
+
+    # ---- friends ----
+    def add_friend_request(self, from_uid: int, to_uid: int) -> dict:
+        conn = self._conn()
+        with conn:
+            cur = conn.execute("INSERT INTO friend_requests (from_user_id, to_user_id, status) "
+                               "VALUES (?, ?, 'pending')", (from_uid, to_uid))
+        return {"id": cur.lastrowid, "from_user_id": from_uid, "to_user_id": to_uid, "status": "pending"}
+
+    def get_friend_request(self, req_id: int) -> dict | None:
+        row = self._conn().execute("SELECT from_user_id, to_user_id FROM friend_requests "
+                                   "WHERE id = ? AND status = 'pending'", (req_id,)).fetchone()
+        if not row:
+            return None
+        return {"id": req_id, "from_user_id": row[0], "to_user_id": row[1], "status": "pending"}
+
+    def accept_friend_request(self, req: dict) -> None:
+        a, b = req["from_user_id"], req["to_user_id"]
+        conn = self._conn()
+        with conn:
+            conn.execute("UPDATE friend_requests SET status = 'accepted' WHERE id = ?", (req["id"],))
+            conn.executemany("INSERT OR IGNORE INTO friendships (a, b) VALUES (?, ?)", ((a, b), (b, a)))
+        req["status"] = "accepted"
+
+    def remove_friendship(self, a: int, b: int) -> None:
+        conn = self._conn()
+        with conn:
+            conn.executemany("DELETE FROM friendships WHERE a = ? AND b = ?", ((a, b), (b, a)))
+
+    def are_friends(self, a: int, b: int) -> bool:
+        n = self._conn().execute("SELECT COUNT(*) FROM friendships WHERE (a = ? AND b = ?) OR (a = ? AND b = ?)",
+                                 (a, b, b, a)).fetchone()[0]
+        return n == 2
+
+    def friend_list(self, uid: int) -> dict:
+        conn = self._conn()
+        friends = [{"user_id": fid, "username": name or f"user_{fid}", "status": "accepted"}
+                   for fid, name in conn.execute(
+                       "SELECT f.b, u.username FROM friendships f LEFT JOIN users u ON u.id = f.b "
+                       "WHERE f.a = ? ORDER BY f.b", (uid,))]
+        pending_in = [{"request_id": rid, "from_user_id": frm, "from_username": name or f"user_{frm}"}
+                      for rid, frm, name in conn.execute(
+                          "SELECT r.id, r.from_user_id, u.username FROM friend_requests r "
+                          "LEFT JOIN users u ON u.id = r.from_user_id "
+                          "WHERE r.to_user_id = ? AND r.status = 'pending' ORDER BY r.id", (uid,))]
+        pending_out = [{"request_id": rid, "to_user_id": to, "to_username": name or f"user_{to}"}
+                       for rid, to, name in conn.execute(
+                           "SELECT r.id, r.to_user_id, u.username FROM friend_requests r "
+                           "LEFT JOIN users u ON u.id = r.to_user_id "
+                           "WHERE r.from_user_id = ? AND r.status = 'pending' ORDER BY r.id", (uid,))]
+        return {"friends": friends, "pending_in": pending_in, "pending_out": pending_out}
+
+    def block(self, blocker: int, blocked: int) -> None:
+        conn = self._conn()
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO blocks (blocker, blocked) VALUES (?, ?)", (blocker, blocked))
+
+    def unblock(self, blocker: int, blocked: Any) -> None:
+        if not _is_id(blocked):
+            return
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM blocks WHERE blocker = ? AND blocked = ?", (blocker, blocked))
+
+    def is_blocked(self, blocker: int, blocked: int) -> bool:
+        return self._conn().execute("SELECT 1 FROM blocks WHERE blocker = ? AND blocked = ?",
+                                    (blocker, blocked)).fetchone() is not None
+
+    # ---- groups ----
+    def create_group(self, owner_id: int, name: str, avatar: Any) -> int:
+        conn = self._conn()
+        with conn:
+            gid = conn.execute("INSERT INTO chat_groups (name, owner_id, avatar) VALUES (?, ?, ?)",
+                               (name, owner_id, avatar)).lastrowid
+            conn.execute("INSERT INTO group_members (group_id, user_id) VALUES (?, ?)", (gid, owner_id))
+        return gid
+
+    def get_group(self, gid: Any) -> dict | None:
+        if not _is_id(gid):
+            return None
+        row = self._conn().execute("SELECT name, owner_id, avatar FROM chat_groups WHERE id = ?",
+                                   (gid,)).fetchone()
+        return {"name": row[0], "owner_id": row[1], "avatar": row[2]} if row else None
+
+    def add_group_member(self, gid: int, uid: int) -> None:
+        conn = self._conn()
+        with conn:
+            cur = conn.execute("INSERT OR IGNORE INTO group_members (group_id, user_id) VALUES (?, ?)", (gid, uid))
+            if cur.rowcount:
+                # a new member starts with the existing history counted as read
+                conv = _conv(("group", gid))
+                conn.execute("INSERT INTO conv_reads (user_id, conv, seen, last_read) "
+                             "SELECT ?, ?, COALESCE(MAX(total), 0), COALESCE(MAX(last_id), 0) "
+                             "FROM conv_stats WHERE conv = ? "
+                             "ON CONFLICT DO UPDATE SET seen = excluded.seen - sent, last_read = excluded.last_read",
+                             (uid, conv, conv))
+
+    def members_of(self, gid: Any) -> Set[int]:
+        if not _is_id(gid):
+            return set()
+        return {r[0] for r in self._conn().execute("SELECT user_id FROM group_members WHERE group_id = ?", (gid,))}
+
+    def is_member(self, gid: Any, uid: int) -> bool:
+        if not _is_id(gid):
+            return False
+        return self._conn().execute("SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?",
+                                    (gid, uid)).fetchone() is not None
+
+    def group_summary(self, gid: int) -> dict:
+        name, count = self._conn().execute(
+            "SELECT name, (SELECT COUNT(*) FROM group_members WHERE group_id = ?) FROM chat_groups WHERE id = ?",
+            (gid, gid)).fetchone()
+        return {"group_id": gid, "name": name, "member_count": count}
+
+    def groups_of(self, uid: int) -> list[dict]:
+        rows = self._conn().execute(
+            "SELECT g.id, g.name, (SELECT COUNT(*) FROM group_members c WHERE c.group_id = g.id) "
+            "FROM group_members m JOIN chat_groups g ON g.id = m.group_id WHERE m.user_id = ? ORDER BY g.id",
+            (uid,))
+        return [{"group_id": gid, "name": name, "member_count": count} for gid, name, count in rows]
+
+    # ---- messages ----
+    def add_message(self, rec: Message) -> Message:
+        if rec.group_id is not None:
+            key = ("group", rec.group_id)
+        else:
+            key = _dm_key(rec.from_user_id, rec.to_user_id)
+        conn = self._conn()
+        with conn:
+            rec.id = conn.execute(
+                "INSERT INTO messages (conv, group_id, from_user_id, to_user_id, content, created_at, reply_to_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (_conv(key), rec.group_id, rec.from_user_id, rec.to_user_id, rec.content, rec.created_at,
+                 rec.reply_to_id)).lastrowid
+            rec.seq = conn.execute("INSERT INTO changes (conv, message_id) VALUES (?, ?)",
+                                   (_conv(key), rec.id)).lastrowid
+            conn.execute("INSERT INTO conv_stats (conv, total, last_id) VALUES (?, 1, ?) "
+                         "ON CONFLICT DO UPDATE SET total = total + 1, last_id = excluded.last_id",
+                         (_conv(key), rec.id))
+            conn.execute("INSERT INTO conv_reads (user_id, conv, sent) VALUES (?, ?, 1) "
+                         "ON CONFLICT DO UPDATE SET sent = sent + 1", (rec.from_user_id, _conv(key)))
+            if rec.group_id is None:
+                conn.executemany("INSERT OR IGNORE INTO dm_peers (user_id, peer_id) VALUES (?, ?)",
+                                 ((rec.from_user_id, rec.to_user_id), (rec.to_user_id, rec.from_user_id)))
+        return rec
+
+    def get_message(self, mid: Any) -> Message | None:
+        if not _is_id(mid):
+            return None
+        row = self._conn().execute(f"SELECT {_MSG_COLS} FROM messages WHERE id = ?", (mid,)).fetchone()
+        return _row_to_msg(row) if row else None
+
+    def get_messages(self, mids: Iterable[Any]) -> list[Message]:
+        ids = [m for m in mids if _is_id(m)]
+        if not ids:
+            return []
+        found: Dict[int, Message] = {}
+        conn = self._conn()
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            q = f"SELECT {_MSG_COLS} FROM messages WHERE id IN ({','.join('?' * len(chunk))})"
+            for row in conn.execute(q, chunk):
+                found[row[0]] = _row_to_msg(row)
+        return [found[m] for m in ids if m in found]
+
+    def visible_messages(self, mids: Iterable[Any], uid: int) -> list[Message]:
+        ids = [m for m in mids if _is_id(m)]
+        found: Dict[int, Message] = {}
+        conn = self._conn()
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            q = (f"SELECT {_MSG_COLS} FROM messages m WHERE id IN ({','.join('?' * len(chunk))}) AND "
+                 "(CASE WHEN group_id IS NULL THEN ? IN (from_user_id, to_user_id) ELSE EXISTS "
+                 "(SELECT 1 FROM group_members g WHERE g.group_id = m.group_id AND g.user_id = ?) END)")
+            for row in conn.execute(q, [*chunk, uid, uid]):
+                found[row[0]] = _row_to_msg(row)
+        return [found[m] for m in ids if m in found]
+
+    def history_page(self, key: tuple, before_id: int | None, limit: int) -> tuple[list[Message], bool]:
+        limit = max(limit, 0)
+        conn = self._conn()
+        if before_id:
+            rows = conn.execute(f"SELECT {_MSG_COLS} FROM messages WHERE conv = ? AND id < ? "
+                                "ORDER BY id DESC LIMIT ?", (_conv(key), before_id, limit + 1)).fetchall()
+        else:
+            rows = conn.execute(f"SELECT {_MSG_COLS} FROM messages WHERE conv = ? "
+                                "ORDER BY id DESC LIMIT ?", (_conv(key), limit + 1)).fetchall()
+        has_more = len(rows) > limit
+        page = [_row_to_msg(r) for r in reversed(rows[:limit])]
+        self._load_reaction_counts(page)
+        return page, has_more
+
+    def _load_reaction_counts(self, page: list[Message]) -> None:
+        # only the maintained counts; who reacted stays in the reactions table
+        if not page:
+            return
+        by_id = {m.id: m for m in page}
+        q = f"SELECT message_id, reaction, n FROM reaction_counts WHERE message_id IN ({','.join('?' * len(page))})"
+        for mid, reaction, n in self._conn().execute(q, list(by_id)):
+            rec = by_id[mid]
+            if rec.reaction_counts is None:
+                rec.reaction_counts = {}
+            rec.reaction_counts[reaction] = n
+
+    def mark_seen(self, recs: list[Message], uid: int) -> None:
+        upto: Dict[str, int] = {}
+        for rec in recs:
+            conv = _conv(("group", rec.group_id) if rec.group_id is not None
+                         else _dm_key(rec.from_user_id, rec.to_user_id))
+            upto[conv] = max(upto.get(conv, 0), rec.id)
+        conn = self._conn()
+        with conn:
+            for conv, mid in upto.items():
+                row = conn.execute("SELECT last_read FROM conv_reads WHERE user_id = ? AND conv = ?",
+                                   (uid, conv)).fetchone()
+                last_read = row[0] if row else 0
+                if mid <= last_read:
+                    continue
+                # messages of the others between the old and the new watermark (messages_by_conv range)
+                n = conn.execute("SELECT COUNT(*) FROM messages WHERE conv = ? AND id > ? AND id <= ? "
+                                 "AND from_user_id != ?", (conv, last_read, mid, uid)).fetchone()[0]
+                conn.execute("INSERT INTO conv_reads (user_id, conv, seen, last_read) VALUES (?, ?, ?, ?) "
+                             "ON CONFLICT DO UPDATE SET seen = seen + excluded.seen, last_read = excluded.last_read",
+                             (uid, conv, n, mid))
+
+    def read_marks(self, key: tuple) -> Dict[int, int]:
+        return dict(self._conn().execute("SELECT user_id, last_read FROM conv_reads WHERE conv = ? AND last_read > 0",
+                                         (_conv(key),)))
+
+    def recall_message(self, rec: Message) -> None:
+        conn = self._conn()
+        with conn:
+            conn.execute("UPDATE messages SET recalled = 1, content = '' WHERE id = ?", (rec.id,))
+            rec.seq = _touch(conn, rec.id)
+        rec.recalled = True
+        rec.content = ""
+
+    def toggle_reaction(self, rec: Message, reaction: str, uid: int) -> tuple[str, Dict[str, int]]:
+        conn = self._conn()
+        with conn:
+            cur = conn.execute("DELETE FROM reactions WHERE message_id = ? AND reaction = ? AND user_id = ?",
+                               (rec.id, reaction, uid))
+            if cur.rowcount:
+                action = "remove"
+                conn.execute("UPDATE reaction_counts SET n = n - 1 WHERE message_id = ? AND reaction = ?",
+                             (rec.id, reaction))
+                conn.execute("DELETE FROM reaction_counts WHERE message_id = ? AND reaction = ? AND n <= 0",
+                             (rec.id, reaction))
+            else:
+                conn.execute("INSERT INTO reactions (message_id, reaction, user_id) VALUES (?, ?, ?)",
+                             (rec.id, reaction, uid))
+                conn.execute("INSERT INTO reaction_counts (message_id, reaction, n) VALUES (?, ?, 1) "
+                             "ON CONFLICT DO UPDATE SET n = n + 1", (rec.id, reaction))
+                action = "add"
+            counts = dict(conn.execute("SELECT reaction, n FROM reaction_counts WHERE message_id = ?", (rec.id,)))
+            rec.seq = _touch(conn, rec.id)
+        return action, counts
+
+    # ---- sync ----
+    def conversations_of(self, uid: int) -> list[tuple]:
+        conn = self._conn()
+        return ([("group", gid) for (gid,) in conn.execute(
+                    "SELECT group_id FROM group_members WHERE user_id = ?", (uid,))]
+                + [_dm_key(uid, peer) for (peer,) in conn.execute(
+                    "SELECT peer_id FROM dm_peers WHERE user_id = ?", (uid,))])
+
+    def sync_page(self, uid: int, since: int | None, limit: int) -> tuple[list[Message], int, bool]:
+        conn = self._conn()
+        # rows up to head are all committed (SQLite serializes writers), so head is a safe cursor
+        head = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+        if since is None:
+            return [], head, False
+        limit = max(limit, 1)
+        # same conv strings as _conv(): "group:<gid>", "dm:<low uid>:<high uid>"
+        rows = conn.execute(
+            "SELECT seq, message_id FROM changes WHERE seq > :since AND seq <= :head AND conv IN ("
+            "SELECT 'group:' || group_id FROM group_members WHERE user_id = :uid UNION ALL "
+            "SELECT 'dm:' || min(:uid, peer_id) || ':' || max(:uid, peer_id) FROM dm_peers WHERE user_id = :uid"
+            ") ORDER BY seq LIMIT :limit", {"since": since, "head": head, "uid": uid, "limit": limit}).fetchall()
+        # limit counts changes here, so a page holds at most limit distinct messages
+        page = self.get_messages(sorted({mid for _, mid in rows}))
+        self._load_reaction_counts(page)
+        if len(rows) == limit:
+            return page, rows[-1][0], True
+        return page, head, False
+
+    # ---- inbox ----
+    def inbox_page(self, uid: int, before_id: int | None, limit: int) -> tuple[list[dict], bool]:
+        limit = max(limit, 0)
+        rows = self._conn().execute(
+            f"SELECT s.conv, MAX(s.total - COALESCE(r.sent, 0) - COALESCE(r.seen, 0), 0), "
+            f"COALESCE(g.name, u.username), {', '.join('m.' + c for c in _MSG_COLS.split(', '))} "
+            "FROM conv_stats s JOIN messages m ON m.id = s.last_id "
+            "LEFT JOIN conv_reads r ON r.user_id = :uid AND r.conv = s.conv "
+            "LEFT JOIN chat_groups g ON g.id = m.group_id "
+            "LEFT JOIN users u ON m.group_id IS NULL "
+            "AND u.id = CASE WHEN m.from_user_id = :uid THEN m.to_user_id ELSE m.from_user_id END "
+            "WHERE s.last_id < :before AND s.conv IN ("
+            "SELECT 'group:' || group_id FROM group_members WHERE user_id = :uid UNION ALL "
+            "SELECT 'dm:' || min(:uid, peer_id) || ':' || max(:uid, peer_id) FROM dm_peers WHERE user_id = :uid"
+            ") ORDER BY s.last_id DESC LIMIT :limit",
+            {"uid": uid, "before": before_id or (1 << 62), "limit": limit + 1}).fetchall()
+        out = []
+        for _, unread, name, *msg in rows[:limit]:
+            last = _row_to_msg(msg)
+            if last.group_id is not None:
+                entry = {"group_id": last.group_id, "name": name}
+            else:
+                peer = last.other_party(uid)
+                entry = {"peer_id": peer, "username": name or f"user_{peer}"}
+            entry["last_message"] = last_message_summary(last)
+            entry["unread"] = unread
+            out.append(entry)
+        return out, len(rows) > limit
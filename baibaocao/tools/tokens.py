@@ -0,0 +1,61 @@
+# tools/tokens.py
+import base64
+import hashlib
+import hmac
+import os
+import struct
+import time
+
+_BODY = struct.Struct(">QQ8s")  # user_id, expiry (unix seconds), account fingerprint
+_MAC_LEN = 16
+
+
+def secret_from_env() -> bytes:
+    """CHAT_SESSION_SECRET nếu có (giữ token hợp lệ qua các lần khởi động lại), nếu không thì ngẫu nhiên."""
+    value = os.environ.get("CHAT_SESSION_SECRET")
+    return value.encode() if value else os.urandom(32)
+
+
+class TokenSigner:
+    """
+    Token phiên cho AUTH_RESUME: user_id + hạn dùng + dấu vân tay tài khoản, ký HMAC-SHA256, base64url.
+    Client coi token là chuỗi mờ. Server không lưu gì: mọi worker dùng chung secret
+    đều kiểm tra được; đổi secret là thu hồi toàn bộ token.
+    user_id có thể được cấp lại cho người khác (store trong RAM sau khi khởi động lại, cùng
+    CHAT_SESSION_SECRET), nên token còn gắn với username + password hash (fingerprint):
+    server so lại với tài khoản hiện có user_id đó khi resume.
+    """
+
+    def __init__(self, secret: bytes, ttl: float) -> None:
+        self.secret = secret
+        self.ttl = ttl
+
+    def _mac(self, body: bytes) -> bytes:
+        return hmac.new(self.secret, body, hashlib.sha256).digest()[:_MAC_LEN]
+
+    def fingerprint(self, user: dict) -> bytes:
+        """8 byte từ username + password hash của bản ghi user, có khoá (token không lộ gì về mật khẩu)."""
+        return self._mac(b"user\0" + user["username"].encode() + b"\0" + user["password_hash"].encode())[:8]
+
+    def issue(self, user: dict, now: float | None = None) -> str:
+        body = _BODY.pack(user["user_id"], int((time.time() if now is None else now) + self.ttl),
+                          self.fingerprint(user))
+        return base64.urlsafe_b64encode(body + self._mac(body)).rstrip(b"=").decode()
+
+    def verify(self, token: object, now: float | None = None) -> tuple[int, bytes] | None:
+        """(user_id, fingerprint) nếu token hợp lệ và còn hạn, ngược lại None."""
+        if not isinstance(token, str) or len(token) > 64:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        except ValueError:
+            return None
+        if len(raw) != _BODY.size + _MAC_LEN:
+            return None
+        body, mac = raw[:_BODY.size], raw[_BODY.size:]
+        if not hmac.compare_digest(mac, self._mac(body)):
+            return None
+        user_id, expires, fp = _BODY.unpack(body)
+        if expires < (time.time() if now is None else now):
+            return None
+        return user_id, fp
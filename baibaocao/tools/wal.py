@@ -0,0 +1,187 @@
+# tools/wal.py
+import glob
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Iterator, Optional
+
+
+class WriteAheadLog:
+    """
+    Nhật ký ghi trước (append-only, JSON-lines) + snapshot định kỳ.
+
+    - append(record) chỉ đẩy bản ghi vào bộ đệm rồi trả về ngay; một luồng
+      nền gom mọi bản ghi đang chờ, ghi một lần và fsync một lần (group commit),
+      nên event loop không bao giờ đợi fsync cho từng tin nhắn.
+    - Sau mỗi `snapshot_every` bản ghi, gọi snapshot_source() (trên luồng
+      gọi append, để lấy trạng thái nhất quán) rồi ghi snapshot ở luồng nền,
+      chuyển sang file log mới và xoá các file log cũ đã nằm trong snapshot.
+      snapshot_source() nên rẻ: nếu nó trả về một hàm, luồng nền gọi hàm đó
+      để dựng trạng thái (vd State.capture) rồi mới serialize.
+    - recover() trả về (snapshot, các bản ghi sau snapshot) để dựng lại trạng thái.
+    """
+
+    SNAPSHOT = "snapshot.json"
+
+    def __init__(self, directory: str, commit_interval: float = 0.005,
+                 snapshot_every: int = 100_000) -> None:
+        self.directory = directory
+        self.commit_interval = commit_interval
+        self.snapshot_every = snapshot_every
+        os.makedirs(directory, exist_ok=True)
+
+        self.lsn = 0             # last assigned log sequence number
+        self.durable_lsn = 0     # last lsn known to be fsynced
+        self._cond = threading.Condition()
+        self._pending: list[bytes] = []
+        self._pending_since = 0.0
+        self._snapshot_job: Optional[tuple[int, Any, int]] = None
+        self._since_snapshot = 0
+        self._snapshot_source: Optional[Callable[[], Any]] = None
+        self._before_snapshot: Optional[Callable[[], None]] = None
+        self._fh = None
+        self._thread: Optional[threading.Thread] = None
+        self._closing = False
+
+        # stats (đọc từ luồng bất kỳ, chỉ để theo dõi)
+        self.commits = 0
+        self.records = 0
+        self.commit_latency_total = 0.0
+        self.commit_latency_max = 0.0
+        self.snapshots = 0
+
+    # ---- recovery ----
+    def _log_files(self) -> list[tuple[int, str]]:
+        files = []
+        for path in glob.glob(os.path.join(self.directory, "wal-*.log")):
+            start = os.path.basename(path)[4:-4]
+            if start.isdigit():
+                files.append((int(start), path))
+        return sorted(files)
+
+    def recover(self) -> tuple[Any, list[dict]]:
+        snapshot, snap_lsn = None, 0
+        snap_path = os.path.join(self.directory, self.SNAPSHOT)
+        if os.path.exists(snap_path):
+            with open(snap_path, "rb") as f:
+                doc = json.loads(f.read())
+            snapshot, snap_lsn = doc["state"], doc["lsn"]
+        records = list(self._read_records(snap_lsn))
+        self.lsn = self.durable_lsn = records[-1]["lsn"] if records else snap_lsn
+        return snapshot, records
+
+    def _read_records(self, after_lsn: int) -> Iterator[dict]:
+        for _, path in self._log_files():
+            with open(path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # torn tail write from a crash
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        break
+                    if rec["lsn"] > after_lsn:
+                        yield rec
+
+    # ---- lifecycle ----
+    def start(self, snapshot_source: Optional[Callable[[], Any]] = None,
+              before_snapshot: Optional[Callable[[], None]] = None) -> None:
+        # before_snapshot runs on the flush thread, e.g. to fsync files the snapshot refers to
+        self._snapshot_source = snapshot_source
+        self._before_snapshot = before_snapshot
+        self._fh = open(os.path.join(self.directory, f"wal-{self.lsn + 1}.log"), "ab")
+        self._thread = threading.Thread(target=self._flush_loop, name="wal-flush", daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    # ---- writes ----
+    def append(self, record: dict) -> int:
+        with self._cond:
+            self.lsn += 1
+            record["lsn"] = self.lsn
+            if not self._pending:
+                self._pending_since = time.perf_counter()
+            self._pending.append(json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode() + b"\n")
+            self._since_snapshot += 1
+            if (self._since_snapshot >= self.snapshot_every and self._snapshot_source is not None
+                    and self._snapshot_job is None):
+                self._since_snapshot = 0
+                # pending[:cut] still belongs to the old log file, the rest goes after the snapshot
+                self._snapshot_job = (self.lsn, self._snapshot_source(), len(self._pending))
+            self._cond.notify()
+            return self.lsn
+
+    def _flush_loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending and self._snapshot_job is None and not self._closing:
+                    self._cond.wait()
+                closing = self._closing
+            if not closing:
+                # let more writers join this commit
+                time.sleep(self.commit_interval)
+            with self._cond:
+                batch, self._pending = self._pending, []
+                since = self._pending_since
+                job, self._snapshot_job = self._snapshot_job, None
+                last_lsn = self.lsn
+            if job is None:
+                self._commit(batch)
+            else:
+                lsn, state, cut = job
+                self._commit(batch[:cut])
+                self._write_snapshot(lsn, state() if callable(state) else state)
+                self._commit(batch[cut:])
+            if batch:
+                latency = time.perf_counter() - since
+                self.commits += 1
+                self.records += len(batch)
+                self.commit_latency_total += latency
+                self.commit_latency_max = max(self.commit_latency_max, latency)
+            self.durable_lsn = last_lsn
+            if closing:
+                with self._cond:
+                    if not self._pending:
+                        return
+
+    def _commit(self, lines: list[bytes]) -> None:
+        if not lines:
+            return
+        self._fh.write(b"".join(lines))
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+
+    def _write_snapshot(self, lsn: int, state: Any) -> None:
+        if self._before_snapshot is not None:
+            self._before_snapshot()
+        path = os.path.join(self.directory, self.SNAPSHOT)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(json.dumps({"lsn": lsn, "state": state}, ensure_ascii=False, separators=(",", ":")).encode())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        # records after `lsn` go to a fresh file; older files are covered by the snapshot
+        old = self._fh
+        self._fh = open(os.path.join(self.directory, f"wal-{lsn + 1}.log"), "ab")
+        old.close()
+        current = os.path.basename(self._fh.name)
+        for start, p in self._log_files():
+            if start <= lsn and os.path.basename(p) != current:
+                os.remove(p)
+        self.snapshots += 1
+
+    def stats(self) -> dict:
+        return {"records": self.records, "commits": self.commits, "snapshots": self.snapshots,
+                "avg_commit_ms": self.commit_latency_total / self.commits * 1000 if self.commits else 0.0,
+                "max_commit_ms": self.commit_latency_max * 1000}